@@ -3,128 +3,284 @@
 # This code manages all of the API requests
 # 2024
 
-from flask import Flask, request, jsonify
+import gzip
+import json
+import math
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS, cross_origin
-from trafficBase.model import CityModel
-from trafficBase.agent import Car, Traffic_Light, Obstacle,Road,Destination
+from trafficBase.model import CityModel, RUN_CONDITIONS
+from trafficBase.citymap import available_cities, check_city_name, DEFAULT_CITY, CELL_ROAD, CELL_OBSTACLE, CELL_DESTINATION
+from trafficBase.collector import RingBufferSink
+from trafficBase.frames import pack_frame, pack_arrays
+from trafficBase.sessions import SessionRegistry, SessionLimitError, SESSION_ID_PATTERN
+from trafficBase.broadcast import Ticker, check_tick_rate
+from trafficBase.snapshot import ModelSnapshot
+from trafficBase.trajectory import TrajectoryReader
+from trafficBase.worker import WorkerModel, WorkerError
 
 # Size of the board:
 width = 35
 height = 35
-number_agents = 0
-randomModel = None
-currentStep = 0
+# Independent models by session id (?session=<id>, or "default" for older clients)
+DEFAULT_SESSION = "default"
+sessions = SessionRegistry(max_sessions=int(os.environ.get("TRAFFIC_MAX_SESSIONS", "16")),
+                           idle_timeout=float(os.environ.get("TRAFFIC_SESSION_TIMEOUT", "3600")))
+# Step profiling for /metrics, set TRAFFIC_METRICS=0 to turn it off
+collect_metrics = os.environ.get("TRAFFIC_METRICS", "1") != "0"
+# Collected rows kept per table for live sessions (older ones are dropped)
+history_size = 10000
+# Most steps a single /update?steps=N may run
+max_fast_forward = int(os.environ.get("TRAFFIC_MAX_FAST_FORWARD", "100000"))
+# Steps per second of sessions stepped by the server (/play)
+default_tick_rate = float(os.environ.get("TRAFFIC_TICK_RATE", "10"))
+check_tick_rate(default_tick_rate)
+# Trajectory files written by /init with "record" and served by /replay
+recordings_dir = os.environ.get("TRAFFIC_RECORDINGS",
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings"))
+RECORDING_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,96}\.trj")
+# Open recordings by name: (modification time, size, reader, lock)
+open_recordings = {}
+open_recordings_lock = threading.Lock()
+# Run models in worker processes (see trafficBase.worker), or per session with "worker": true in /init
+use_workers = os.environ.get("TRAFFIC_WORKERS", "0") == "1"
+# Serialized static map responses by (map digest, name): (etag, body, gzipped body)
+static_responses = {}
 
 # Flask app setup
 app = Flask("Traffic Example")
 cors = CORS(app, origins=['http://localhost'])
 
+def current_session():
+    """Return the session named by ?session= in the request, or None if it has no model."""
+    return sessions.get(request.args.get('session', DEFAULT_SESSION))
+
+def session_model(session):
+    """
+    Return the model of a session to read from. For worker sessions this is the
+    last frame the worker published, so reads never wait for a step.
+    """
+    model = session.model
+    return model.latest() if isinstance(model, WorkerModel) else model
+
 @app.route('/init', methods=['POST'])
 @cross_origin()
 def initModel():
-    """Initialize the CityModel with parameters from the client."""
-    global currentStep, randomModel, number_agents
-
+    """
+    Initialize a CityModel with parameters from the client. Each session id
+    ('session' in the body or ?session=) gets its own model; /init again
+    replaces it. The same 'seed' gives the same run, and 'record': true
+    writes every step to a trajectory file that /replay serves. With
+    'worker': true the model steps in its own process (see WorkerModel).
+    """
     if request.method == 'POST':
         try:
             number_agents = int(request.json.get('NAgents'))
-            currentStep = 0
+            city = request.json.get('city', DEFAULT_CITY)
+            session_id = str(request.json.get("session", request.args.get("session", DEFAULT_SESSION)))
+            seed = request.json.get('seed')
+            record = request.json.get('record', False)
+            worker = request.json.get('worker', use_workers)
 
             print(request.json)
-            print(f"Model parameters: {number_agents}")
+            print(f"Model parameters: {number_agents}, {city}, session {session_id}")
+            check_city_name(city)  # Only the shipped maps, never a path on the server
+            # Checked before the id is used in the recording's file name
+            if not SESSION_ID_PATTERN.fullmatch(session_id):
+                raise ValueError(f"Invalid session id {session_id!r}")
+
+            # Initialize the model (the compiled map is reused across /init calls)
+            # Unique even for two /init calls in the same second: the old model may still be writing its file
+            recording = f"{session_id}-{int(time.time())}-{uuid.uuid4().hex[:8]}.trj" if record else None
+            record_path = os.path.join(recordings_dir, recording) if record else None
+            if worker:
+                model = WorkerModel(number_agents, city=city, seed=seed, record=record_path)
+            else:
+                model = CityModel(number_agents, city=city, seed=seed, metrics=collect_metrics,
+                                  collector=RingBufferSink(history_size), record=record_path)
+            try:
+                sessions.create(session_id, model)  # Closes the model if it fails
+            except Exception:
+                if record_path is not None:
+                    os.remove(record_path)
+                raise
+            print("MODEL STARTED CORRECTLY")
+            return jsonify({"message": "Parametersss received, model initialized.", "session": session_id,
+                            "seed": model._seed, "recording": recording, "worker": bool(worker)})
+
+        except ValueError as e:
+            print(e)
+            return jsonify({"message": str(e)}), 400
 
-            # Initialize the model
-            randomModel = CityModel(number_agents)
-            if randomModel is None:
-                print("MODEL NOT STARTED")
-            elif randomModel is not None:
-                print("MODEL STARTED CORRECTLY")
-            return jsonify({"message": "Parametersss received, model initialized."})
+        except SessionLimitError as e:
+            print(e)
+            return jsonify({"message": str(e)}), 503
 
         except Exception as e:
             print(e)
             return jsonify({"message": "Error initializing the model"}), 500
 
+@app.route('/getCities', methods=['GET'])
+@cross_origin()
+def getCities():
+    """List the map files that can be passed as 'city' to /init."""
+    return jsonify({'cities': available_cities(), 'default': DEFAULT_CITY})
+
 @app.route('/getAgents', methods=['GET'])
 @cross_origin()
 def getAgents():
-    """Retrieve the positions of all cars in the model."""
-    global randomModel
-
+    """
+    Retrieve the positions of all cars in the model.
+    With ?since=<step> (the 'step' of a previous response), only the cars
+    added, moved or removed after that step are sent. 'full' tells if the
+    response is a complete snapshot instead (first request or too old a step).
+    """
     if request.method == 'GET':
         try:
-            if not randomModel:
+            session = current_session()
+            if session is None:
                 return jsonify({"message": "Model not initialized"}), 400
 
-            # Get car positions from the schedule instead
-            car_positions = []
-            for agents, pos in randomModel.grid.coord_iter():
-            # for agent in randomModel.schedule.agents:
-                for agent in agents:
-                    if isinstance(agent, Car):
-                        car_positions.append({
-                            "id": agent.unique_id,
-                            "x": agent.pos[0],
-                            "y": 0.7,
-                            "z": agent.pos[1]  # Using y coordinate as z for 3D
-                        })
-            
-            print(f"Found {len(car_positions)} cars")
-                
-            return jsonify({'positions': car_positions})
+            with session.lock:
+                model = session_model(session)
+                since = request.args.get('since', type=int)
+                changes = model.car_changes(since)
+
+                def car_list(cars):
+                    return [{
+                        "id": unique_id,
+                        "x": pos[0],
+                        "y": 0.7,
+                        "z": pos[1]  # Using y coordinate as z for 3D
+                    } for unique_id, pos in cars]
+
+                if since is None:
+                    return jsonify({'step': changes['step'], 'positions': car_list(changes['added'])})
+
+                return jsonify({
+                    'step': changes['step'],
+                    'full': changes['full'],
+                    'added': car_list(changes['added']),
+                    'moved': car_list(changes['moved']),
+                    'removed': changes['removed'],
+                })
 
         except Exception as e:
             print(f"Error in getAgents: {str(e)}")
             return jsonify({"message": f"Error retrieving agent positions: {str(e)}"}), 500
 
+def buildings_payload(model):
+    """Positions of all obstacle cells."""
+    return {'positions': [{
+        "id": model.cell_id("ob", pos),
+        "x": pos[0],
+        "y": 1,
+        "z": pos[1]  # Using y coordinate as z for 3D
+    } for pos in model.static_cells(CELL_OBSTACLE)]}
+
+def roads_payload(model):
+    """Positions and directions of all road cells."""
+    return {'positions': [{
+        "id": model.cell_id("r", pos),
+        "x": pos[0],
+        "y": 0.6,
+        "z": pos[1],  # Using y coordinate as z for 3D
+        "direction": model.direction_layer[pos].tolist()
+    } for pos in model.static_cells(CELL_ROAD)]}
+
+def destinations_payload(model):
+    """Positions of all destination cells."""
+    return {'positions': [{
+        "id": model.cell_id("d", pos),
+        "x": pos[0],
+        "y": 1,
+        "z": pos[1]  # Using y coordinate as z for 3D
+    } for pos in model.static_cells(CELL_DESTINATION)]}
+
+def map_payload(model):
+    """Every static layer of the map in one payload (light states come from /getLights or /step)."""
+    return {
+        'width': model.width,
+        'height': model.height,
+        'buildings': buildings_payload(model)['positions'],
+        'roads': roads_payload(model)['positions'],
+        'destinations': destinations_payload(model)['positions'],
+        'lights': [{"id": light.unique_id, "x": light.pos[0], "y": 2, "z": light.pos[1]}
+                   for light in model.traffic_lights],
+    }
+
+# Static map responses, built once per loaded map
+STATIC_PAYLOADS = {
+    'buildings': buildings_payload,
+    'roads': roads_payload,
+    'destinations': destinations_payload,
+    'map': map_payload,
+}
+
+def static_response(name, model):
+    """
+    Serve a static map response. The JSON body and its gzip version are built
+    once per map (keyed by the map's content hash) and sent with an ETag, so
+    clients that already have it get a 304 instead of a new grid scan.
+    """
+    digest = model.city_map.digest
+    cached = static_responses.get((digest, name))
+    if cached is None:
+        body = json.dumps(STATIC_PAYLOADS[name](model), separators=(',', ':')).encode()
+        cached = (f"{digest[:16]}-{name}", body, gzip.compress(body))
+        static_responses[(digest, name)] = cached
+    etag, body, compressed = cached
+
+    use_gzip = 'gzip' in request.accept_encodings
+    if use_gzip:
+        etag += "-gzip"  # Each encoding is a different representation
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(compressed if use_gzip else body, mimetype="application/json")
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'  # Revalidate, /init may load another map
+    return response
+
 @app.route('/getBuildings', methods=['GET'])
 @cross_origin()
 def getBuildings():
-    """Retrieve the positions of all cars in the model."""
-    global randomModel
-
+    """Retrieve the positions of all buildings."""
     if request.method == 'GET':
         try:
-            if not randomModel:
+            session = current_session()
+            if session is None:
                 return jsonify({"message": "Model not initialized"}), 400
 
-            # Get car positions from the schedule instead
-            obstacles_positions = []
-            for agents, pos in randomModel.grid.coord_iter():
-            # for agent in randomModel.schedule.agents:
-                for agent in agents:
-                    if isinstance(agent, Obstacle):
-                        obstacles_positions.append({
-                            "id": agent.unique_id,
-                            "x": agent.pos[0],
-                            "y": 1,
-                            "z": agent.pos[1]  # Using y coordinate as z for 3D
-                        })
-            
-            print(f"Found {len(obstacles_positions)} obstacles")
-
-                
-            return jsonify({'positions': obstacles_positions})
+            return static_response('buildings', session.model)
 
         except Exception as e:
-            print(f"Error in getObstacles: {str(e)}")
+            print(f"Error in getBuildings: {str(e)}")
             return jsonify({"message": f"Error retrieving obstacles positions: {str(e)}"}), 500
 
 @app.route('/getLights', methods=['GET'])
 @cross_origin()
 def getLights():
     """Retrieve the positions and states of all traffic lights."""
-    global randomModel
-
     if request.method == 'GET':
         try:
-            if not randomModel:
+            session = current_session()
+            if session is None:
                 return jsonify({"message": "Model not initialized"}), 400
 
-            # Get car positions from the schedule instead
-            light_positions = []
-            for agent in randomModel.schedule.agents:
-                if isinstance(agent, Traffic_Light):
+            with session.lock:
+                model = session_model(session)
+                # Get light positions and states from the model
+                light_positions = []
+                for agent in model.traffic_lights:
                     light_positions.append({
                         "id": agent.unique_id,
                         "x": agent.pos[0],
@@ -132,10 +288,10 @@ def getLights():
                         "z": agent.pos[1],
                         "state":agent.state  # Using y coordinate as z for 3D
                     })
-            
-            print(f"Found {len(light_positions)} Lights")
-                
-            return jsonify({'positions': light_positions})
+
+                print(f"Found {len(light_positions)} Lights")
+
+                return jsonify({'positions': light_positions})
 
         except Exception as e:
             print(f"Error in getAgents: {str(e)}")
@@ -145,91 +301,69 @@ def getLights():
 @app.route('/getRoads', methods=['GET'])
 @cross_origin()
 def getRoads():
-    """Retrieve the positions of all cars in the model."""
-    global randomModel
-
+    """Retrieve the positions and directions of all roads."""
     if request.method == 'GET':
         try:
-            if not randomModel:
+            session = current_session()
+            if session is None:
                 return jsonify({"message": "Model not initialized"}), 400
 
-            # Get car positions from the schedule instead
-            Roads_positions = []
-            for agents, pos in randomModel.grid.coord_iter():
-            # for agent in randomModel.schedule.agents:
-                for agent in agents:
-                    if isinstance(agent,Road ):
-                        """or isinstance(agent,Traffic_Light ) :"""
-                        Roads_positions.append({
-                            "id": agent.unique_id,
-                            "x": agent.pos[0],
-                            "y": 0.6,
-                            "z": agent.pos[1],
-                            "direction": agent.direction  # Using y coordinate as z for 3D
-                        })
-                
-            
-            print(f"Found {len(Roads_positions)} Roads")
-            for pos in Roads_positions:
-                print(f"Roads {pos['id']} at position ({pos['x']}, {pos['z']}) with direction {pos['direction']}")
-                
-            return jsonify({'positions': Roads_positions})
+            return static_response('roads', session.model)
 
         except Exception as e:
-            print(f"Error in getObstacles: {str(e)}")
-            return jsonify({"message": f"Error retrieving obstacles positions: {str(e)}"}), 500
+            print(f"Error in getRoads: {str(e)}")
+            return jsonify({"message": f"Error retrieving road positions: {str(e)}"}), 500
 
 @app.route('/getDestinations', methods=['GET'])
 @cross_origin()
 def getDestinations():
-    """Retrieve the positions of all cars in the model."""
-    global randomModel
-
+    """Retrieve the positions of all destinations."""
     if request.method == 'GET':
         try:
-            if not randomModel:
+            session = current_session()
+            if session is None:
                 return jsonify({"message": "Model not initialized"}), 400
 
-            # Get car positions from the schedule instead
-            Roads_positions = []
-            for agents, pos in randomModel.grid.coord_iter():
-            # for agent in randomModel.schedule.agents:
-                for agent in agents:
-                    if isinstance(agent,Destination):
-                        Roads_positions.append({
-                            "id": agent.unique_id,
-                            "x": agent.pos[0],
-                            "y": 1,
-                            "z": agent.pos[1]  # Using y coordinate as z for 3D
-                        })
-            
-            print(f"Found {len(Roads_positions)} Destinations")
-            for pos in Roads_positions:
-                print(f"Destinations {pos['id']} at position ({pos['x']}, {pos['z']})")
-                
-            return jsonify({'positions': Roads_positions})
+            return static_response('destinations', session.model)
 
         except Exception as e:
             print(f"Error in getDestinations: {str(e)}")
             return jsonify({"message": f"Error retrieving Destination positions: {str(e)}"}), 500
 
+@app.route('/getMap', methods=['GET'])
+@cross_origin()
+def getMap():
+    """Retrieve every static layer of the map in one response."""
+    if request.method == 'GET':
+        try:
+            session = current_session()
+            if session is None:
+                return jsonify({"message": "Model not initialized"}), 400
+
+            return static_response('map', session.model)
+
+        except Exception as e:
+            print(f"Error in getMap: {str(e)}")
+            return jsonify({"message": f"Error retrieving map: {str(e)}"}), 500
+
 @app.route('/getStats', methods=['GET'])
 @cross_origin()
 def getStats():
     """Retrieve the model's statistics: in_grid and reached_destination."""
-    global randomModel
-
     if request.method == 'GET':
         try:
-            if not randomModel:
+            session = current_session()
+            if session is None:
                 return jsonify({"message": "Model not initialized"}), 400
 
-            stats = {
-                'in_grid': randomModel.in_grid,
-                'reached_destination': randomModel.reached_destination,
-            }
+            with session.lock:
+                model = session_model(session)
+                stats = {
+                    'in_grid': model.in_grid,
+                    'reached_destination': model.reached_destination,
+                }
 
-            return jsonify(stats)
+                return jsonify(stats)
 
         except Exception as e:
             print(f"Error in getStats: {str(e)}")
@@ -238,19 +372,409 @@ def getStats():
 @app.route('/update', methods=['GET'])
 @cross_origin()
 def updateModel():
-    """Advance the model by one step."""
-    global currentStep, randomModel
-
+    """
+    Advance the model by one step, or fast-forward it server-side:
+    - steps: Steps to run in a row (at most max_fast_forward).
+    - until: Stop early on a condition, "stable" for once in_grid stays
+      steady (window and tolerance set it, see InGridStable).
+    - collect: 0 to skip the per-step data collection while fast-forwarding.
+    Only the final state and a summary are returned. Worker sessions only
+    queue the steps and return at once ('steps' queued, 'stopped': 'queued').
+    """
     if request.method == 'GET':
         try:
-            randomModel.step()
-            currentStep += 1
-            return jsonify({'message': f'Model updated to step {currentStep}.', 'currentStep': currentStep})
+            session = current_session()
+            if session is None:
+                return jsonify({"message": "Model not initialized"}), 400
+
+            steps = request.args.get('steps', '1')
+            until_name = request.args.get('until')
+            if not re.fullmatch(r"[0-9]{1,9}", steps) or not 1 <= int(steps) <= max_fast_forward:
+                return jsonify({"message": f"steps must be between 1 and {max_fast_forward}"}), 400
+            steps = int(steps)
+            until = None
+            if until_name is not None:
+                if until_name not in RUN_CONDITIONS:
+                    return jsonify({"message": f"Unknown condition {until_name!r}, expected one of {tuple(RUN_CONDITIONS)}"}), 400
+                options = {}
+                window = request.args.get('window')
+                if window is not None:
+                    if not re.fullmatch(r"[0-9]{1,9}", window) or not 1 <= int(window) <= max_fast_forward:
+                        return jsonify({"message": f"window must be an integer between 1 and {max_fast_forward}"}), 400
+                    options['window'] = int(window)
+                tolerance = request.args.get('tolerance')
+                if tolerance is not None:
+                    try:
+                        options['tolerance'] = float(tolerance)
+                    except ValueError:
+                        options['tolerance'] = math.nan
+                    if not 0 <= options['tolerance'] < math.inf:
+                        return jsonify({"message": "tolerance must be a number of at least 0"}), 400
+                until = RUN_CONDITIONS[until_name](**options)
+            collect = request.args.get('collect', '1') != '0'
+
+            with session.lock:
+                model = session.model
+                if isinstance(model, WorkerModel):
+                    done, reason = model.run_steps(steps, until=until, collect=collect)
+                elif steps == 1 and until is None:
+                    model.step()
+                    done, reason = 1, "steps"
+                else:
+                    start = time.perf_counter()
+                    done, reason = model.run_steps(steps, until=until, collect=collect)
+                    print(f"Fast-forwarded {done} steps in {time.perf_counter() - start:.3f}s ({reason})")
+                session.current_step += done
+                model = session_model(session)
+                return jsonify({
+                    'message': f'Model updated to step {session.current_step}.',
+                    'currentStep': session.current_step,
+                    'steps': done,
+                    'stopped': reason,
+                    'running': model.running,
+                    'in_grid': model.in_grid,
+                    'reached_destination': model.reached_destination,
+                    'stuck_cars': model.stuck_car_count(),
+                })
+
+        except WorkerError as e:
+            print(e)
+            return jsonify({"message": str(e)}), 500
 
         except Exception as e:
             print(e)
             return jsonify({"message": "Error during model update."}), 500
 
+def frame_payload(model):
+    """Cars, light states and stats of the model after its last step."""
+    numbers, xs, ys = model.car_arrays()
+    return frame_json(model.step_count, model.in_grid, model.reached_destination, numbers, xs, ys,
+                      model.light_states())
+
+def frame_json(step, in_grid, reached_destination, numbers, xs, ys, lights):
+    """JSON body of a frame from its arrays (the same for live and recorded steps)."""
+    return {
+        'step': step,
+        'in_grid': in_grid,
+        'reached_destination': reached_destination,
+        'cars': [{"id": f"car_{number}", "x": x, "y": 0.7, "z": y}
+                 for number, x, y in zip(numbers.tolist(), xs.tolist(), ys.tolist())],
+        'lights': lights.tolist(),  # In /getLights order
+    }
+
+@app.route('/step', methods=['GET'])
+@cross_origin()
+def stepModel():
+    """
+    Advance the model by one step and return the cars, light states and stats
+    in one response. With ?format=binary the frame is packed as little-endian
+    arrays (see trafficBase.frames.pack_frame) instead of JSON. Worker
+    sessions queue the step and return the last frame they published.
+    """
+    if request.method == 'GET':
+        try:
+            session = current_session()
+            if session is None:
+                return jsonify({"message": "Model not initialized"}), 400
+
+            with session.lock:
+                model = session.model
+                model.step()
+                session.current_step += 1
+                model = session_model(session)
+
+                if request.args.get('format') == 'binary':
+                    return Response(pack_frame(model), mimetype="application/octet-stream")
+
+                return jsonify(frame_payload(model))
+
+        except Exception as e:
+            print(f"Error in stepModel: {str(e)}")
+            return jsonify({"message": f"Error during model step: {str(e)}"}), 500
+
+@app.route('/checkpoint', methods=['GET'])
+@cross_origin()
+def checkpointModel():
+    """Return a binary snapshot of the session's model (see trafficBase.snapshot), for /restore."""
+    if request.method == 'GET':
+        try:
+            session = current_session()
+            if session is None:
+                return jsonify({"message": "Model not initialized"}), 400
+            if isinstance(session.model, WorkerModel):
+                return jsonify({"message": "Checkpoints are not available for worker sessions"}), 409
+
+            with session.lock:
+                snapshot = ModelSnapshot.capture(session.model)
+            return Response(snapshot.to_bytes(), mimetype="application/octet-stream")
+
+        except Exception as e:
+            print(f"Error in checkpointModel: {str(e)}")
+            return jsonify({"message": f"Error taking a checkpoint: {str(e)}"}), 500
+
+@app.route('/restore', methods=['POST'])
+@cross_origin()
+def restoreModel():
+    """Start the session (?session=) from a snapshot sent as the request body by /checkpoint."""
+    if request.method == 'POST':
+        try:
+            session_id = request.args.get('session', DEFAULT_SESSION)
+            snapshot = ModelSnapshot.from_bytes(request.get_data())
+            check_city_name(snapshot.meta.get("city"))
+            model = snapshot.restore(metrics=collect_metrics, collector=RingBufferSink(history_size))
+            sessions.create(session_id, model)
+            return jsonify({"message": "Model restored.", "session": session_id, "step": model.step_count})
+
+        except (ValueError, OSError, KeyError, TypeError) as e:  # A malformed snapshot
+            print(e)
+            return jsonify({"message": str(e)}), 400
+
+        except SessionLimitError as e:
+            print(e)
+            return jsonify({"message": str(e)}), 503
+
+        except Exception as e:
+            print(f"Error in restoreModel: {str(e)}")
+            return jsonify({"message": f"Error restoring the model: {str(e)}"}), 500
+
+@app.route('/fork', methods=['POST'])
+@cross_origin()
+def forkModel():
+    """
+    Copy the session's model into new independent sessions, to try what-ifs
+    from the same state. The body maps every new session id to the settings
+    to change in it (see TUNABLES), e.g. {"forks": {"short": {"light_cycle_duration": 6}, "same": {}}}.
+    """
+    if request.method == 'POST':
+        try:
+            session = current_session()
+            if session is None:
+                return jsonify({"message": "Model not initialized"}), 400
+            if isinstance(session.model, WorkerModel):
+                return jsonify({"message": "Forks are not available for worker sessions"}), 409
+
+            forks = (request.get_json(silent=True) or {}).get('forks', {})
+            if not isinstance(forks, dict) or not all(isinstance(changes, dict) for changes in forks.values()):
+                return jsonify({"message": "forks must map session ids to settings"}), 400
+            with session.lock:
+                snapshot = ModelSnapshot.capture(session.model)
+
+            # Build every fork before registering any, so a bad parameter leaves no half-made fork
+            models = {}
+            pending = []  # Models not handed to the registry yet, closed if a fork fails
+            try:
+                for fork_id, changes in forks.items():
+                    model = snapshot.restore(metrics=collect_metrics, collector=RingBufferSink(history_size))
+                    pending.append(model)
+                    for name, value in changes.items():
+                        model.set_tunable(name, value)
+                    models[fork_id] = model
+                for fork_id, model in models.items():
+                    pending.remove(model)
+                    sessions.create(fork_id, model)
+            finally:
+                for model in pending:
+                    model.close()
+            return jsonify({"message": "Model forked.", "sessions": list(models), "step": snapshot.meta["scalars"]["step_count"]})
+
+        except ValueError as e:
+            print(e)
+            return jsonify({"message": str(e)}), 400
+
+        except SessionLimitError as e:
+            print(e)
+            return jsonify({"message": str(e)}), 503
+
+        except Exception as e:
+            print(f"Error in forkModel: {str(e)}")
+            return jsonify({"message": f"Error forking the model: {str(e)}"}), 500
+
+def session_ticker(session):
+    """Return the session's ticker, creating it on first use."""
+    with session.lock:
+        if session.ticker is None:
+            session.ticker = Ticker(session, frame_payload, default_tick_rate)
+        return session.ticker
+
+@app.route('/play', methods=['POST'])
+@cross_origin()
+def playModel():
+    """
+    Let the server step the session's model on its own at tick_rate steps per
+    second (in the body or ?tick_rate=, default TRAFFIC_TICK_RATE). Every step
+    is pushed to the viewers of /stream.
+    """
+    if request.method == 'POST':
+        try:
+            session = current_session()
+            if session is None:
+                return jsonify({"message": "Model not initialized"}), 400
+
+            body = request.get_json(silent=True) or {}
+            tick_rate = body.get('tick_rate', request.args.get('tick_rate'))
+            if isinstance(tick_rate, str):
+                try:
+                    tick_rate = float(tick_rate)
+                except ValueError:
+                    pass  # Rejected below with the value in the message
+            if tick_rate is not None:
+                check_tick_rate(tick_rate)
+            if isinstance(session.model, WorkerModel):
+                tick_rate = default_tick_rate if tick_rate is None else tick_rate
+                session.model.play(tick_rate)  # The worker steps on its own timer
+                return jsonify({'playing': True, 'tick_rate': tick_rate})
+            ticker = session_ticker(session)
+            ticker.start(tick_rate)
+            return jsonify({'playing': True, 'tick_rate': ticker.tick_rate})
+
+        except ValueError as e:
+            print(e)
+            return jsonify({"message": str(e)}), 400
+
+        except Exception as e:
+            print(f"Error in playModel: {str(e)}")
+            return jsonify({"message": f"Error starting the simulation: {str(e)}"}), 500
+
+@app.route('/pause', methods=['POST'])
+@cross_origin()
+def pauseModel():
+    """Stop the server-driven stepping started by /play. Viewers stay connected."""
+    if request.method == 'POST':
+        try:
+            session = current_session()
+            if session is None:
+                return jsonify({"message": "Model not initialized"}), 400
+
+            if isinstance(session.model, WorkerModel):
+                session.model.pause()
+            if session.ticker is not None:
+                session.ticker.stop()
+            return jsonify({'playing': False, 'currentStep': session.current_step})
+
+        except Exception as e:
+            print(f"Error in pauseModel: {str(e)}")
+            return jsonify({"message": f"Error pausing the simulation: {str(e)}"}), 500
+
+@app.route('/stream', methods=['GET'])
+@cross_origin()
+def streamModel():
+    """
+    Server-Sent Events stream of the session: one 'frame' event (the JSON of
+    /step) for every step run by /play. Nobody needs to poll /update.
+    """
+    if request.method == 'GET':
+        session = current_session()
+        if session is None:
+            return jsonify({"message": "Model not initialized"}), 400
+        if isinstance(session.model, WorkerModel):
+            return jsonify({"message": "Live streams are not available for worker sessions"}), 409
+
+        ticker = session_ticker(session)
+        viewer = ticker.subscribe()
+
+        def events():
+            try:
+                yield "retry: 1000\n\n"
+                while True:
+                    try:
+                        message = viewer.get(timeout=15)
+                    except queue.Empty:
+                        yield ": keep-alive\n\n"  # Lets proxies and clients know the stream is alive
+                        continue
+                    if message is None:
+                        break  # Session closed or replaced
+                    yield message
+            finally:
+                ticker.unsubscribe(viewer)
+
+        return Response(events(), mimetype="text/event-stream",
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def recording_reader(name):
+    """Return the reader and lock of a recording, reopening it if the file changed."""
+    if not RECORDING_PATTERN.fullmatch(name):
+        raise ValueError(f"Invalid recording name {name!r}")
+    path = os.path.join(recordings_dir, name)
+    stat = os.stat(path)
+    with open_recordings_lock:
+        cached = open_recordings.get(name)
+        if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2], cached[3]
+        if cached is not None:
+            with cached[3]:
+                cached[2].close()
+        reader = TrajectoryReader(path)
+        open_recordings[name] = (stat.st_mtime, stat.st_size, reader, threading.Lock())
+        return reader, open_recordings[name][3]
+
+@app.route('/getRecordings', methods=['GET'])
+@cross_origin()
+def getRecordings():
+    """List the trajectory files that /replay can serve."""
+    if not os.path.isdir(recordings_dir):
+        return jsonify({'recordings': []})
+    return jsonify({'recordings': sorted(name for name in os.listdir(recordings_dir)
+                                         if RECORDING_PATTERN.fullmatch(name))})
+
+@app.route('/replay', methods=['GET'])
+@cross_origin()
+def replayModel():
+    """
+    Serve a recorded run without simulating it (?recording=<name>). With
+    ?step=N, return that step like /step does (?format=binary included);
+    otherwise, return the recording's header and its first and last steps.
+    """
+    if request.method == 'GET':
+        try:
+            reader, lock = recording_reader(request.args.get('recording', ''))
+            step = request.args.get('step', type=int)
+            with lock:
+                if step is None:
+                    return jsonify({**reader.header, 'steps': len(reader),
+                                    'first_step': int(reader.steps[0]) if len(reader) else None,
+                                    'last_step': int(reader.steps[-1]) if len(reader) else None})
+                frame = reader.frame(step)
+
+            arrays = (frame['step'], frame['in_grid'], frame['reached_destination'],
+                      frame['numbers'], frame['xs'], frame['ys'], frame['lights'])
+            if request.args.get('format') == 'binary':
+                return Response(pack_arrays(*arrays), mimetype="application/octet-stream")
+            return jsonify(frame_json(*arrays))
+
+        except (ValueError, KeyError) as e:
+            print(e)
+            return jsonify({"message": str(e)}), 400
+
+        except FileNotFoundError:
+            return jsonify({"message": "No such recording"}), 404
+
+        except Exception as e:
+            print(f"Error in replayModel: {str(e)}")
+            return jsonify({"message": f"Error replaying the recording: {str(e)}"}), 500
+
+@app.route('/metrics', methods=['GET'])
+@cross_origin()
+def getMetrics():
+    """Expose the per-phase step timings and model counters in the Prometheus text format."""
+    if request.method == 'GET':
+        try:
+            session = current_session()
+            if session is None:
+                return jsonify({"message": "Model not initialized"}), 400
+            if isinstance(session.model, WorkerModel):
+                return jsonify({"message": "Metrics are not available for worker sessions"}), 409
+            if session.model.metrics is None:
+                return jsonify({"message": "Metrics are turned off (TRAFFIC_METRICS=0)"}), 404
+
+            with session.lock:
+                model = session.model
+
+                return Response(model.metrics.render(model), mimetype="text/plain; version=0.0.4")
+
+        except Exception as e:
+            print(f"Error in getMetrics: {str(e)}")
+            return jsonify({"message": f"Error retrieving metrics: {str(e)}"}), 500
+
 if __name__ == '__main__':
     # Run the Flask server on port 8585
     app.run(host="localhost", port=8585, debug=True)
@@ -0,0 +1,63 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code measures the memory used by the city model
+# 2024
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+# Make trafficBase importable when run as a script
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from trafficBase.model import CityModel  # noqa: E402
+from trafficBase.agent import Car  # noqa: E402
+
+
+def measure(steps=30, seed=0):
+    """
+    Builds a CityModel, runs it for a number of steps and reports the memory
+    it holds, the peak allocated while running and the number of Python
+    objects tracked by the garbage collector.
+    """
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    tracemalloc.start()
+
+    start = time.perf_counter()
+    model = CityModel(0, seed=seed)
+    build_time = time.perf_counter() - start
+    build_memory, _ = tracemalloc.get_traced_memory()
+
+    for _ in range(steps):
+        model.step()
+        if not model.running:
+            break
+
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+
+    cars = [agent for agent in model.schedule.agents if isinstance(agent, Car)]
+    # Object size plus its attribute dictionary, if it uses one
+    car_bytes = sum(sys.getsizeof(car) + (sys.getsizeof(vars(car)) if vars(car) else 0) for car in cars)
+    return {
+        "build_seconds": round(build_time, 4),
+        "build_kib": round(build_memory / 1024, 1),
+        "current_kib": round(current / 1024, 1),
+        "peak_kib": round(peak / 1024, 1),
+        "gc_objects": len(gc.get_objects()) - objects_before,
+        "scheduled_agents": model.schedule.get_agent_count(),
+        "cars": len(cars),
+        "bytes_per_car": round(car_bytes / len(cars)) if cars else 0,
+        "steps": model.step_count,
+    }
+
+
+if __name__ == '__main__':
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    for name, value in measure(steps).items():
+        print(f"{name}: {value}")
@@ -0,0 +1,235 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code runs the headless simulation benchmarks and writes them as JSON
+# 2024
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Make trafficBase importable when run as a script
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+import mesa  # noqa: E402
+import numpy as np  # noqa: E402
+from trafficBase.model import CityModel  # noqa: E402
+from trafficBase.citygen import write_city  # noqa: E402
+
+SHIPPED_CITIES = ["2021_base", "2022_base", "2024_base"]
+GENERATED_CITIES = ["grid-100x100", "grid-200x200"]  # "grid-WxH" maps are made with citygen
+
+
+def city_file(city, directory):
+    """
+    Returns what to pass as city to CityModel: shipped maps by name, and
+    "grid-WxH" maps generated (with a fixed seed) into directory.
+    """
+    if not city.startswith("grid-"):
+        return city
+    width, height = (int(size) for size in city[len("grid-"):].split("x"))
+    path = os.path.abspath(os.path.join(directory, f"{city}.txt"))
+    if not os.path.exists(path):
+        write_city(path, width, height, destinations=max(4, width * height // 2500), seed=0)
+    return path
+
+
+def peak_rss_kib():
+    """
+    Peak resident memory of this process in KiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # macOS reports bytes
+
+
+def percentile(values, q):
+    """
+    Percentile of a list of values, or None for an empty list.
+    """
+    return round(float(np.percentile(values, q)), 4) if values else None
+
+
+def run_once(config):
+    """
+    Runs one benchmark configuration and returns its measurements.
+
+    Parameters:
+    - config: Dictionary with city (name or path), engine, signals,
+      spawn_interval, light_cycle_duration, steps, probes, seed, workers
+      (processes of the partitioned engine) and read_frames (read the cars
+      after every step, as metrics, recordings and /step frames do).
+    """
+    start = time.perf_counter()
+    model = CityModel(0, engine=config["engine"], city=config["city_file"], seed=config["seed"],
+                      signals=config["signals"], workers=config.get("workers"))
+    build_seconds = time.perf_counter() - start
+    model.spawn_interval = config["spawn_interval"]
+    model.light_cycle_duration = config["light_cycle_duration"]
+
+    # Time every find_path call the cars make
+    latencies = []
+    find_path = model.find_path
+
+    def timed_find_path(*args, **kwargs):
+        call_start = time.perf_counter()
+        path = find_path(*args, **kwargs)
+        latencies.append(time.perf_counter() - call_start)
+        return path
+
+    model.find_path = timed_find_path
+
+    start = time.perf_counter()
+    steps = 0
+    while steps < config["steps"] and model.running:
+        model.step()
+        if config.get("read_frames"):
+            model.stuck_car_count()
+            model.car_changes(model.step_count - 1)
+        steps += 1
+    step_seconds = time.perf_counter() - start
+    cars_left = model.in_grid
+
+    # Probe searches from the spawn corners to random destinations, with the
+    # final traffic, so both engines report a routing latency
+    probe_random = random.Random(config["seed"])
+    for _ in range(config["probes"]):
+        model.find_path(probe_random.choice(model.corner_positions), probe_random.choice(model.destinations))
+
+    model.close()
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return {
+        **{key: value for key, value in config.items() if key != "city_file"},
+        "steps_run": steps,
+        "stopped_early": steps < config["steps"],
+        "build_seconds": round(build_seconds, 4),
+        "steps_per_second": round(steps / step_seconds, 2) if step_seconds > 0 else None,
+        "find_path_calls": len(latencies_ms),
+        "find_path_p50_ms": percentile(latencies_ms, 50),
+        "find_path_p99_ms": percentile(latencies_ms, 99),
+        "peak_rss_kib": peak_rss_kib(),
+        "cars_delivered": model.reached_destination,
+        "cars_in_grid": cars_left,
+        "delivered_per_1000_steps": round(1000 * model.reached_destination / steps, 2) if steps else 0.0,
+    }
+
+
+def run_isolated(config):
+    """
+    Runs a configuration in a fresh process, so peak RSS belongs to that run
+    only. The process is not a daemon, so the partitioned engine can start its workers.
+    """
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(run_once, config).result()
+
+
+def environment():
+    """
+    Describes the machine and code the benchmarks ran on.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=SERVER_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "mesa": mesa.__version__,
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def run_key(run):
+    """
+    Fields that identify a run when comparing two result files.
+    """
+    return (run["city"], run["engine"], run.get("signals", "fixed"), run["spawn_interval"],
+            run["light_cycle_duration"], run["seed"], run["steps"], run.get("read_frames", False))
+
+
+def compare(results, baseline):
+    """
+    Prints the change in steps/sec and delivery rate against an older result file.
+    """
+    old_runs = {run_key(run): run for run in baseline["runs"]}
+    for run in results["runs"]:
+        old = old_runs.get(run_key(run))
+        if old is None or not old["steps_per_second"] or not run["steps_per_second"]:
+            continue
+        speedup = run["steps_per_second"] / old["steps_per_second"]
+        print(f"{run['city']:>14} {run['engine']:>10} {run.get('signals', 'fixed'):>8} spawn/{run['spawn_interval']} "
+              f"cycle {run['light_cycle_duration']:>2}: {speedup:6.2f}x steps/sec, delivered/1000 {old['delivered_per_1000_steps']} -> {run['delivered_per_1000_steps']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless benchmarks of CityModel.step.")
+    parser.add_argument("--cities", nargs="+", default=SHIPPED_CITIES + GENERATED_CITIES)
+    parser.add_argument("--engines", nargs="+", default=["agents", "vectorized"],
+                        help="Stepping engines (agents, vectorized, partitioned)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Processes of the partitioned engine (default: one per core)")
+    parser.add_argument("--read-frames", action="store_true",
+                        help="Read the stuck count and car changes after every step, like a server session")
+    parser.add_argument("--signals", nargs="+", default=["fixed"], help="Signal controllers (fixed, actuated)")
+    parser.add_argument("--spawn-intervals", nargs="+", type=int, default=[1, 4],
+                        help="Car densities, as steps between spawn waves")
+    parser.add_argument("--light-cycles", nargs="+", type=int, default=[10, 20])
+    parser.add_argument("--seeds", nargs="+", type=int, default=[0])
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--probes", type=int, default=50, help="Extra find_path calls timed after each run")
+    parser.add_argument("--output", default=None, help="JSON file to write (default: print only)")
+    parser.add_argument("--compare", default=None, help="Older JSON result file to compare against")
+    parser.add_argument("--in-process", action="store_true",
+                        help="Run everything in this process (faster, but peak RSS is cumulative)")
+    arguments = parser.parse_args(argv)
+
+    results = {"environment": environment(), "runs": []}
+    with tempfile.TemporaryDirectory() as directory:
+        for city, engine, signals, spawn_interval, light_cycle, seed in itertools.product(
+                arguments.cities, arguments.engines, arguments.signals, arguments.spawn_intervals,
+                arguments.light_cycles, arguments.seeds):
+            config = {
+                "city": city,
+                "city_file": city_file(city, directory),
+                "engine": engine,
+                "signals": signals,
+                "spawn_interval": spawn_interval,
+                "light_cycle_duration": light_cycle,
+                "seed": seed,
+                "steps": arguments.steps,
+                "probes": arguments.probes,
+                "workers": arguments.workers if engine == "partitioned" else None,
+                "read_frames": arguments.read_frames,
+            }
+            run = run_once(config) if arguments.in_process else run_isolated(config)
+            results["runs"].append(run)
+            print(f"{city:>14} {engine:>10} {signals:>8} spawn/{spawn_interval} cycle {light_cycle:>2} seed {seed}: "
+                  f"{run['steps_per_second']} steps/s, find_path p50 {run['find_path_p50_ms']} ms, "
+                  f"{run['delivered_per_1000_steps']} delivered/1000, {run['peak_rss_kib']} KiB")
+
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            compare(results, json.load(file))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code tests the procedural city map generator
+# 2024
+
+import os
+import sys
+
+# Make trafficBase importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+import pytest  # noqa: E402
+from trafficBase.citygen import generate_city, MAX_DEFAULT_DESTINATIONS  # noqa: E402
+from trafficBase.citymap import CityMap  # noqa: E402
+
+
+@pytest.mark.parametrize("lanes", [2, 3])
+@pytest.mark.parametrize("directions", ["alternate", "random"])
+@pytest.mark.parametrize("seed", range(6))
+def test_every_corner_reaches_every_destination(lanes, directions, seed):
+    city_map = CityMap.compile(generate_city(60, 50, lanes=lanes, directions=directions, block_jitter=2, seed=seed))
+    graph = city_map.compiled_graph
+    corners = [graph.node_id(pos) for pos in city_map.corner_positions]
+    assert city_map.destinations
+    assert np.isfinite(city_map.route_distances[:, corners]).all()
+
+
+def test_single_lane_is_rejected():
+    with pytest.raises(ValueError):
+        generate_city(60, 50, lanes=1)
+
+
+def test_default_destinations_are_capped():
+    city_map = CityMap.compile(generate_city(400, 400, block_size=4))
+    assert len(city_map.destinations) == MAX_DEFAULT_DESTINATIONS
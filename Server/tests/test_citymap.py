@@ -0,0 +1,40 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code tests the loading and caching of city map files
+# 2024
+
+import os
+import sys
+
+# Make trafficBase importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from trafficBase import citymap  # noqa: E402
+from trafficBase.citygen import write_city  # noqa: E402
+
+
+def test_relative_paths_are_not_read_from_the_working_directory(tmp_path, monkeypatch):
+    write_city(str(tmp_path / "local.txt"), 40, 40, seed=0)
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(ValueError):
+        citymap.city_path("local.txt")
+    with pytest.raises(ValueError):
+        citymap.city_path("../city_files/2024_base")
+    assert citymap.city_path(str(tmp_path / "local.txt")) == str(tmp_path / "local.txt")
+    assert citymap.city_path("2024_base") == os.path.join(citymap.CITY_FILES_DIR, "2024_base.txt")
+
+
+def test_loaded_maps_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(citymap, "_loaded_maps", type(citymap._loaded_maps)())
+    monkeypatch.setattr(citymap, "MAX_LOADED_MAPS", 2)
+    paths = []
+    for seed in range(3):
+        paths.append(str(tmp_path / f"grid{seed}.txt"))
+        write_city(paths[-1], 40, 40, seed=seed)
+    first = citymap.load_city_map(paths[0], cache_dir=None)
+    citymap.load_city_map(paths[1], cache_dir=None)
+    assert citymap.load_city_map(paths[0], cache_dir=None) is first  # Now the most recently used
+    citymap.load_city_map(paths[2], cache_dir=None)
+    assert len(citymap._loaded_maps) == 2
+    assert first.digest in citymap._loaded_maps
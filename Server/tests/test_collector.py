@@ -0,0 +1,48 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code tests the bounded-memory data collection of the city model
+# 2024
+
+import os
+import sys
+
+# Make trafficBase importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from trafficBase.collector import RingBufferSink, ColumnarFileSink, StreamingCollector  # noqa: E402
+from trafficBase.model import CityModel  # noqa: E402
+
+ROWS = [{"value": True, "label": 1}, {"value": 2, "label": 2}, {"value": 2.5, "label": "three"}, {"value": 4, "label": None}]
+
+
+def sinks(tmp_path):
+    return [RingBufferSink(capacity=3), ColumnarFileSink(str(tmp_path / "data.col"), chunk_size=2),
+            ColumnarFileSink(str(tmp_path / "rows.col"), chunk_size=10)]
+
+
+@pytest.mark.parametrize("index", range(3))
+def test_columns_are_widened_instead_of_truncated(tmp_path, index):
+    sink = sinks(tmp_path)[index]
+    for row in ROWS:
+        sink.append("table", dict(row))
+    columns = sink.columns("table")
+    kept = ROWS[-len(columns["value"]):]
+    assert columns["value"].tolist() == [float(row["value"]) for row in kept]
+    assert [str(label) for label in columns["label"].tolist()] == [str(row["label"]) for row in kept]
+    sink.close()
+
+
+def test_trips_are_only_kept_with_a_sink():
+    model = CityModel(0, seed=1)
+    for _ in range(60):
+        model.step()
+    assert model.reached_destination > 0
+    assert "Trips" not in model.datacollector.tables
+
+    model = CityModel(0, seed=1, collector=RingBufferSink(capacity=5))
+    for _ in range(60):
+        model.step()
+    assert isinstance(model.datacollector, StreamingCollector)
+    assert len(model.datacollector.get_table_dataframe("Trips")) == min(5, model.reached_destination)
+    model.close()
@@ -0,0 +1,80 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code tests that the vectorized engine follows the rules of Car.move
+# 2024
+
+import os
+import sys
+
+# Make trafficBase importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+import pytest  # noqa: E402
+from trafficBase.agent import Car  # noqa: E402
+from trafficBase.model import CityModel  # noqa: E402
+
+
+class FixedOrder:
+    """
+    Stands in for the engine's random generator: the cars act in a given order.
+    """
+
+    def __init__(self, turns):
+        self.turns = turns
+
+    def permutation(self, count):
+        return self.turns
+
+
+@pytest.mark.parametrize("seed", [5, 11])
+def test_vectorized_steps_like_agents(monkeypatch, seed):
+    # Stuck cars do not search for detours in the vectorized engine
+    monkeypatch.setattr(CityModel, "repair_route", lambda self, pos, destination: None)
+    monkeypatch.setattr(CityModel, "request_route", lambda self, car: None)
+    agents = CityModel(0, seed=seed)
+    for _ in range(10):
+        agents.step()
+    vectorized = CityModel(0, engine="vectorized", seed=seed)
+    engine = vectorized.vectorized
+
+    order = []
+    car_step = Car.step
+
+    def logged_step(car):
+        order.append(car.number)
+        car_step(car)
+
+    monkeypatch.setattr(Car, "step", logged_step)
+    moves = 0
+    for _ in range(150):
+        # Give the vectorized engine the cars and lights of the agents model
+        engine.clear()
+        for car in agents.cars.values():
+            engine.add_car(car.number, car.pos, car.destination)
+        engine.stuck[:] = [car.stuck_counter for car in agents.cars.values()]
+        vectorized.light_timer = agents.light_timer
+        for source, light in zip(agents.traffic_lights, vectorized.traffic_lights):
+            light.state = source.state
+        before = {car.number: car.pos for car in agents.cars.values()}
+
+        # One step of each, with the cars acting in the order the schedule used
+        order.clear()
+        agents.step_count += 1
+        agents.toggle_traffic_lights()
+        agents.schedule.step()
+        index = {number: i for i, number in enumerate(engine.numbers.tolist())}
+        turns = np.empty(len(index), dtype=np.int64)
+        for turn, number in enumerate(order):
+            turns[index[number]] = turn
+        engine.rng = FixedOrder(turns)
+        vectorized.toggle_traffic_lights()
+        engine.step()
+
+        expected = {car.number: car.pos for car in agents.cars.values()}
+        numbers, xs, ys = engine.car_arrays()
+        assert dict(zip(numbers.tolist(), zip(xs.tolist(), ys.tolist()))) == expected
+        assert np.array_equal(vectorized.light_requests, agents.light_requests)
+        moves += sum(expected.get(number) != pos for number, pos in before.items())
+        agents.try_spawn_car()
+    assert moves > 500  # The cars did move, the comparison is not empty
@@ -0,0 +1,56 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code tests the reads of the partitioned stepping engine
+# 2024
+
+import os
+import sys
+
+# Make trafficBase importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trafficBase.citygen import write_city  # noqa: E402
+from trafficBase.model import CityModel  # noqa: E402
+from trafficBase.vectorized import VectorizedEngine  # noqa: E402
+
+
+def test_reads_match_the_gathered_cars(tmp_path):
+    path = str(tmp_path / "grid.txt")
+    write_city(path, 120, 100, seed=3)
+    model = CityModel(150, engine="partitioned", city=path, seed=5, workers=3)
+    engine = model.vectorized
+    try:
+        for _ in range(60):
+            model.step()
+            step = model.step_count
+            reads = (engine.stuck_count(), engine.changes(step - 1), engine.changes(step - 5),
+                     [array.tolist() for array in engine.car_arrays()], engine.positions())
+            assert engine.scattered  # Reading did not bring the cars back
+            engine.gather()
+            assert reads == (VectorizedEngine.stuck_count(engine), VectorizedEngine.changes(engine, step - 1),
+                             VectorizedEngine.changes(engine, step - 5),
+                             [array.tolist() for array in VectorizedEngine.car_arrays(engine)],
+                             VectorizedEngine.positions(engine))
+        assert model.in_grid > 0
+    finally:
+        model.close()
+
+
+def test_cars_move_at_most_one_cell_per_step(tmp_path):
+    path = str(tmp_path / "grid.txt")
+    write_city(path, 120, 100, seed=3)
+    model = CityModel(0, engine="partitioned", city=path, seed=5, workers=4)
+    try:
+        previous = {}
+        for _ in range(150):
+            model.step()
+            numbers, xs, ys = model.car_arrays()
+            current = dict(zip(numbers.tolist(), zip(xs.tolist(), ys.tolist())))
+            for number, (x, y) in current.items():
+                if number in previous:
+                    old_x, old_y = previous[number]
+                    assert max(abs(x - old_x), abs(y - old_y)) <= 1, (number, previous[number], (x, y))
+            previous = current
+        assert model.running
+    finally:
+        model.close()
@@ -0,0 +1,128 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code tests the endpoints of the traffic server
+# 2024
+
+import os
+import sys
+
+# Make the server and trafficBase importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+import agents_server  # noqa: E402
+from trafficBase.sessions import SessionRegistry  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    """
+    A test client with no sessions, recording into a temporary directory.
+    """
+    registry = SessionRegistry(max_sessions=4)
+    monkeypatch.setattr(agents_server, "sessions", registry)
+    monkeypatch.setattr(agents_server, "recordings_dir", str(tmp_path))
+    yield agents_server.app.test_client()
+    for session_id in list(registry.sessions):
+        registry.remove(session_id)
+
+
+def init(client, **options):
+    response = client.post('/init', json={"NAgents": 5, "seed": 1, **options})
+    assert response.status_code == 200, response.json
+    return response
+
+
+def test_init_and_read(client):
+    assert agents_server.DEFAULT_CITY in client.get('/getCities').json['cities']
+    init(client)
+    assert client.get('/getStats').json == {'in_grid': 0, 'reached_destination': 0}
+    assert set(client.get('/getMap').json) >= {'buildings', 'roads', 'destinations'}
+
+    frame = client.get('/step').json
+    assert frame['step'] == 1 and len(frame['cars']) == client.get('/getStats').json['in_grid'] > 0
+    full = client.get('/getAgents').json
+    assert len(full['positions']) == len(frame['cars'])
+    client.get('/step')
+    delta = client.get(f"/getAgents?since={full['step']}").json
+    assert not delta['full'] and delta['step'] == 2 and delta['moved']
+    assert client.get('/step?format=binary').mimetype == "application/octet-stream"
+
+
+def test_init_rejects_bad_input(client):
+    assert client.post('/init', json={"NAgents": 1, "city": "../agents_server"}).status_code == 400
+    assert client.post('/init', json={"NAgents": 1, "session": "a/b"}).status_code == 400
+    assert client.get('/getStats?session=missing').status_code == 400
+
+
+@pytest.mark.parametrize("query", ["steps=0", "steps=x", "until=never", "until=stable&window=0",
+                                   "until=stable&window=abc", "until=stable&tolerance=-1",
+                                   "until=stable&tolerance=nan"])
+def test_update_rejects_bad_options(client, query):
+    init(client)
+    assert client.get(f'/update?{query}').status_code == 400
+
+
+def test_update_fast_forwards(client):
+    init(client)
+    body = client.get('/update?steps=20&until=stable&window=5&tolerance=0.5').json
+    assert 1 <= body['steps'] <= 20 and body['currentStep'] == body['steps']
+    assert body['stopped'] in ("steps", "condition", "finished")
+
+
+def test_checkpoint_restore_and_fork(client):
+    init(client)
+    client.get('/update?steps=10')
+    snapshot = client.get('/checkpoint').data
+    restored = client.post('/restore?session=copy', data=snapshot)
+    assert restored.status_code == 200 and restored.json['step'] == 10
+    assert client.get('/getStats?session=copy').json == client.get('/getStats').json
+    assert client.post('/restore?session=bad', data=b"garbage").status_code == 400
+
+    forked = client.post('/fork', json={"forks": {"slow": {"spawn_interval": 8}, "same": {}}})
+    assert forked.status_code == 200 and forked.json['step'] == 10
+    assert client.get('/getStats?session=slow').status_code == 200
+    assert client.post('/fork', json={"forks": {"bad": {"schedule": 1}}}).status_code == 400
+    assert client.post('/fork', json={"forks": {"bad": {"spawn_interval": 0}}}).status_code == 400
+    assert client.get('/getStats?session=bad').status_code == 400
+
+
+def test_play_and_pause(client):
+    init(client)
+    for tick_rate in ("nan", "inf", "0", "abc"):
+        assert client.post(f'/play?tick_rate={tick_rate}').status_code == 400
+    assert client.post('/play', json={"tick_rate": 50}).json == {'playing': True, 'tick_rate': 50}
+    assert client.post('/pause').json['playing'] is False
+
+
+def test_recording_and_replay(client):
+    init(client, session="rec", record=True)
+    client.get('/update?session=rec&steps=15')
+    agents_server.sessions.remove("rec")  # Finishes the file
+    recordings = client.get('/getRecordings').json['recordings']
+    assert len(recordings) == 1 and recordings[0].startswith("rec-")
+    header = client.get(f'/replay?recording={recordings[0]}').json
+    assert header['first_step'] == 0 and header['last_step'] == 15
+    frame = client.get(f'/replay?recording={recordings[0]}&step=15').json
+    assert frame['step'] == 15
+    assert client.get('/replay?recording=../x.trj').status_code == 400
+    assert client.get('/replay?recording=missing.trj').status_code == 404
+
+
+def test_metrics(client):
+    init(client)
+    client.get('/update?steps=3')
+    response = client.get('/metrics')
+    if agents_server.collect_metrics:
+        assert response.status_code == 200 and b"step" in response.data
+    else:
+        assert response.status_code == 404
+
+
+def test_worker_session(client):
+    init(client, session="w", worker=True)
+    body = client.get('/update?session=w&steps=5').json
+    assert body['steps'] == 5 and body['stopped'] == "queued"
+    assert client.get('/metrics?session=w').status_code == 409
+    assert client.get('/checkpoint?session=w').status_code == 409
+    assert client.get('/getStats?session=w').status_code == 200
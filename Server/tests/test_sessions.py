@@ -0,0 +1,82 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code tests the session registry of the server
+# 2024
+
+import os
+import sys
+
+# Make trafficBase importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from trafficBase.sessions import SessionRegistry, SessionLimitError  # noqa: E402
+
+
+class FakeModel:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_least_recently_used_session_is_evicted():
+    sessions = SessionRegistry(max_sessions=2)
+    a, b, c = FakeModel(), FakeModel(), FakeModel()
+    sessions.create("a", a)
+    sessions.create("b", b)
+    sessions.get("a")  # "b" is now the least recently used
+    sessions.create("c", c)
+    assert sessions.get("b") is None and b.closed
+    assert sessions.get("a").model is a and not a.closed
+    assert len(sessions) == 2
+
+
+def test_sessions_in_use_are_not_evicted():
+    sessions = SessionRegistry(max_sessions=2)
+    a, b = FakeModel(), FakeModel()
+    sessions.create("a", a)
+    sessions.create("b", b)
+    with sessions.get("a").lock:
+        c = FakeModel()
+        sessions.create("c", c)
+        assert sessions.get("a").model is a and b.closed
+        with sessions.get("c").lock:
+            d = FakeModel()
+            with pytest.raises(SessionLimitError):
+                sessions.create("d", d)
+            assert d.closed  # A model that could not be stored is closed
+    assert sorted(sessions.sessions) == ["a", "c"]
+
+
+def test_replacing_a_session_closes_the_old_model():
+    sessions = SessionRegistry(max_sessions=2)
+    old, new = FakeModel(), FakeModel()
+    sessions.create("a", old)
+    sessions.create("a", new)
+    assert old.closed and sessions.get("a").model is new
+
+
+def test_invalid_ids_are_rejected():
+    sessions = SessionRegistry()
+    model = FakeModel()
+    with pytest.raises(ValueError):
+        sessions.create("../a", model)
+    assert model.closed and len(sessions) == 0
+
+
+def test_idle_sessions_are_dropped():
+    sessions = SessionRegistry(max_sessions=4, idle_timeout=0)
+    old = FakeModel()
+    sessions.create("old", old)
+    sessions.create("new", FakeModel())
+    assert old.closed and sessions.get("old") is None
+
+
+def test_remove():
+    sessions = SessionRegistry()
+    model = FakeModel()
+    sessions.create("a", model)
+    assert sessions.remove("a") and model.closed
+    assert not sessions.remove("a")
@@ -0,0 +1,95 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code tests the checkpoints of the city model
+# 2024
+
+import os
+import sys
+
+# Make trafficBase importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+import pytest  # noqa: E402
+from trafficBase.citymap import CELL_OBSTACLE  # noqa: E402
+from trafficBase.model import CityModel  # noqa: E402
+from trafficBase.snapshot import ModelSnapshot  # noqa: E402
+
+
+def run_model(engine, steps=30):
+    model = CityModel(10, engine=engine, seed=3)
+    model.spawn_interval = 2
+    for _ in range(steps):
+        model.step()
+    return model
+
+
+@pytest.mark.parametrize("engine", ["agents", "vectorized"])
+def test_restored_model_continues_like_the_original(engine):
+    original = run_model(engine)
+    restored = ModelSnapshot.from_bytes(ModelSnapshot.capture(original).to_bytes()).restore()
+    assert sorted(restored.car_positions()) == sorted(original.car_positions())
+    for _ in range(40):
+        original.step()
+        restored.step()
+        assert sorted(restored.car_positions()) == sorted(original.car_positions())
+    assert (restored.step_count, restored.in_grid, restored.reached_destination) == \
+           (original.step_count, original.in_grid, original.reached_destination)
+    assert restored.reached_destination > 0
+
+
+def corrupt(data, name, change):
+    snapshot = ModelSnapshot.from_bytes(data)
+    array = snapshot.arrays[name].copy()
+    change(array)
+    snapshot.arrays[name] = array
+    return snapshot
+
+
+def set_item(index, value):
+    return lambda array: array.__setitem__(index, value)
+
+
+@pytest.mark.parametrize("name, change", [
+    ("engine_nodes", set_item(0, -1)),
+    ("engine_nodes", set_item(0, 10 ** 7)),
+    ("engine_nodes", lambda array: array.__setitem__(1, array[0])),
+    ("engine_numbers", lambda array: array.__setitem__(1, array[0])),
+    ("engine_destinations", set_item(0, -2)),
+    ("engine_next_hops", set_item(0, -5)),
+])
+def test_restore_rejects_invalid_vectorized_cars(name, change):
+    data = ModelSnapshot.capture(run_model("vectorized")).to_bytes()
+    with pytest.raises(ValueError):
+        corrupt(data, name, change).restore()
+
+
+def test_restore_rejects_invalid_agent_cars():
+    model = run_model("agents")
+    data = ModelSnapshot.capture(model).to_bytes()
+    obstacle = tuple(int(v) for v in np.argwhere(model.cell_layer == CELL_OBSTACLE)[0])
+    for name, change in [
+        ("car_positions", set_item(0, obstacle)),
+        ("car_positions", set_item(0, (-1, 3))),
+        ("car_positions", lambda array: array.__setitem__(1, array[0])),
+        ("car_numbers", lambda array: array.__setitem__(1, array[0])),
+        ("car_colors", set_item(0, 99)),
+    ]:
+        with pytest.raises(ValueError):
+            corrupt(data, name, change).restore()
+
+
+def test_restore_rejects_arrays_of_the_wrong_size():
+    snapshot = ModelSnapshot.capture(run_model("agents", steps=5))
+    snapshot.arrays["light_requests"] = snapshot.arrays["light_requests"][:-1]
+    with pytest.raises(ValueError):
+        snapshot.restore()
+
+
+def test_restore_rejects_unknown_settings():
+    snapshot = ModelSnapshot.capture(run_model("agents", steps=5))
+    snapshot.meta["scalars"]["spawn_interval"] = 0
+    with pytest.raises(ValueError):
+        snapshot.restore()
+    with pytest.raises(ValueError):
+        ModelSnapshot.from_bytes(b"not a snapshot")
@@ -0,0 +1,50 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code tests the trajectory recordings of the city model
+# 2024
+
+import os
+import random
+import sys
+
+# Make trafficBase importable when run from anywhere
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from trafficBase.model import CityModel  # noqa: E402
+from trafficBase.trajectory import TrajectoryReader  # noqa: E402
+
+
+@pytest.mark.parametrize("engine", ["agents", "vectorized"])
+def test_recording_reads_back_every_step(tmp_path, engine):
+    path = str(tmp_path / "run.trj")
+    model = CityModel(10, engine=engine, seed=7, record=path)
+    model.spawn_interval = 2
+    live = {}
+
+    def remember():
+        numbers, xs, ys = model.car_arrays()
+        live[model.step_count] = (sorted(zip(numbers.tolist(), xs.tolist(), ys.tolist())),
+                                  model.reached_destination, model.light_states().tolist())
+
+    remember()
+    for _ in range(250):  # More than two keyframe intervals
+        model.step()
+        remember()
+        if not model.running:
+            break
+    model.close()
+
+    reader = TrajectoryReader(path)
+    try:
+        assert len(reader) == len(live)
+        steps = list(live)
+        random.Random(0).shuffle(steps)  # Seeks back and forth across keyframes
+        for step in steps:
+            frame = reader.frame(step)
+            cars = sorted(zip(frame["numbers"].tolist(), frame["xs"].tolist(), frame["ys"].tolist()))
+            assert (cars, frame["reached_destination"], frame["lights"].tolist()) == live[step]
+        with pytest.raises(KeyError):
+            reader.frame(max(live) + 1)
+    finally:
+        reader.close()
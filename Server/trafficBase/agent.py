@@ -4,7 +4,6 @@
 # 2024
 
 from mesa import Agent
-import random
 
 # Define a palette of colors to randomly assign to cars for visualization
 color_palette = ["red", "blue", "green", "orange", "purple", "yellow", "pink", "cyan"]
@@ -13,66 +12,84 @@ class Car(Agent):
     """
     Car agent representing vehicles in the simulation. Each car has a destination 
     and follows a calculated path while respecting traffic rules and avoiding obstacles.
+    For many cars, the vectorized engine keeps the same state in arrays instead.
     """
 
-    def __init__(self, unique_id, model, destination):
+    def __init__(self, unique_id, model, destination, number=None, color_index=None):
         super().__init__(unique_id, model)
+        self.number = number  # Integer id stored in the model's car layer
         self.destination = destination  # The target destination for the car
-        self.current_path = None  # The path the car is currently following
-        self.path_index = 0  # Tracks the car's position along the path
         self.stuck_counter = 0  # Counter to detect if the car is stuck
+        self.detour = None  # Cells of a temporary detour around blocked cells, if any
         self.direction = None  # Current movement direction of the car
-        self.recalculate_path()  # Initial path calculation
-        self.color = random.choice(color_palette)  # Assign a random color for visualization
+        if color_index is None:
+            color_index = model.color_random.randrange(len(color_palette))  # Random color for visualization
+        self.color_index = color_index
+        self.spawn_step = model.step_count  # Step the car entered the grid, for trip times
+        self.moved_step = model.step_count  # Last step the car changed cell, for /getAgents?since=
+
+    @property
+    def color(self):
+        """
+        Name of the car's color in the palette.
+        """
+        return color_palette[self.color_index]
 
     def recalculate_path(self):
         """
-        Recalculates the shortest path to the destination using the model's pathfinding logic.
-        Resets the path index and stuck counter.
+        Searches the whole map for a route that avoids other cars and follows it
+        as a detour. Used only when no local detour exists; otherwise the route
+        comes from the model's shared next-hop table. Resets the stuck counter.
         """
-        if self.pos and self.destination:
-            self.current_path = self.model.find_path(self.pos, self.destination, avoid_traffic=True)
-            self.path_index = 0
-            self.stuck_counter = 0
+        path = self.model.find_path(self.pos, self.destination, avoid_traffic=True)
+        self.detour = path[1:] if path and len(path) > 1 else None
+        self.stuck_counter = 0
 
-    def check_traffic_light(self, next_pos):
+    def check_traffic_light(self, next_pos, count=True):
         """
         Checks if there is a traffic light at the next position and returns its state.
         Returns True if the light is green or if no light is present, False otherwise.
+
+        Parameters:
+        - next_pos: The cell the car wants to enter.
+        - count: False to only look at the light, when the car was already
+          counted as waiting for it this step.
         """
-        next_cell_contents = self.model.grid.get_cell_list_contents([next_pos])
-        for agent in next_cell_contents:
-            if isinstance(agent, Traffic_Light):
-                return agent.state
-        return True  # No traffic light means no restriction
+        if next_pos is None:
+            return True
+        light = self.model.light_layer[next_pos]
+        if light < 0:
+            return True  # No traffic light means no restriction
+        if count:
+            self.model.light_requests[light] += 1  # Queue count for the signal controller
+        return self.model.traffic_lights[light].state
 
     def check_for_obstacles(self, next_pos):
         """
         Checks if the next position is blocked by another car or an obstacle.
         Returns True if the position is clear, False otherwise.
         """
-        next_cell_contents = self.model.grid.get_cell_list_contents([next_pos])
-        for agent in next_cell_contents:
-            if isinstance(agent, (Obstacle, Car)):  # Blocked by an obstacle or another car
-                return False
-        return True
+        # Blocked by an obstacle or another car
+        return not self.model.obstacle_layer[next_pos] and self.model.car_layer[next_pos] < 0
 
     def get_next_position(self):
         """
-        Retrieves the next position in the car's path.
-        Returns None if the path is incomplete or the car is at its destination.
+        Retrieves the next position on the route to the destination.
+        Returns None if there is no route or the car is at its destination.
         """
-        if not self.current_path or self.path_index >= len(self.current_path) - 1:
+        if self.pos is None or self.pos == self.destination:
             return None
-        return self.current_path[self.path_index + 1]
+        if self.detour:
+            return self.detour[0]
+        return self.model.next_hop(self.pos, self.destination)
 
     def near_corner(self):
         """
         Checks if the car is near a corner cell and trying to move into it.
         Returns True if the car is near a corner and another car is blocking the corner.
         """
+        next_pos = self.get_next_position()
         for corner in self.model.corner_positions:
-            next_pos = self.get_next_position()
             if next_pos == corner:
                 if self.check_for_obstacles(next_pos):
                     continue  # Corner is clear
@@ -82,18 +99,20 @@ class Car(Agent):
 
     def move(self):
         """
-        Moves the car along its path, handling traffic lights, obstacles, and alternative routes.
-        Recalculates the path if stuck for too long or avoids blocked cells when possible.
+        Moves the car along its route, handling traffic lights, obstacles, and alternative routes.
+        When blocked it tries a short detour that rejoins the route, then a sidestep,
+        and searches the whole map only if stuck for too long.
         """
         if self.near_corner():
             return  # Yield movement to avoid congestion near corners
 
         if self.pos == self.destination:
             # If the car reaches its destination, remove it from the grid and schedule
-            self.model.grid.remove_agent(self)
+            self.model.remove_car(self)
             self.model.schedule.remove(self)
             self.model.in_grid -= 1
             self.model.reached_destination += 1
+            self.model.record_trip(self.number, self.spawn_step)
             return
 
         next_pos = self.get_next_position()
@@ -104,82 +123,72 @@ class Car(Agent):
 
         if not next_pos or not self.check_for_obstacles(next_pos):
             self.stuck_counter += 1
-            # Explore alternative cells if stuck
-            neighborhood = self.model.grid.get_neighborhood(self.pos, moore=False, include_center=False)
-            if self.stuck_counter == 1:
-                current_cell_contents = self.model.grid.get_cell_list_contents([self.pos])
-                current_cell_type = None
-
-                # Identify the current cell's type
-                for agent in current_cell_contents:
-                    if isinstance(agent, Road):
-                        current_cell_type = agent.direction
-
-                for neighbor in neighborhood:
-                    if not self.model.grid.out_of_bounds(neighbor):
-                        neighbor_cell_contents = self.model.grid.get_cell_list_contents([neighbor])
-                        neighbor_cell_type = None
-
-                        # Check the neighbor cell's type
-                        for agent in neighbor_cell_contents:
-                            if isinstance(agent, Road):
-                                neighbor_cell_type = agent.direction
-
-                        # Attempt to move into a valid neighbor cell
-                        if (current_cell_type and neighbor_cell_type and
-                            self.model.valid_movement(current_cell_type, neighbor_cell_type,
-                                                        neighbor[0] - self.pos[0], neighbor[1] - self.pos[1])):
-                            if all(not isinstance(agent, (Car, Obstacle)) for agent in neighbor_cell_contents):
-                                dx = neighbor[0] - self.pos[0]
-                                dy = neighbor[1] - self.pos[1]
-                                self.direction = (dx, dy)
-                                self.model.grid.move_agent(self, neighbor)
-                                self.stuck_counter = 0
-                                self.recalculate_path()
-                                return
-            if self.stuck_counter == 3:  # Recalculate path if stuck for too long
-                self.recalculate_path()
-                self.stuck_counter = 0
-            else:
+            self.detour = None  # The way ahead is blocked, drop any old detour
+
+            # Look for a short detour that rejoins the route a few cells ahead
+            detour = self.model.repair_route(self.pos, self.destination)
+            if detour is not None:
+                self.detour = detour[1:]
+                # Count the detour's light unless the car already asked for it at next_pos
+                light_layer = self.model.light_layer
+                counted = next_pos is not None and light_layer[self.detour[0]] == light_layer[next_pos]
+                if self.check_traffic_light(self.detour[0], count=not counted):
+                    self.advance(self.detour[0])
                 return
+
+            # Otherwise step aside into the free neighbor cell closest to the destination
+            sidestep = self.model.sidestep(self.pos, self.destination)
+            if sidestep is not None:
+                self.advance(sidestep)
+                return
+
+            if self.stuck_counter == 3:  # Ask for a route over the whole map if stuck for too long
+                self.model.request_route(self)
         else:
-            # Move to the next position
-            dx = next_pos[0] - self.pos[0]
-            dy = next_pos[1] - self.pos[1]
-            self.direction = (dx, dy)
-            self.model.grid.move_agent(self, next_pos)
-            self.path_index += 1
-            self.stuck_counter = 0
+            self.advance(next_pos)
+
+    def advance(self, next_pos):
+        """
+        Moves the car one cell, consuming its detour if it is following one.
+        """
+        dx = next_pos[0] - self.pos[0]
+        dy = next_pos[1] - self.pos[1]
+        self.direction = (dx, dy)
+        self.model.move_car(self, next_pos)
+        if self.detour and self.detour[0] == next_pos:
+            self.detour.pop(0)
+            if not self.detour:
+                self.detour = None  # Back on the shared route
+        self.stuck_counter = 0
 
     def step(self):
         """
         Executes the car's logic for a single simulation step.
-        Recalculates its path if no valid path exists, then moves along the path.
+        Waits if the destination cannot be reached from the current cell, then moves along the route.
         """
-        if not self.current_path:
-            self.recalculate_path()
-            if not self.current_path:
-                return
+        if self.pos != self.destination and self.get_next_position() is None:
+            return
         self.move()
 
 
-class Traffic_Light(Agent):
+class Traffic_Light:
     """
-    Traffic light agent, controlled by the model to toggle states.
+    Traffic light, controlled by the model to toggle states. Lights have no
+    behavior of their own, so they are plain slotted objects instead of agents.
     """
-    def __init__(self, unique_id, model, is_horizontal=False):
-        super().__init__(unique_id, model)
+    __slots__ = ("unique_id", "pos", "state", "is_horizontal")
+
+    def __init__(self, unique_id, pos, is_horizontal=False):
+        self.unique_id = unique_id
+        self.pos = pos
         self.state = False  # Default state: red
         self.is_horizontal = is_horizontal  # True for horizontal traffic lights, False for vertical
-        self.facing_directions = []  # Unused, can represent the directions the light controls
-
-    def step(self):
-        pass  # Traffic lights are controlled by the CityModel
 
 
 class Road(Agent):
     """
     Road agent defining the direction of traffic.
+    Kept for compatibility; the model stores roads in its direction_layer.
     """
     def __init__(self, unique_id, model, direction):
         super().__init__(unique_id, model)
@@ -192,6 +201,7 @@ class Road(Agent):
 class Obstacle(Agent):
     """
     Obstacle agent representing a blocking element in the grid.
+    Kept for compatibility; the model stores obstacles in its obstacle_layer.
     """
     def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
@@ -203,6 +213,7 @@ class Obstacle(Agent):
 class Destination(Agent):
     """
     Destination agent representing the target endpoint for cars.
+    Kept for compatibility; the model stores destinations in its cell_layer.
     """
     def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
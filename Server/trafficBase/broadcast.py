@@ -0,0 +1,132 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the server-driven stepping of a session and its live viewers
+# 2024
+
+import json
+import math
+import queue
+import threading
+import time
+
+
+def check_tick_rate(tick_rate):
+    """
+    Raises ValueError unless tick_rate is a finite number of steps per
+    second above 0 (NaN or inf would stall or spin a stepping loop).
+    """
+    if isinstance(tick_rate, bool) or not isinstance(tick_rate, (int, float)) \
+            or not (math.isfinite(tick_rate) and tick_rate > 0):
+        raise ValueError(f"tick_rate must be a positive number, got {tick_rate!r}")
+
+
+class Ticker:
+    """
+    Steps the model of a session on a background thread at a fixed tick
+    rate and pushes every new state to all subscribed viewers. Each state is
+    encoded once as a Server-Sent Events message and shared by every viewer.
+    Viewers get a small queue each; a viewer that falls behind loses its
+    oldest frames instead of slowing the simulation down.
+    """
+
+    def __init__(self, session, frame, tick_rate=10, backlog=4):
+        """
+        Parameters:
+        - session: The Session to step (its lock is held while stepping).
+        - frame: Function of the model returning the JSON-serializable state to push.
+        - tick_rate: Steps per second.
+        - backlog: Frames kept for a viewer that has not read them yet.
+        """
+        check_tick_rate(tick_rate)
+        self.session = session
+        self.frame = frame
+        self.tick_rate = tick_rate
+        self.backlog = backlog
+        self.subscribers = set()  # One queue per viewer
+        self.lock = threading.Lock()  # Guards subscribers and the thread
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def playing(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def subscribe(self):
+        """
+        Returns a new viewer queue. It receives SSE messages, and None once the ticker is closed.
+        """
+        viewer = queue.Queue(maxsize=self.backlog)
+        with self.lock:
+            self.subscribers.add(viewer)
+        return viewer
+
+    def unsubscribe(self, viewer):
+        with self.lock:
+            self.subscribers.discard(viewer)
+
+    def publish(self, message):
+        """
+        Sends a message to every viewer, dropping the oldest frame of full queues.
+        """
+        with self.lock:
+            viewers = list(self.subscribers)
+        for viewer in viewers:
+            while True:
+                try:
+                    viewer.put_nowait(message)
+                    break
+                except queue.Full:
+                    try:
+                        viewer.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def start(self, tick_rate=None):
+        """
+        Starts stepping (or changes the tick rate if already playing).
+        """
+        if tick_rate is not None:
+            check_tick_rate(tick_rate)
+            self.tick_rate = tick_rate
+        with self.lock:
+            if self.playing:
+                return
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name=f"ticker-{self.session.session_id}", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stops stepping. Viewers stay subscribed.
+        """
+        self.stopping.set()
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def close(self):
+        """
+        Stops stepping and disconnects every viewer.
+        """
+        self.stop()
+        self.publish(None)
+        with self.lock:
+            self.subscribers.clear()
+
+    def run(self):
+        session = self.session
+        next_tick = time.monotonic()
+        while not self.stopping.is_set():
+            with session.lock:
+                model = session.model
+                model.step()
+                session.current_step += 1
+                state = self.frame(model)
+                running = model.running
+            self.publish(f"id: {state['step']}\nevent: frame\ndata: {json.dumps(state, separators=(',', ':'))}\n\n")
+            if not running:
+                break
+
+            # Fixed rate: wait for the next tick, without bursts to catch up after a slow step
+            next_tick = max(next_tick + 1 / self.tick_rate, time.monotonic())
+            self.stopping.wait(next_tick - time.monotonic())
@@ -0,0 +1,153 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the generation of large procedural city maps
+# 2024
+
+import argparse
+import numpy as np
+from .citymap import ARROW_ORIENTATIONS, get_allowed_moves
+
+DIRECTION_LAYOUTS = ("alternate", "random")
+
+# Most destinations given by default: every destination adds a next-hop and a
+# distance table over all road cells (about 12 bytes per cell)
+MAX_DEFAULT_DESTINATIONS = 32
+
+
+def street_starts(start, stop, block_size, lanes, block_jitter, rng):
+    """
+    Returns the first coordinate of every street between start and stop, with
+    a block (block_size +- block_jitter cells) before each street and at least
+    block_size cells left after the last one.
+    """
+    starts = []
+    position = start
+    while True:
+        position += max(1, block_size + int(rng.integers(-block_jitter, block_jitter + 1)))
+        if position + lanes + block_size > stop:
+            return starts
+        starts.append(position)
+        position += lanes
+
+
+def generate_city(width, height, block_size=6, lanes=2, signal_density=0.5, destinations=None,
+                  directions="alternate", block_jitter=0, seed=0):
+    """
+    Generates a city map in the format of static/city_files: a counterclockwise
+    ring road, a grid of one-way streets with `lanes` lanes each and blocks of
+    buildings in between, traffic lights before some crossings and destinations
+    on the edge of the blocks. The same parameters and seed always give the same map.
+
+    Parameters:
+    - width, height: Size of the map in cells.
+    - block_size: Side of a block of buildings between two streets.
+    - lanes: Number of lanes of every street and of the ring road (at least
+      2: with a single lane the ring can only be crossed at the spawn corners,
+      which routes never go through, so some destinations become unreachable).
+    - signal_density: Fraction of street crossings with traffic lights (0 to 1).
+    - destinations: Number of destination cells (default one for every two
+      blocks, at most MAX_DEFAULT_DESTINATIONS).
+      The model keeps a routing table per destination over all road cells,
+      so keep it low on very large maps.
+    - directions: "alternate" for streets in alternating directions, "random" for random ones.
+    - block_jitter: Blocks get block_size +- block_jitter cells (at least 1).
+    - seed: Seed of the random generator.
+
+    Returns the map as text, one line per row from the top.
+    """
+    if directions not in DIRECTION_LAYOUTS:
+        raise ValueError(f"Unknown direction layout {directions!r}, expected one of {DIRECTION_LAYOUTS}")
+    if lanes < 2:
+        raise ValueError("lanes must be at least 2")
+    if block_size < 1:
+        raise ValueError("block_size must be at least 1")
+    if min(width, height) < 2 * lanes + block_size:
+        raise ValueError(f"The map must be at least {2 * lanes + block_size} cells wide and high")
+
+    rng = np.random.default_rng(seed)
+    cells = np.full((width, height), '#', dtype='<U1')  # Indexed by [x, y]
+
+    # Ring road, flowing counterclockwise; each corner takes the direction it turns into
+    cells[:, :lanes] = '>'  # Bottom
+    cells[:, height - lanes:] = '<'  # Top
+    cells[:lanes, lanes:] = 'v'  # Left
+    cells[width - lanes:, :height - lanes] = '^'  # Right
+
+    column_starts = street_starts(lanes, width - lanes, block_size, lanes, block_jitter, rng)
+    row_starts = street_starts(lanes, height - lanes, block_size, lanes, block_jitter, rng)
+
+    def pick_direction(index, first, second):
+        if directions == "alternate":
+            return first if index % 2 == 0 else second
+        return first if rng.random() < 0.5 else second
+
+    # Vertical streets, then horizontal ones (crossings keep the horizontal arrows)
+    column_directions = [pick_direction(i, 'v', '^') for i in range(len(column_starts))]
+    row_directions = [pick_direction(i, '<', '>') for i in range(len(row_starts))]
+    for x, arrow in zip(column_starts, column_directions):
+        cells[x:x + lanes, lanes:height - lanes] = arrow
+    for y, arrow in zip(row_starts, row_directions):
+        cells[lanes:width - lanes, y:y + lanes] = arrow
+
+    # Traffic lights on every lane entering a crossing: "s" for the horizontal
+    # street and "S" for the vertical one, right before the crossing
+    for x, column_arrow in zip(column_starts, column_directions):
+        for y, row_arrow in zip(row_starts, row_directions):
+            if rng.random() >= signal_density:
+                continue
+            before_x = x + lanes if row_arrow == '<' else x - 1
+            before_y = y + lanes if column_arrow == 'v' else y - 1
+            cells[before_x, y:y + lanes] = 's'
+            cells[x:x + lanes, before_y] = 'S'
+
+    # Destinations go on block cells a road lane can turn into (not from a spawn corner)
+    corners = np.zeros((width, height), dtype=bool)
+    corners[[0, 0, width - 1, width - 1], [0, height - 1, 0, height - 1]] = True
+    candidates = np.zeros((width, height), dtype=bool)
+    for dx, dy in [(1, 0), (-1, 0), (0, 1), (0, -1)]:
+        # Roads whose allowed moves include (dx, dy)
+        arrows = [arrow for arrow in ARROW_ORIENTATIONS if (dx, dy) in get_allowed_moves(arrow)]
+        from_road = np.isin(cells, arrows) & ~corners
+        shifted = np.zeros((width, height), dtype=bool)
+        shifted[max(dx, 0):width + min(dx, 0), max(dy, 0):height + min(dy, 0)] = \
+            from_road[max(-dx, 0):width + min(-dx, 0), max(-dy, 0):height + min(-dy, 0)]
+        candidates |= shifted
+    candidates &= cells == '#'
+
+    candidate_cells = np.argwhere(candidates)
+    if destinations is None:
+        destinations = min(max(1, (len(column_starts) + 1) * (len(row_starts) + 1) // 2), MAX_DEFAULT_DESTINATIONS)
+    destinations = min(destinations, len(candidate_cells))
+    for x, y in candidate_cells[rng.choice(len(candidate_cells), destinations, replace=False)]:
+        cells[x, y] = 'D'
+
+    # Rows of the file go from the top (highest y) down
+    return "".join("".join(cells[:, y]) + "\n" for y in range(height - 1, -1, -1))
+
+
+def write_city(path, width, height, **options):
+    """
+    Generates a city (see generate_city) and writes it to path.
+    """
+    with open(path, 'w') as file:
+        file.write(generate_city(width, height, **options))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a procedural city map file.")
+    parser.add_argument("path", help="Where to write the map (e.g. static/city_files/200_grid.txt)")
+    parser.add_argument("--width", type=int, default=200)
+    parser.add_argument("--height", type=int, default=200)
+    parser.add_argument("--block-size", type=int, default=6)
+    parser.add_argument("--lanes", type=int, default=2)
+    parser.add_argument("--signal-density", type=float, default=0.5)
+    parser.add_argument("--destinations", type=int, default=None)
+    parser.add_argument("--directions", choices=DIRECTION_LAYOUTS, default="alternate")
+    parser.add_argument("--block-jitter", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    write_city(arguments.path, arguments.width, arguments.height, block_size=arguments.block_size,
+               lanes=arguments.lanes, signal_density=arguments.signal_density,
+               destinations=arguments.destinations, directions=arguments.directions,
+               block_jitter=arguments.block_jitter, seed=arguments.seed)
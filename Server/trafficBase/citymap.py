@@ -0,0 +1,392 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the compilation and caching of city map files
+# 2024
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import networkx as nx  # Only needed when a map is compiled, not when it is loaded from cache
+from .graph import CompiledGraph
+
+# Map files live next to the server, whatever the working directory is
+CITY_FILES_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "static", "city_files"))
+CACHE_DIR = os.path.join(CITY_FILES_DIR, ".cache")
+DEFAULT_CITY = "2024_base"
+
+# Bump when the compiled format or the routing rules change, so old cache files are ignored
+COMPILER_VERSION = 1
+
+# Cell type codes used in the map layers
+CELL_EMPTY = 0
+CELL_ROAD = 1
+CELL_LIGHT = 2
+CELL_OBSTACLE = 3
+CELL_DESTINATION = 4
+
+# Arrow orientations for navigation
+ARROW_ORIENTATIONS = {
+    '>': (1, 0),    # Right
+    '<': (-1, 0),   # Left
+    '^': (0, 1),    # Up
+    'v': (0, -1),   # Down
+}
+
+# Compiled maps already loaded by this process, by content hash, least
+# recently used first. Only the last MAX_LOADED_MAPS are kept
+MAX_LOADED_MAPS = 8
+_loaded_maps = OrderedDict()
+_loaded_maps_lock = threading.Lock()  # Request threads load maps concurrently
+
+
+def available_cities():
+    """
+    Returns the names of the map files in the city files folder.
+    """
+    return sorted(name[:-4] for name in os.listdir(CITY_FILES_DIR) if name.endswith(".txt"))
+
+
+def check_city_name(city):
+    """
+    Raises ValueError unless city is the name of a map in the city files
+    folder. Use it on names from clients: CityModel also accepts any path.
+    """
+    if not isinstance(city, str) or city.removesuffix(".txt") not in available_cities():
+        raise ValueError(f"Unknown city {city!r}, expected one of {available_cities()}")
+
+
+def city_path(city):
+    """
+    Returns the path of a map file. city is either the name of a file in the
+    city files folder (with or without ".txt") or the absolute path of a
+    custom map. Relative paths are never looked up in the working directory.
+    """
+    if os.path.isabs(city):
+        if not os.path.isfile(city):
+            raise ValueError(f"No map file at {city!r}")
+        return city
+    name = city if city.endswith(".txt") else city + ".txt"
+    path = os.path.join(CITY_FILES_DIR, name)
+    if os.path.basename(name) != name or not os.path.isfile(path):
+        raise ValueError(f"Unknown city {city!r}, expected an absolute path or one of {available_cities()}")
+    return path
+
+
+def load_city_map(city=DEFAULT_CITY, cache_dir=CACHE_DIR):
+    """
+    Returns the compiled CityMap of a map file. Maps are keyed by the hash of
+    their content: a map already loaded by this process is reused as is, and
+    one compiled before is read back from cache_dir (None disables the disk cache).
+    """
+    with open(city_path(city), 'rb') as file:
+        content = file.read()
+    digest = hashlib.sha256(content + f"v{COMPILER_VERSION}".encode()).hexdigest()
+
+    with _loaded_maps_lock:
+        if digest in _loaded_maps:
+            _loaded_maps.move_to_end(digest)
+            return _loaded_maps[digest]
+
+    city_map = None
+    cache_file = os.path.join(cache_dir, digest + ".npz") if cache_dir is not None else None
+    if cache_file is not None and os.path.isfile(cache_file):
+        try:
+            city_map = CityMap.load(cache_file)
+        except (OSError, ValueError, KeyError):
+            city_map = None  # Unreadable cache file, compile again
+    if city_map is None:
+        city_map = CityMap.compile(content.decode())
+        if cache_file is not None:
+            try:
+                city_map.save(cache_file)
+            except OSError:
+                pass  # Read-only install, keep the map in memory only
+
+    city_map.digest = digest
+    with _loaded_maps_lock:
+        _loaded_maps[digest] = city_map
+        while len(_loaded_maps) > MAX_LOADED_MAPS:
+            _loaded_maps.popitem(last=False)
+    return city_map
+
+
+def lateral_moves(direction):
+    """
+    Returns the lateral movement directions based on the forward direction.
+    """
+    if direction == (1, 0):  # Right
+        return [(0, 1), (0, -1)]  # Up and Down
+    elif direction == (-1, 0):  # Left
+        return [(0, -1), (0, 1)]  # Down and Up
+    elif direction == (0, 1):  # Up
+        return [(-1, 0), (1, 0)]  # Left and Right
+    elif direction == (0, -1):  # Down
+        return [(1, 0), (-1, 0)]  # Right and Left
+    else:
+        return []
+
+
+def get_allowed_moves(cell_type):
+    """
+    Returns the list of allowed movement directions based on the cell type.
+    """
+    if cell_type in ARROW_ORIENTATIONS:
+        forward = ARROW_ORIENTATIONS[cell_type]
+        return [forward] + lateral_moves(forward)
+    elif cell_type == 's':
+        return [(-1, 0), (1, 0)]  # Horizontal traffic light (left, right)
+    elif cell_type == 'S':
+        return [(0, -1), (0, 1)]  # Vertical traffic light (up, down)
+    elif cell_type == 'D':
+        return []  # Destination cells allow no outgoing movement
+    else:
+        return []
+
+
+def valid_movement(current_cell_type, next_cell_type, dx, dy):
+    """
+    Determines if movement between two cells is valid based on rules:
+    - Movement allowed by current cell type.
+    - No U-turns or contrary movement.
+    """
+    if next_cell_type == '#':  # Obstacles are impassable
+        return False
+
+    # Check allowed moves for current cell type
+    if (dx, dy) not in get_allowed_moves(current_cell_type):
+        return False
+
+    # Prevent movement into a contrary arrow
+    current_orientation = ARROW_ORIENTATIONS.get(current_cell_type)
+    next_orientation = ARROW_ORIENTATIONS.get(next_cell_type)
+    if next_orientation:
+        if current_orientation and (current_orientation[0] == -next_orientation[0] and current_orientation[1] == -next_orientation[1]):
+            return False
+
+    # Prevent U-turns
+    if current_orientation == (-dx, -dy):
+        return False
+
+    if next_cell_type in ["s", "S"]:
+        if current_orientation:
+            right_turn_direction = (current_orientation[1], -current_orientation[0])  # Rotate forward direction 90° clockwise
+            if (dx, dy) == right_turn_direction:
+                return False
+
+    return True
+
+
+def create_city_graph(cell_types):
+    """
+    Creates a directed graph representing the city layout.
+
+    Parameters:
+    - cell_types: Dictionary from (x, y) to the map character of the cell.
+    """
+    city_graph = nx.DiGraph()
+
+    # Add all valid cells to the graph as nodes
+    for pos, cell in cell_types.items():
+        if cell != '#':  # Skip obstacles
+            city_graph.add_node(pos)
+
+    # Add edges based on movement rules
+    for pos, cell in cell_types.items():
+        if cell == '#' or cell == 'D':  # Skip obstacles and destinations
+            continue
+        for dx, dy in get_allowed_moves(cell):
+            next_pos = (pos[0] + dx, pos[1] + dy)
+            if next_pos in cell_types and valid_movement(cell, cell_types[next_pos], dx, dy):
+                city_graph.add_edge(pos, next_pos)
+
+    return city_graph
+
+
+class CityMap:
+    """
+    Everything that only depends on the map file: the static layers, the
+    traffic light and destination cells, the compiled navigation graph and the
+    per-destination routing tables. A CityMap is shared by every model built
+    from the same map, so its arrays are read-only.
+    """
+
+    # Arrays written to and read from the cache file
+    ARRAYS = ("cell_layer", "direction_layer", "light_layer", "obstacle_layer", "light_cells",
+              "light_horizontal", "destination_cells", "node_positions", "edges",
+              "corner_penalty", "node_costs", "routing_tables", "route_distances")
+
+    def __init__(self, arrays):
+        """
+        Parameters:
+        - arrays: Dictionary with one array for every name in ARRAYS.
+        """
+        for name in self.ARRAYS:
+            array = np.array(arrays[name])
+            array.flags.writeable = False
+            setattr(self, name, array)
+
+        self.digest = None  # Content hash, set by load_city_map
+        self.width, self.height = self.cell_layer.shape
+        self.destinations = [tuple(pos) for pos in self.destination_cells.tolist()]
+        self.lights = [(tuple(pos), horizontal) for pos, horizontal
+                       in zip(self.light_cells.tolist(), self.light_horizontal.tolist())]
+        self.intersections = self.group_lights()
+        self.corner_positions = [
+            (0, 0),                          # Bottom-left corner
+            (0, self.height - 1),            # Top-left corner
+            (self.width - 1, 0),             # Bottom-right corner
+            (self.width - 1, self.height - 1)  # Top-right corner
+        ]
+        self.compiled_graph = CompiledGraph(
+            [tuple(pos) for pos in self.node_positions.tolist()], self.edges.tolist(),
+            self.width, self.height, self.corner_positions, self.destinations
+        )
+        self.destination_index = {pos: i for i, pos in enumerate(self.destinations)}
+
+    def group_lights(self):
+        """
+        Groups the traffic lights into intersections: lights that touch each
+        other (Moore neighborhood) control the same crossing.
+        Returns a list of intersections, each a list of light indices.
+        """
+        index = {pos: i for i, (pos, _) in enumerate(self.lights)}
+        parent = list(range(len(self.lights)))
+
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for (x, y), i in index.items():
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    j = index.get((x + dx, y + dy))
+                    if j is not None:
+                        parent[root(j)] = root(i)
+
+        groups = {}
+        for i in range(len(self.lights)):
+            groups.setdefault(root(i), []).append(i)
+        return list(groups.values())
+
+    @classmethod
+    def compile(cls, text):
+        """
+        Parses the text of a map file and builds its layers, graph and routing tables.
+        """
+        lines = text.splitlines(keepends=True)
+        width = len(lines[0].strip())  # Grid width
+        height = len(lines)  # Grid height
+
+        # Static map layers, indexed by [x, y]
+        cell_layer = np.full((width, height), CELL_EMPTY, dtype=np.int8)  # Cell type code
+        direction_layer = np.zeros((width, height, 2), dtype=np.int8)  # Road (dx, dy)
+        light_layer = np.full((width, height), -1, dtype=np.int32)  # Index in the light list
+        obstacle_layer = np.zeros((width, height), dtype=bool)  # Impassable cells
+        light_cells, light_horizontal, destination_cells = [], [], []
+
+        for r, row in enumerate(lines):
+            for c, col in enumerate(row.strip('\n')):
+                pos = (c, height - r - 1)  # Align Y-axis correctly
+                if col in ARROW_ORIENTATIONS:
+                    # Road cell with its direction
+                    cell_layer[pos] = CELL_ROAD
+                    direction_layer[pos] = ARROW_ORIENTATIONS[col]
+                elif col in ["S", "s"]:
+                    # Traffic light, "s" ones are horizontal
+                    cell_layer[pos] = CELL_LIGHT
+                    light_layer[pos] = len(light_cells)
+                    light_cells.append(pos)
+                    light_horizontal.append(col == "s")
+                elif col == "#":
+                    cell_layer[pos] = CELL_OBSTACLE
+                    obstacle_layer[pos] = True
+                elif col == "D":
+                    cell_layer[pos] = CELL_DESTINATION
+                    destination_cells.append(pos)
+
+        # Map characters by cell for the movement rules
+        cell_types = {}
+        for y, line in enumerate(lines):
+            for x, cell in enumerate(line.strip()):
+                cell_types[(x, height - y - 1)] = cell
+
+        navigation_graph = create_city_graph(cell_types)
+        positions = sorted(navigation_graph.nodes)
+        index = {pos: node for node, pos in enumerate(positions)}
+        edges = [(index[u], index[v]) for u, v in navigation_graph.edges]
+
+        arrays = {
+            "cell_layer": cell_layer,
+            "direction_layer": direction_layer,
+            "light_layer": light_layer,
+            "obstacle_layer": obstacle_layer,
+            "light_cells": np.array(light_cells, dtype=np.int32).reshape(-1, 2),
+            "light_horizontal": np.array(light_horizontal, dtype=bool),
+            "destination_cells": np.array(destination_cells, dtype=np.int32).reshape(-1, 2),
+            "node_positions": np.array(positions, dtype=np.int32).reshape(-1, 2),
+            "edges": np.array(edges, dtype=np.int32).reshape(-1, 2),
+        }
+
+        # Routing data is filled in once the graph is compiled
+        for name in ("corner_penalty", "node_costs", "routing_tables", "route_distances"):
+            arrays[name] = np.empty(0)
+        city_map = cls(arrays)
+        city_map.build_routing_tables()
+        return city_map
+
+    def build_corner_penalty(self):
+        """
+        Builds an array with the routing penalty of every cell: 30 for every
+        corner the cell is next to (Moore neighborhood, corner itself excluded).
+        """
+        penalty = np.zeros((self.width, self.height), dtype=np.int32)
+        for x, y in self.corner_positions:
+            penalty[max(x - 1, 0):x + 2, max(y - 1, 0):y + 2] += 30
+            penalty[x, y] -= 30  # A corner is not its own neighbor
+        return penalty
+
+    def build_routing_tables(self):
+        """
+        Precomputes one next-hop table per destination so cars can follow a
+        shared route instead of running their own search. Both tables are
+        arrays indexed by [destination index, node id].
+        """
+        graph = self.compiled_graph
+        corner_penalty = self.build_corner_penalty()
+        node_costs = 1.0 + corner_penalty[self.node_positions[:, 0], self.node_positions[:, 1]]
+        routing_tables = np.full((len(self.destinations), graph.node_count), -1, dtype=np.int32)
+        route_distances = np.full((len(self.destinations), graph.node_count), np.inf)
+
+        costs = node_costs.tolist()
+        for i, destination in enumerate(self.destinations):
+            next_hop, distances = graph.reverse_tree(graph.node_id(destination), costs)
+            routing_tables[i] = next_hop  # Next node to take
+            route_distances[i] = distances  # Remaining route cost
+
+        for name, array in (("corner_penalty", corner_penalty), ("node_costs", node_costs),
+                            ("routing_tables", routing_tables), ("route_distances", route_distances)):
+            array.flags.writeable = False
+            setattr(self, name, array)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a compiled map saved with save.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls({name: data[name] for name in cls.ARRAYS})
+
+    def save(self, path):
+        """
+        Writes the compiled map to path (a .npz file). The file is written
+        under a temporary name first so readers never see a partial file.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as file:
+            np.savez(file, **{name: getattr(self, name) for name in self.ARRAYS})
+        os.replace(temporary, path)
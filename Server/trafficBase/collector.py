@@ -0,0 +1,251 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the bounded-memory data collection of the city model
+# 2024
+
+import os
+import numpy as np
+import pandas as pd
+
+
+def column_dtype(value):
+    """
+    NumPy dtype used to store a column whose first value is value.
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return np.bool_
+    if isinstance(value, (int, np.integer)):
+        return np.int64
+    if isinstance(value, (float, np.floating)):
+        return np.float64
+    return np.str_
+
+
+def common_dtype(*dtypes):
+    """
+    Narrowest column dtype (as returned by column_dtype) that holds values of
+    every given dtype: bool, int64 and float64 widen in that order, and any
+    string makes it a string column.
+    """
+    if any(dtype is np.str_ for dtype in dtypes):
+        return np.str_
+    return np.result_type(*dtypes).type
+
+
+class RingBufferSink:
+    """
+    Keeps only the last `capacity` rows of every table in preallocated
+    arrays, for live use: memory does not grow however long the model runs.
+    A column is widened (e.g. int64 to float64) when a value does not fit it.
+    """
+
+    def __init__(self, capacity=10000):
+        """
+        Parameters:
+        - capacity: Rows kept per table.
+        """
+        self.capacity = capacity
+        self.tables = {}  # Table name -> dict of column name -> array
+        self.rows = {}  # Table name -> rows written so far
+
+    def append(self, table, row):
+        """
+        Adds a row (dictionary of column -> value) to a table.
+        """
+        columns = self.tables.get(table)
+        if columns is None:
+            columns = {name: self.empty_column(value) for name, value in row.items()}
+            self.tables[table] = columns
+            self.rows[table] = 0
+        slot = self.rows[table] % self.capacity
+        for name, value in row.items():
+            column = columns[name]
+            if column.dtype != object and column_dtype(value) is not column.dtype.type:
+                dtype = common_dtype(column.dtype.type, column_dtype(value))
+                if dtype is not column.dtype.type:
+                    column = columns[name] = column.astype(object if dtype is np.str_ else dtype)
+            column[slot] = value
+        self.rows[table] += 1
+
+    def empty_column(self, value):
+        """
+        Preallocated array for a column whose first value is value.
+        """
+        dtype = column_dtype(value)
+        if dtype is np.str_:
+            return np.full(self.capacity, "", dtype=object)
+        return np.zeros(self.capacity, dtype=dtype)
+
+    def columns(self, table):
+        """
+        Returns the kept rows of a table as a dictionary of arrays, oldest first.
+        """
+        columns = self.tables.get(table)
+        if columns is None:
+            return {}
+        rows = self.rows[table]
+        if rows <= self.capacity:
+            return {name: array[:rows].copy() for name, array in columns.items()}
+        start = rows % self.capacity
+        return {name: np.concatenate([array[start:], array[:start]]) for name, array in columns.items()}
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ColumnarFileSink:
+    """
+    Appends rows to an append-only columnar file on disk. Rows are buffered
+    and written in chunks: for every chunk, the table and column names are
+    written with np.save followed by one np.save per column, each with a
+    dtype that fits every value of the chunk. Only the current chunk is
+    kept in memory.
+    """
+
+    def __init__(self, path, chunk_size=4096):
+        """
+        Parameters:
+        - path: File to append to (created if missing).
+        - chunk_size: Rows buffered per table before they are written.
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.buffers = {}  # Table name -> list of rows not written yet
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'ab')
+
+    def append(self, table, row):
+        """
+        Adds a row (dictionary of column -> value) to a table.
+        """
+        buffer = self.buffers.setdefault(table, [])
+        buffer.append(row)
+        if len(buffer) >= self.chunk_size:
+            self.write_chunk(table)
+
+    def write_chunk(self, table):
+        """
+        Writes the buffered rows of a table as one chunk.
+        """
+        rows = self.buffers.get(table)
+        if not rows:
+            return
+        names = list(rows[0])
+        np.save(self.file, np.array([table] + names))
+        for name in names:
+            values = [row[name] for row in rows]
+            dtype = common_dtype(*{column_dtype(value) for value in values})
+            array = np.array([str(value) for value in values]) if dtype is np.str_ else np.array(values, dtype=dtype)
+            np.save(self.file, array, allow_pickle=False)
+        self.buffers[table] = []
+
+    def flush(self):
+        """
+        Writes every buffered row to disk.
+        """
+        for table in list(self.buffers):
+            self.write_chunk(table)
+        self.file.flush()
+
+    def columns(self, table):
+        """
+        Returns every row of a table written so far as a dictionary of arrays.
+        """
+        self.flush()
+        return read_columnar_file(self.path).get(table, {})
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_columnar_file(path):
+    """
+    Reads a file written by ColumnarFileSink.
+    Returns a dictionary of table name -> dictionary of column name -> array.
+    """
+    chunks = {}
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        while file.tell() < size:
+            header = np.load(file, allow_pickle=False).tolist()
+            table, names = header[0], header[1:]
+            columns = chunks.setdefault(table, {name: [] for name in names})
+            for name in names:
+                columns[name].append(np.load(file, allow_pickle=False))
+    return {table: {name: np.concatenate(parts) for name, parts in columns.items()}
+            for table, columns in chunks.items()}
+
+
+def load_dataframes(path):
+    """
+    Loads a file written by ColumnarFileSink as one DataFrame per table.
+    """
+    return {table: pd.DataFrame(columns) for table, columns in read_columnar_file(path).items()}
+
+
+class StreamingCollector:
+    """
+    Drop-in replacement for mesa's DataCollector (model reporters and tables)
+    that sends every row to a sink instead of growing lists in memory.
+    Model rows get a "Step" column with the model's step count.
+    """
+
+    MODEL_TABLE = "model"
+
+    def __init__(self, model_reporters, tables, sink):
+        """
+        Parameters:
+        - model_reporters: Dictionary of column name -> function of the model.
+        - tables: Dictionary of table name -> list of column names.
+        - sink: Where rows go (RingBufferSink or ColumnarFileSink).
+        """
+        self.model_reporters = model_reporters
+        self.tables = tables
+        self.sink = sink
+
+    def collect(self, model):
+        row = {"Step": model.step_count}
+        for name, reporter in self.model_reporters.items():
+            row[name] = reporter(model)
+        self.sink.append(self.MODEL_TABLE, row)
+
+    def add_table_row(self, table_name, row, ignore_missing=False):
+        if table_name not in self.tables:
+            raise Exception("Table does not exist.")
+        for column in self.tables[table_name]:
+            if column not in row:
+                if not ignore_missing:
+                    raise Exception("Could not insert row with missing column")
+                row[column] = None
+        self.sink.append(table_name, {column: row[column] for column in self.tables[table_name]})
+
+    @property
+    def model_vars(self):
+        """
+        Kept model rows as a dictionary of column name -> list, like DataCollector.model_vars.
+        """
+        columns = self.sink.columns(self.MODEL_TABLE)
+        return {name: columns[name].tolist() if name in columns else [] for name in self.model_reporters}
+
+    def get_model_vars_dataframe(self):
+        columns = self.sink.columns(self.MODEL_TABLE)
+        if not columns:
+            return pd.DataFrame(columns=list(self.model_reporters))
+        return pd.DataFrame(columns).set_index("Step")
+
+    def get_table_dataframe(self, table_name):
+        if table_name not in self.tables:
+            raise Exception("No such table.")
+        columns = self.sink.columns(table_name)
+        return pd.DataFrame(columns) if columns else pd.DataFrame(columns=self.tables[table_name])
+
+    def close(self):
+        """
+        Writes out any buffered rows and releases the sink.
+        """
+        self.sink.close()
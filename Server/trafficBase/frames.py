@@ -0,0 +1,54 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the binary encoding of simulation frames for the visualization
+# 2024
+
+import numpy as np
+
+FRAME_VERSION = 1
+# Int32 fields at the start of every frame
+FRAME_HEADER = ("version", "step", "in_grid", "reached_destination", "car_count", "light_count")
+
+
+def pack_frame(model):
+    """
+    Packs the cars, light states and stats of a model into one little-endian
+    buffer that a client can read with typed array views, without copies:
+    - Int32Array(6): FRAME_HEADER values.
+    - Int32Array(car_count): car numbers (the id is "car_<number>").
+    - Int32Array(2 * car_count): x, y of every car, interleaved.
+    - Uint8Array(light_count): light states (1 for green), in /getLights order.
+    Every section starts on a 4-byte boundary.
+    """
+    numbers, xs, ys = model.car_arrays()
+    return pack_arrays(model.step_count, model.in_grid, model.reached_destination, numbers, xs, ys,
+                       model.light_states())
+
+
+def pack_arrays(step, in_grid, reached_destination, numbers, xs, ys, lights):
+    """
+    Packs a frame from its arrays (see pack_frame), e.g. for a recorded step.
+    """
+    header = np.array([FRAME_VERSION, step, in_grid, reached_destination, len(numbers), len(lights)], dtype='<i4')
+    positions = np.empty((len(numbers), 2), dtype='<i4')
+    positions[:, 0] = xs
+    positions[:, 1] = ys
+    return b"".join([header.tobytes(), np.asarray(numbers).astype('<i4').tobytes(), positions.tobytes(),
+                     np.asarray(lights).astype(np.uint8).tobytes()])
+
+
+def unpack_frame(data):
+    """
+    Reads a buffer written by pack_frame back into a dictionary of header
+    fields and "numbers", "positions" and "lights" arrays.
+    """
+    header = np.frombuffer(data, dtype='<i4', count=len(FRAME_HEADER))
+    frame = dict(zip(FRAME_HEADER, header.tolist()))
+    cars, light_count = frame["car_count"], frame["light_count"]
+    offset = header.nbytes
+    frame["numbers"] = np.frombuffer(data, dtype='<i4', count=cars, offset=offset)
+    offset += 4 * cars
+    frame["positions"] = np.frombuffer(data, dtype='<i4', count=2 * cars, offset=offset).reshape(-1, 2)
+    offset += 8 * cars
+    frame["lights"] = np.frombuffer(data, dtype=np.uint8, count=light_count, offset=offset).astype(bool)
+    return frame
@@ -0,0 +1,219 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the compiled navigation graph used for routing
+# 2024
+
+import heapq
+import numpy as np
+
+INFINITY = float('inf')
+
+
+class CompiledGraph:
+    """
+    Array representation of the city navigation graph. Nodes are integer ids,
+    edges are stored as CSR adjacency arrays (forward and reverse) and the
+    corner and destination cells are kept as node masks, so searches never
+    build subgraphs or hash tuple positions.
+    """
+
+    def __init__(self, positions, edges, width, height, corner_positions, destinations):
+        """
+        Parameters:
+        - positions: List of (x, y) cells, the index of each cell is its node id.
+        - edges: Iterable of (from_id, to_id) pairs.
+        - width, height: Size of the grid.
+        - corner_positions: Cells that can only start a route.
+        - destinations: Cells that can only end a route.
+        """
+        self.width = width
+        self.height = height
+        self.positions = list(positions)  # Node id -> (x, y)
+        self.node_count = len(self.positions)
+
+        # Grid lookup from cell to node id (-1 for cells outside the graph)
+        self.node_ids = np.full((width, height), -1, dtype=np.int32)
+        for node, (x, y) in enumerate(self.positions):
+            self.node_ids[x, y] = node
+
+        edges = np.array(sorted(edges), dtype=np.int32).reshape(-1, 2)
+        self.indptr, self.indices = self.build_csr(edges[:, 0], edges[:, 1])
+        self.reverse_indptr, self.reverse_indices = self.build_csr(edges[:, 1], edges[:, 0])
+
+        self.corner_mask = np.zeros(self.node_count, dtype=bool)
+        for pos in corner_positions:
+            if self.node_id(pos) is not None:
+                self.corner_mask[self.node_id(pos)] = True
+        self.destination_mask = np.zeros(self.node_count, dtype=bool)
+        for pos in destinations:
+            if self.node_id(pos) is not None:
+                self.destination_mask[self.node_id(pos)] = True
+        # Nodes a route may pass through (corners and destinations only start or end one)
+        self.through_mask = ~(self.corner_mask | self.destination_mask)
+
+        # Plain list copies for the heap loops, indexing lists is much faster than arrays
+        self._successors = self.adjacency_lists(self.indptr, self.indices)
+        self._predecessors = self.adjacency_lists(self.reverse_indptr, self.reverse_indices)
+        self._through = self.through_mask.tolist()
+        self._corners = self.corner_mask.tolist()
+        self._xs = [x for x, _ in self.positions]
+        self._ys = [y for _, y in self.positions]
+
+    @classmethod
+    def from_networkx(cls, graph, width, height, corner_positions, destinations):
+        """
+        Compiles a networkx DiGraph whose nodes are (x, y) cells.
+        """
+        positions = sorted(graph.nodes)
+        index = {pos: node for node, pos in enumerate(positions)}
+        edges = [(index[u], index[v]) for u, v in graph.edges]
+        return cls(positions, edges, width, height, corner_positions, destinations)
+
+    def build_csr(self, sources, targets):
+        """
+        Builds CSR (indptr, indices) arrays for the given edge lists.
+        """
+        order = np.argsort(sources, kind='stable')
+        counts = np.bincount(sources, minlength=self.node_count)
+        indptr = np.zeros(self.node_count + 1, dtype=np.int32)
+        np.cumsum(counts, out=indptr[1:])
+        return indptr, targets[order].astype(np.int32)
+
+    def adjacency_lists(self, indptr, indices):
+        """
+        Expands CSR arrays into one Python list of neighbors per node.
+        """
+        bounds = indptr.tolist()
+        flat = indices.tolist()
+        return [flat[bounds[node]:bounds[node + 1]] for node in range(self.node_count)]
+
+    def node_id(self, pos):
+        """
+        Returns the node id of a cell, or None if the cell is not in the graph.
+        """
+        x, y = pos
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        node = int(self.node_ids[x, y])
+        return node if node >= 0 else None
+
+    def successors(self, node):
+        """
+        Returns the node ids reachable in one move from node.
+        """
+        return self._successors[node]
+
+    def predecessors(self, node):
+        """
+        Returns the node ids that reach node in one move.
+        """
+        return self._predecessors[node]
+
+    def shortest_path(self, source, target, costs, blocked=None):
+        """
+        Shortest path from source to target. costs[v] is the cost of entering
+        node v, and nodes for which blocked(v) is true cost infinity. Corners
+        and destinations are only entered when they are the target.
+        Returns the list of node ids, or None if unreachable.
+        """
+        return self.astar(source, [target], costs, blocked)
+
+    def astar(self, source, targets, costs, blocked=None, max_expansions=None, allow_blocked=True):
+        """
+        A* search from source to the nearest of several targets, guided by the
+        Manhattan distance to the closest target. Every move costs at least 1
+        and changes the Manhattan distance by exactly 1, so the heuristic never
+        overestimates.
+
+        Parameters:
+        - source: Node id to start from.
+        - targets: Node ids that end the search (the route may stop at any of them).
+        - costs: costs[v] is the cost of entering node v.
+        - blocked: Optional function telling if a node is taken; taken nodes cost infinity.
+        - max_expansions: Give up after expanding this many nodes (None for no limit).
+        - allow_blocked: If False, taken nodes are never entered.
+
+        Returns the list of node ids from source to the reached target, or None.
+        """
+        through = self._through
+        successors = self._successors
+        xs, ys = self._xs, self._ys
+        goals = set(targets)
+        goal_cells = [(xs[node], ys[node]) for node in goals]
+        if not goal_cells:
+            return None
+
+        def heuristic(node):
+            x, y = xs[node], ys[node]
+            return min(abs(x - gx) + abs(y - gy) for gx, gy in goal_cells)
+
+        distances = {source: 0}
+        previous = {}
+        queue = [(heuristic(source), 0, source)]
+        expansions = 0
+
+        while queue:
+            _, distance, node = heapq.heappop(queue)
+            if node in goals:
+                path = [node]
+                while node != source:
+                    node = previous[node]
+                    path.append(node)
+                path.reverse()
+                return path
+            if distance > distances[node]:
+                continue  # Outdated queue entry
+
+            expansions += 1
+            if max_expansions is not None and expansions > max_expansions:
+                return None
+
+            for neighbor in successors[node]:
+                if not through[neighbor] and neighbor not in goals:
+                    continue
+                cost = costs[neighbor]
+                if blocked is not None and blocked(neighbor):
+                    if not allow_blocked:
+                        continue
+                    cost = INFINITY
+                new_distance = distance + cost
+                if neighbor not in distances or new_distance < distances[neighbor]:
+                    distances[neighbor] = new_distance
+                    previous[neighbor] = node
+                    heapq.heappush(queue, (new_distance + heuristic(neighbor), new_distance, neighbor))
+
+        return None
+
+    def reverse_tree(self, target, costs, blocked=None):
+        """
+        Runs Dijkstra backwards from target. Returns two arrays indexed by node
+        id: the next node on the shortest route to target (-1 if none) and the
+        remaining route cost (infinity if unreachable). Corners may start a
+        route but are never crossed, and neither are nodes for which
+        blocked(v) is true.
+        """
+        predecessors = self._predecessors
+        corners = self._corners
+        distances = [INFINITY] * self.node_count
+        next_hop = [-1] * self.node_count
+        distances[target] = 0
+        queue = [(0, target)]
+
+        while queue:
+            distance, node = heapq.heappop(queue)
+            if distance > distances[node]:
+                continue  # Outdated queue entry
+            if corners[node]:
+                continue  # Corners can start a route but never be crossed
+            if blocked is not None and node != target and blocked(node):
+                continue  # Taken cells cannot be crossed either
+
+            cost = costs[node]
+            for previous in predecessors[node]:
+                new_distance = distance + cost
+                if new_distance < distances[previous]:
+                    distances[previous] = new_distance
+                    next_hop[previous] = node
+                    heapq.heappush(queue, (new_distance, previous))
+
+        return np.array(next_hop, dtype=np.int32), np.array(distances, dtype=np.float64)
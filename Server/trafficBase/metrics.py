@@ -0,0 +1,136 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the per-step profiling metrics of the city model
+# 2024
+
+import bisect
+import time
+
+# Phases of CityModel.step, in the order they run
+STEP_PHASES = ("lights", "cars", "routing", "spawn", "shutdown", "collect")
+
+# Histogram buckets (upper bounds) for phase durations in seconds and for per-step counts
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram: memory stays the same however many values it sees.
+    """
+
+    def __init__(self, bounds):
+        """
+        Parameters:
+        - bounds: Sorted upper bounds of the buckets (a last +Inf bucket is implied).
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Records one value.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name, labels=""):
+        """
+        Returns the Prometheus text lines of the histogram.
+        """
+        separator = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.bounds) + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.total}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+
+class StepMetrics:
+    """
+    Collects per-phase timings and per-step counts of a CityModel. The model
+    only calls it when metrics are enabled (model.metrics is None otherwise).
+    """
+
+    def __init__(self):
+        self.phase_seconds = {phase: Histogram(SECONDS_BUCKETS) for phase in STEP_PHASES}
+        self.step_seconds = Histogram(SECONDS_BUCKETS)
+        self.find_path_per_step = Histogram(COUNT_BUCKETS)
+        self.reroutes_per_step = Histogram(COUNT_BUCKETS)
+        self.stuck_per_step = Histogram(COUNT_BUCKETS)
+        self.last_phase_seconds = dict.fromkeys(STEP_PHASES, 0.0)  # Timings of the last step
+        self.stuck_cars = 0  # Stuck cars after the last step
+        self.steps = 0
+        self._step_start = 0.0
+        self._lap_start = 0.0
+        self._find_path_calls = 0
+        self._reroutes = 0
+
+    def start_step(self, model):
+        """
+        Starts timing a step.
+        """
+        self._find_path_calls = model.find_path_calls
+        self._reroutes = model.reroutes
+        self._step_start = self._lap_start = time.perf_counter()
+
+    def lap(self, phase):
+        """
+        Records the time since the previous lap as the duration of phase.
+        """
+        now = time.perf_counter()
+        self.last_phase_seconds[phase] = now - self._lap_start
+        self.phase_seconds[phase].observe(now - self._lap_start)
+        self._lap_start = now
+
+    def end_step(self, model):
+        """
+        Records the whole step and the counts of the model after it.
+        """
+        self.step_seconds.observe(time.perf_counter() - self._step_start)
+        self.find_path_per_step.observe(model.find_path_calls - self._find_path_calls)
+        self.reroutes_per_step.observe(model.reroutes - self._reroutes)
+        self.stuck_cars = model.stuck_car_count()
+        self.stuck_per_step.observe(self.stuck_cars)
+        self.steps += 1
+
+    def render(self, model, prefix="traffic"):
+        """
+        Returns the metrics (and the model counters) in the Prometheus text format.
+        """
+        lines = [
+            f"# HELP {prefix}_step_phase_seconds Time spent in each phase of a step.",
+            f"# TYPE {prefix}_step_phase_seconds histogram",
+        ]
+        for phase in STEP_PHASES:
+            lines += self.phase_seconds[phase].render(f"{prefix}_step_phase_seconds", f'phase="{phase}"')
+
+        histograms = [
+            ("step_seconds", self.step_seconds, "Time spent in a whole step."),
+            ("step_find_path_calls", self.find_path_per_step, "find_path calls made in a step."),
+            ("step_reroutes", self.reroutes_per_step, "Cars given a new route in a step."),
+            ("step_stuck_cars", self.stuck_per_step, "Cars stuck at the end of a step."),
+        ]
+        for name, histogram, description in histograms:
+            lines += [f"# HELP {prefix}_{name} {description}", f"# TYPE {prefix}_{name} histogram"]
+            lines += histogram.render(f"{prefix}_{name}")
+
+        values = [
+            ("steps_total", "counter", "Steps run.", model.step_count),
+            ("find_path_calls_total", "counter", "find_path calls made.", model.find_path_calls),
+            ("reroutes_total", "counter", "Cars given a new route.", model.reroutes),
+            ("cars_delivered_total", "counter", "Cars that reached their destination.", model.reached_destination),
+            ("cars_in_grid", "gauge", "Cars currently on the grid.", model.in_grid),
+            ("stuck_cars", "gauge", "Cars stuck after the last step.", self.stuck_cars),
+        ]
+        for name, kind, description, value in values:
+            lines += [f"# HELP {prefix}_{name} {description}", f"# TYPE {prefix}_{name} {kind}",
+                      f"{prefix}_{name} {value}"]
+        return "\n".join(lines) + "\n"
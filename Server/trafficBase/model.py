@@ -8,266 +8,414 @@ from mesa.datacollection import DataCollector
 from mesa.time import RandomActivation
 from mesa.space import MultiGrid
 from .agent import *  
-import json
+from .citymap import load_city_map, DEFAULT_CITY, CELL_ROAD
+from .vectorized import VectorizedEngine
+from .partitioned import PartitionedEngine
+from .metrics import StepMetrics
+from .signals import Intersection, SIGNAL_CONTROLLERS
+from .collector import StreamingCollector
+from .trajectory import TrajectoryRecorder
+from collections import deque
 import random
-import networkx as nx  # For graph-based city navigation
+import numpy as np  # For array-backed map layers
+
+# Available stepping engines for cars
+ENGINES = ("agents", "vectorized", "partitioned")
+
+
+class InGridStable:
+    """
+    Stop condition for CityModel.run_steps: true once the number of cars in
+    the grid stayed within tolerance (a fraction of its mean) over the last
+    window steps.
+    """
+
+    def __init__(self, window=50, tolerance=0.05):
+        """
+        Parameters:
+        - window: Steps the count must stay steady for.
+        - tolerance: Allowed spread (max - min) as a fraction of the mean count.
+        """
+        self.window = window
+        self.tolerance = tolerance
+        self.history = deque(maxlen=window)
+
+    def __call__(self, model):
+        self.history.append(model.in_grid)
+        if len(self.history) < self.window:
+            return False
+        spread = max(self.history) - min(self.history)
+        return spread <= self.tolerance * sum(self.history) / self.window
+
+
+# Stop conditions of CityModel.run_steps by name
+RUN_CONDITIONS = {
+    "stable": InGridStable,
+}
+
+# Settings that may be changed on a running model (e.g. in a fork), with their allowed range
+TUNABLES = {
+    "light_cycle_duration": (2, 10000),
+    "spawn_interval": (1, 10000),
+    "repair_horizon": (1, 100),
+    "repair_budget": (1, 100000),
+    "change_history": (1, 100000),
+}
 
 # Define the main city simulation model
 class CityModel(Model):
-    def __init__(self, N):
+    def __init__(self, N, engine="agents", city=DEFAULT_CITY, seed=None, metrics=False,
+                 signals="fixed", collector=None, record=None, workers=None):
         """
         Initialize the city simulation model.
 
         Parameters:
         - N: Number of cars to spawn initially (not directly used in this code).
+        - engine: "agents" to step every Car agent one at a time, "vectorized"
+          to step all cars at once as arrays (see VectorizedEngine), or
+          "partitioned" to split them by region over worker processes (see PartitionedEngine).
+        - city: Name of a map in static/city_files (e.g. "2022_base") or the
+          absolute path of a custom map file.
+        - seed: Seed of the model's random generator (read by mesa.Model). Every
+          random draw of the model comes from it, so a seed reproduces a run.
+        - metrics: If True, time every phase of step and keep per-step counts (see StepMetrics).
+        - signals: "fixed" to switch every light together on light_cycle_duration, or
+          "actuated" to give green time per intersection from the waiting queues.
+        - collector: None to keep the collected data in memory (mesa's DataCollector,
+          without the "Trips" table), or a sink (RingBufferSink, ColumnarFileSink)
+          to stream it, trips included, with bounded memory.
+        - record: Path of a trajectory file to write the car positions and light
+          states of every step to (see TrajectoryRecorder), or None.
+        - workers: Regions and worker processes of the partitioned engine
+          (default: one per CPU core). Call close() to stop them.
         """
         super().__init__()
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+        if signals not in SIGNAL_CONTROLLERS:
+            raise ValueError(f"Unknown signals {signals!r}, expected one of {tuple(SIGNAL_CONTROLLERS)}")
+        self.engine = engine
+        # Seeded streams split from the model's generator (seed), so that runs
+        # with the same seed are identical and drawing car colors never
+        # changes where cars go
+        self.spawn_random = random.Random(self.random.getrandbits(64))  # Destinations of new cars
+        self.color_random = random.Random(self.random.getrandbits(64))  # Car colors
+        self.city = city  # Map name or path, as given
+        self.signals = signals  # Signal controller name
         self.reached_destination = 0  # Counter for cars that reached their destination
         self.in_grid = 0  # Counter for cars currently in the grid
-        self.corner_positions = []  # Positions designated for spawning cars
         self.running = True  # Controls the simulation run state
         self.step_count = 0  # Step counter
+        self.route_requests = []  # Cars waiting for a new route this step
+        self.route_searches_saved = 0  # Searches avoided by batching in the last step
+        self.find_path_calls = 0  # Total find_path calls
+        self.reroutes = 0  # Total cars given a detour or a new route
+        self.metrics = StepMetrics() if metrics else None  # Step profiling, None when off
+        self.collect_data = True  # Collect the model reporters every step
         self.n = N  # Number of cars to potentially spawn
-
-        # Initialize DataCollector to track model metrics
-        self.datacollector = DataCollector(
-            model_reporters={
-                "Cars in Grid": lambda m: m.in_grid,
-                "Cars Reached Destination": lambda m: m.reached_destination,
-            }
-        )
-
-        # Load the map dictionary (provides additional map-related data if needed)
-        with open("./static/city_files/mapDictionary.json") as f:
-            dataDictionary = json.load(f)
-
-        # Separate lists for traffic lights and destination positions
-        self.traffic_lights_S = []  # Vertical traffic lights
-        self.traffic_lights_s = []  # Horizontal traffic lights
-        self.destinations = []  # Destination positions
-
-        # Define arrow orientations for navigation
-        self.arrow_orientations = {
-            '>': (1, 0),    # Right
-            '<': (-1, 0),   # Left
-            '^': (0, 1),    # Up
-            'v': (0, -1),   # Down
+        self.change_history = 1000  # Steps of removed cars kept for car_changes
+        self.removed_cars = deque()  # (step, unique_id, spawn_step) of cars that left the grid
+
+        # Initialize DataCollector to track model metrics and car trips
+        model_reporters = {
+            "Cars in Grid": lambda m: m.in_grid,
+            "Cars Reached Destination": lambda m: m.reached_destination,
+            "Route Searches Saved": lambda m: m.route_searches_saved,
         }
-
-        # Load the map file and create the grid
-        map_path = './static/city_files/2024_base.txt'
-        with open(map_path) as baseFile:
-            lines = baseFile.readlines()
-            self.width = len(lines[0].strip())  # Grid width
-            self.height = len(lines)  # Grid height
-            self.grid = MultiGrid(self.width, self.height, torus=False)  # Non-wrapping grid
-            self.schedule = RandomActivation(self)  # Random activation schedule for agents
-
-            # Create the grid structure by parsing the map file
-            for r, row in enumerate(lines):
-                for c, col in enumerate(row.strip('\n')):
-                    pos = (c, self.height - r - 1)  # Align Y-axis correctly
-                    unique_id = f"{col}_{r*self.width+c}"
-                    if col in self.arrow_orientations:
-                        # Create Road agent with appropriate direction
-                        direction = tuple(self.arrow_orientations[col])
-                        agent = Road(f"r_{r*self.width+c}", self, direction)
-                        self.grid.place_agent(agent, pos)
-                    elif col in ["S", "s"]:
-                        # Create Traffic_Light agent and add to appropriate list
-                        is_horizontal = (col == "s")
-                        agent = Traffic_Light(f"tl_{r*self.width+c}", self, is_horizontal=is_horizontal)
-                        self.grid.place_agent(agent, pos)
-                        self.schedule.add(agent)
-                        if col == "S":
-                            self.traffic_lights_S.append(agent)
-                        else:
-                            self.traffic_lights_s.append(agent)
-                    elif col == "#":
-                        # Create Obstacle agent
-                        agent = Obstacle(f"ob_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, pos)
-                    elif col == "D":
-                        # Create Destination agent and store its position
-                        agent = Destination(f"d_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, pos)
-                        self.destinations.append(pos)
-
-        # Create the city navigation graph based on the map
-        self.navigation_graph = self.create_city_graph(map_path)
-
-        # Define corner positions for spawning cars
-        self.corner_positions = [
-            (0, 0),                          # Bottom-left corner
-            (0, self.height - 1),            # Top-left corner
-            (self.width - 1, 0),             # Bottom-right corner
-            (self.width - 1, self.height - 1)  # Top-right corner
+        # Trips grow with every delivered car, so they are only kept by a sink
+        # (which bounds or streams them), never in the in-memory DataCollector
+        self.record_trips = collector is not None
+        tables = {"Trips": ["Car", "Spawn Step", "Arrival Step", "Trip Steps"]} if self.record_trips else {}
+        if collector is None:
+            self.datacollector = DataCollector(model_reporters=model_reporters, tables=tables)
+        else:
+            self.datacollector = StreamingCollector(model_reporters, tables, collector)
+
+        # Load the compiled map (parsed, routed and cached once per map file)
+        self.city_map = load_city_map(city)
+        self.width = self.city_map.width  # Grid width
+        self.height = self.city_map.height  # Grid height
+        self.grid = MultiGrid(self.width, self.height, torus=False)  # Non-wrapping grid, holds only cars
+        self.schedule = RandomActivation(self)  # Random activation schedule for agents
+
+        # Static map layers, indexed by [x, y] and shared with every model of the same map
+        self.cell_layer = self.city_map.cell_layer  # Cell type code
+        self.direction_layer = self.city_map.direction_layer  # Road (dx, dy)
+        self.light_layer = self.city_map.light_layer  # Index in traffic_lights
+        self.obstacle_layer = self.city_map.obstacle_layer  # Impassable cells
+        # Dynamic layer with the number of the car on each cell (-1 if free)
+        self.car_layer = np.full((self.width, self.height), -1, dtype=np.int32)
+        self.cars = {}  # Cars on the grid by number, indexed by car_layer
+
+        # Only traffic lights get an object, since their state changes
+        self.traffic_lights = [  # All traffic lights, indexed by light_layer
+            Traffic_Light(self.cell_id("tl", pos), pos, is_horizontal=is_horizontal)
+            for pos, is_horizontal in self.city_map.lights
         ]
+        # Lights grouped by crossing, each switched by the signal controller
+        self.intersections = [
+            Intersection(i, [self.traffic_lights[light] for light in lights])
+            for i, lights in enumerate(self.city_map.intersections)
+        ]
+        self.light_intersection = np.zeros(len(self.traffic_lights), dtype=np.int64)  # Intersection of each light
+        for intersection, lights in enumerate(self.city_map.intersections):
+            self.light_intersection[lights] = intersection
+        self.light_horizontal = self.city_map.light_horizontal
+        self.light_requests = np.zeros(len(self.traffic_lights), dtype=np.int64)  # Cars checking each light this step
+        self.signal_controller = SIGNAL_CONTROLLERS[signals]()
+
+        self.destinations = list(self.city_map.destinations)  # Destination positions
+        self.corner_positions = list(self.city_map.corner_positions)  # Positions designated for spawning cars
+
+        # Compiled graph and shared per-destination routing tables
+        self.compiled_graph = self.city_map.compiled_graph
+        self.corner_penalty = self.city_map.corner_penalty  # Static routing penalty for cells next to a corner
+        self.node_costs = self.city_map.node_costs  # Static cost of entering each node
+        self.destination_index = self.city_map.destination_index
+        self.routing_tables = self.city_map.routing_tables  # Next node to take, by [destination, node]
+        self.route_distances = self.city_map.route_distances  # Remaining route cost, by [destination, node]
+        self.node_cost_list = self.node_costs.tolist()  # Cost lists for path searches
+        self.unit_costs = [1] * self.compiled_graph.node_count
 
         self.car_id_counter = 0  # Unique ID counter for cars
         self.light_timer = 0  # Timer for traffic light toggling
         self.light_cycle_duration = 10  # Duration for each traffic light state
+        self.spawn_interval = 1  # Steps between two spawn waves at the corners
+        self.repair_horizon = 6  # How many cells ahead a detour may rejoin the route
+        self.repair_budget = 64  # Node expansions allowed for a local detour search
+
+        # Array-based stepping engine, used instead of Car agents if selected
+        self.vectorized = None
+        if engine in ("vectorized", "partitioned"):
+            road_nodes = self.cell_layer[tuple(np.array(self.compiled_graph.positions).T)] == CELL_ROAD
+            if engine == "vectorized":
+                self.vectorized = VectorizedEngine(self, road_nodes)
+            else:
+                self.vectorized = PartitionedEngine(self, road_nodes, workers)
 
-    def lateral_moves(self, direction):
+        # Trajectory recording, None when off
+        self.recorder = None
+        if record is not None:
+            self.recorder = TrajectoryRecorder(record, self)
+            self.recorder.record(self)  # Starting state
+
+    def set_tunable(self, name, value):
         """
-        Returns the lateral movement directions based on the forward direction.
+        Changes one of the TUNABLES settings. Raises ValueError for any other
+        attribute, a value that is not an integer or one out of its range.
         """
-        if direction == (1, 0):  # Right
-            return [(0, 1), (0, -1)]  # Up and Down
-        elif direction == (-1, 0):  # Left
-            return [(0, -1), (0, 1)]  # Down and Up
-        elif direction == (0, 1):  # Up
-            return [(-1, 0), (1, 0)]  # Left and Right
-        elif direction == (0, -1):  # Down
-            return [(1, 0), (-1, 0)]  # Right and Left
-        else:
-            return []
-
-    def get_allowed_moves(self, cell_type):
-        """
-        Returns the list of allowed movement directions based on the cell type.
-        """
-        if cell_type in self.arrow_orientations:
-            forward = self.arrow_orientations[cell_type]
-            lateral_moves = self.lateral_moves(forward)
-            return [forward] + lateral_moves
-        elif cell_type == 's':
-            return [(-1, 0), (1, 0)]  # Horizontal traffic light (left, right)
-        elif cell_type == 'S':
-            return [(0, -1), (0, 1)]  # Vertical traffic light (up, down)
-        elif cell_type == 'D':
-            return []  # Destination cells allow no outgoing movement
+        if name not in TUNABLES:
+            raise ValueError(f"{name!r} cannot be changed, expected one of {tuple(TUNABLES)}")
+        low, high = TUNABLES[name]
+        if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+            raise ValueError(f"{name} must be an integer between {low} and {high}, got {value!r}")
+        setattr(self, name, value)
+
+    def next_hop(self, pos, destination):
+        """
+        Returns the next cell on the shared route from pos to destination,
+        or None if the destination is not reachable from pos.
+        """
+        node = self.compiled_graph.node_id(pos)
+        if node is None:
+            return None
+        next_node = self.routing_tables[self.destination_index[destination], node]
+        return self.compiled_graph.positions[next_node] if next_node >= 0 else None
+
+    def route_distance(self, pos, destination):
+        """
+        Returns the remaining route cost from pos to destination,
+        or infinity if the destination is not reachable from pos.
+        """
+        node = self.compiled_graph.node_id(pos)
+        if node is None:
+            return float('inf')
+        return float(self.route_distances[self.destination_index[destination], node])
+
+    def is_occupied_node(self, node):
+        """
+        Returns True if a car is on the given node of the compiled graph.
+        """
+        x, y = self.compiled_graph.positions[node]
+        return self.car_layer[x, y] >= 0
+
+    def find_path(self, start_pos, end_pos, avoid_traffic=True):
+        """
+        Finds the shortest path between two positions using A* with a Manhattan
+        heuristic on the compiled graph. Corners other than the start and
+        destinations other than the end are never crossed.
+        Returns the list of cells, or None if there is no path.
+        """
+        graph = self.compiled_graph
+        source = graph.node_id(start_pos)
+        target = graph.node_id(end_pos)
+        if source is None or target is None:
+            return None
+
+        self.find_path_calls += 1
+        if avoid_traffic:
+            path = graph.shortest_path(source, target, self.node_cost_list, self.is_occupied_node)
         else:
-            return []
+            path = graph.shortest_path(source, target, self.unit_costs)
+
+        if path is None:
+            return None
+        return [graph.positions[node] for node in path]
 
-    def valid_movement(self, current_cell_type, next_cell_type, dx, dy):
+    def route_ahead(self, pos, destination, length):
         """
-        Determines if movement between two cells is valid based on rules:
-        - Movement allowed by current cell type.
-        - No U-turns or contrary movement.
+        Returns up to `length` node ids that follow pos on the shared route.
         """
-        if next_cell_type == '#':  # Obstacles are impassable
-            return False
+        table = self.routing_tables[self.destination_index[destination]]
+        node = self.compiled_graph.node_id(pos)
+        ahead = []
+        while node is not None and len(ahead) < length:
+            node = int(table[node])
+            if node < 0:
+                break
+            ahead.append(node)
+        return ahead
+
+    def sidestep(self, pos, destination):
+        """
+        Returns the free neighbor cell (reachable in one move, not a corner or
+        a traffic light) with the lowest remaining route cost, or None.
+        """
+        graph = self.compiled_graph
+        node = graph.node_id(pos)
+        if node is None:
+            return None
+        distances = self.route_distances[self.destination_index[destination]]
+        best_node = None
+        best_distance = np.inf
+        for neighbor in graph.successors(node):
+            x, y = graph.positions[neighbor]
+            if (graph.through_mask[neighbor] and self.cell_layer[x, y] == CELL_ROAD
+                    and self.car_layer[x, y] < 0 and distances[neighbor] < best_distance):
+                best_node = neighbor
+                best_distance = distances[neighbor]
+        return graph.positions[best_node] if best_node is not None else None
+
+    def repair_route(self, pos, destination):
+        """
+        Looks for a short detour around taken cells that rejoins the shared
+        route a few cells ahead (at most repair_horizon cells, expanding at
+        most repair_budget nodes).
+        Returns the list of cells from pos to the end of the detour, or None.
+        """
+        graph = self.compiled_graph
+        source = graph.node_id(pos)
+        if source is None:
+            return None
 
-        # Check allowed moves for current cell type
-        allowed_moves = self.get_allowed_moves(current_cell_type)
-        if (dx, dy) not in allowed_moves:
-            return False
+        # The next cell is the blocked one, so rejoin the route after it
+        targets = [node for node in self.route_ahead(pos, destination, self.repair_horizon)[1:]
+                   if not self.is_occupied_node(node)]
+        path = graph.astar(source, targets, self.node_cost_list, self.is_occupied_node,
+                           max_expansions=self.repair_budget, allow_blocked=False)
+        if path is None:
+            return None
+        self.reroutes += 1
+        return [graph.positions[node] for node in path]
 
-        # Prevent movement into a contrary arrow
-        current_orientation = self.arrow_orientations.get(current_cell_type)
-        next_orientation = self.arrow_orientations.get(next_cell_type)
-        if next_orientation:
-            if current_orientation and (current_orientation[0] == -next_orientation[0] and current_orientation[1] == -next_orientation[1]):
-                return False
+    def request_route(self, car):
+        """
+        Registers a car that needs a new route. Requests are answered together
+        in the routing phase at the end of the agents' turn.
+        """
+        self.route_requests.append(car)
 
-        # Prevent U-turns
-        reverse_direction = (-dx, -dy)
-        if current_orientation == reverse_direction:
-            return False
-        
-        if next_cell_type in ["s", "S"]:
-            forward_direction = self.arrow_orientations.get(current_cell_type)
-            if forward_direction:
-                right_turn_direction = (forward_direction[1], -forward_direction[0])  # Rotate forward direction 90° clockwise
-                if (dx, dy) == right_turn_direction:
-                    return False
-
-        return True
-
-    def create_city_graph(self, map_file_path):
-        """
-        Creates a directed graph representing the city layout based on the map file.
-        """
-        with open(map_file_path, 'r') as file:
-            lines = file.readlines()
-            height = len(lines)
-            width = len(lines[0].strip())
-
-        city_graph = nx.DiGraph()
-        cell_types = {}
-
-        # Map cell types to their grid coordinates
-        for y, line in enumerate(lines):
-            for x, cell in enumerate(line.strip()):
-                grid_y = height - y - 1  # Invert Y axis to align with the grid
-                cell_types[(x, grid_y)] = cell
-
-        # Add all valid cells to the graph as nodes
-        for pos, cell in cell_types.items():
-            if cell != '#':  # Skip obstacles
-                city_graph.add_node(pos)
-
-        # Add edges based on movement rules
-        for pos, cell in cell_types.items():
-            if cell == '#' or cell == 'D':  # Skip obstacles and destinations
+    def resolve_route_requests(self):
+        """
+        Routing phase: answers every pending route request against a single
+        occupancy snapshot. A lone request for a destination gets its own A*
+        search, while several requests for the same destination share one
+        reverse search from it. Records how many searches this saved.
+        """
+        graph = self.compiled_graph
+        requests_by_destination = {}
+        for car in self.route_requests:
+            if car.pos is not None:
+                requests_by_destination.setdefault(car.destination, []).append(car)
+        self.route_requests = []
+
+        searches = 0
+        requests = 0
+        for destination, cars in requests_by_destination.items():
+            searches += 1
+            requests += len(cars)
+            if len(cars) == 1:
+                cars[0].recalculate_path()
                 continue
 
-            # Determine allowed moves
-            allowed_moves = self.get_allowed_moves(cell)
-            for dx, dy in allowed_moves:
-                next_pos = (pos[0] + dx, pos[1] + dy)
-                if next_pos in cell_types:
-                    next_cell = cell_types[next_pos]
-                    if self.valid_movement(cell, next_cell, dx, dy):
-                        city_graph.add_edge(pos, next_pos)
+            next_hop, _ = graph.reverse_tree(graph.node_id(destination), self.node_cost_list,
+                                             self.is_occupied_node)
+            next_hop = next_hop.tolist()
+            for car in cars:
+                node = graph.node_id(car.pos)
+                path = []
+                while node is not None and next_hop[node] >= 0:
+                    node = next_hop[node]
+                    path.append(graph.positions[node])
+                car.detour = path or None
+                car.stuck_counter = 0
+
+        self.route_searches_saved = requests - searches
+        self.reroutes += requests
+
+    def place_car(self, car, pos):
+        """
+        Places a car on the grid and records it in the car layer.
+        """
+        self.grid.place_agent(car, pos)
+        self.car_layer[pos] = car.number
+        self.cars[car.number] = car
+        car.moved_step = self.step_count
 
-        return city_graph
+    def move_car(self, car, pos):
+        """
+        Moves a car to a new cell, keeping the car layer up to date.
+        """
+        self.car_layer[car.pos] = -1
+        self.grid.move_agent(car, pos)
+        self.car_layer[pos] = car.number
+        car.moved_step = self.step_count
 
-    def is_neighbor(self, pos, reference_pos):
+    def remove_car(self, car):
         """
-        Checks if a position is a direct neighbor of another.
+        Removes a car from the grid and frees its cell.
         """
-        neighbors = self.grid.get_neighborhood(reference_pos, moore=True, include_center=False)
-        return pos in neighbors
+        self.car_layer[car.pos] = -1
+        self.grid.remove_agent(car)
+        del self.cars[car.number]
+        self.log_removal(car.unique_id, car.spawn_step)
 
-    def find_path(self, start_pos, end_pos, avoid_traffic=True):
+    def log_removal(self, unique_id, spawn_step):
         """
-        Finds the shortest path between two positions using Dijkstra's algorithm.
+        Remembers that a car left the grid in this step, for car_changes.
+        Removals older than change_history steps are forgotten.
         """
-        try:
-            allowed_nodes = set(self.navigation_graph.nodes)
-            if start_pos in self.corner_positions:
-                allowed_nodes -= set(self.corner_positions)
-                allowed_nodes.add(start_pos)
-            else:
-                allowed_nodes -= set(self.corner_positions)
-
-            other_destinations = set(self.destinations) - {end_pos}
-            allowed_nodes -= other_destinations
-
-            temp_graph = self.navigation_graph.subgraph(allowed_nodes)
-
-            if avoid_traffic:
-                def weight(u, v, d):
-                    w = 1
-                    cell_contents = self.grid.get_cell_list_contents([v])
-                    if any(isinstance(agent, (Car, Obstacle)) for agent in cell_contents):
-                        return float('inf')
-                    for corner in self.corner_positions:
-                        if self.is_neighbor(v, corner):
-                            w += 30
-                    return w
-
-                path = nx.dijkstra_path(temp_graph, start_pos, end_pos, weight=weight)
-                return path
-            else:
-                path = nx.shortest_path(temp_graph, start_pos, end_pos)
-                return path
-        except nx.NetworkXNoPath:
-            return None
+        removed = self.removed_cars
+        removed.append((self.step_count, unique_id, spawn_step))
+        while removed[0][0] <= self.step_count - self.change_history:
+            removed.popleft()
+
+    def car_at(self, pos):
+        """
+        Returns the car on a cell, or None if the cell is free.
+        """
+        number = self.car_layer[pos]
+        return self.cars[number] if number >= 0 else None
 
     def try_spawn_car(self):
         """
         Attempts to spawn up to 4 cars at corner positions if available.
+        Returns the spawned Car agents (their numbers with the vectorized engine).
         """
-        if self.step_count % 1 != 0:
+        if self.step_count % self.spawn_interval != 0:
             return None
 
-        available_positions = [
-            pos for pos in self.corner_positions
-            if not any(isinstance(agent, Car) for agent in self.grid.get_cell_list_contents([pos]))
-        ]
+        available_positions = [pos for pos in self.corner_positions if self.car_layer[pos] < 0]
 
         cars_to_spawn = min(4, len(available_positions))
         spawned_cars = []
@@ -275,49 +423,199 @@ class CityModel(Model):
         for i in range(cars_to_spawn):
             pos = available_positions[i]
             self.car_id_counter += 1
-            destination = random.choice(self.destinations)
-            car = Car(f"car_{self.car_id_counter}", self, destination)
-            self.grid.place_agent(car, pos)
-            self.schedule.add(car)
+            destination = self.spawn_random.choice(self.destinations)
             self.in_grid += 1
+            if self.vectorized is not None:
+                self.vectorized.add_car(self.car_id_counter, pos, destination)
+                spawned_cars.append(self.car_id_counter)
+                continue
+            car = Car(f"car_{self.car_id_counter}", self, destination, number=self.car_id_counter)
+            self.place_car(car, pos)
+            self.schedule.add(car)
             spawned_cars.append(car)
 
         return spawned_cars
 
+    def car_positions(self):
+        """
+        Returns a list of (unique_id, (x, y)) for every car, whatever the engine.
+        """
+        if self.vectorized is not None:
+            return self.vectorized.positions()
+        return [(car.unique_id, car.pos) for car in self.cars.values()]
+
+    def car_arrays(self):
+        """
+        Returns the number, x and y of every car as three int32 arrays, whatever the engine.
+        """
+        if self.vectorized is not None:
+            return self.vectorized.car_arrays()
+        cars = self.cars.values()
+        numbers = np.fromiter((car.number for car in cars), dtype=np.int32, count=len(self.cars))
+        positions = np.array([car.pos for car in cars], dtype=np.int32).reshape(-1, 2)
+        return numbers, positions[:, 0], positions[:, 1]
+
+    def light_states(self):
+        """
+        Returns the state of every traffic light (True for green) as a bool array, in traffic_lights order.
+        """
+        return np.fromiter((light.state for light in self.traffic_lights), dtype=bool, count=len(self.traffic_lights))
+
+    def car_changes(self, since=None):
+        """
+        Returns what changed on the grid after step since, as a dictionary:
+        - step: The current step (the since of the next request).
+        - full: True if added holds every car instead of a delta. This happens
+          when since is None, in the future, or older than change_history steps.
+        - added: (unique_id, (x, y)) of the cars that entered the grid.
+        - moved: (unique_id, (x, y)) of the cars that changed cell.
+        - removed: unique_id of the cars that left the grid.
+        Cars that entered and left within the interval are not reported.
+        """
+        step = self.step_count
+        if since is None or since > step or since < step - self.change_history:
+            return {"step": step, "full": True, "added": self.car_positions(), "moved": [], "removed": []}
+
+        if self.vectorized is not None:
+            added, moved = self.vectorized.changes(since)
+        else:
+            added, moved = [], []
+            for car in self.cars.values():
+                if car.moved_step > since:
+                    (added if car.spawn_step > since else moved).append((car.unique_id, car.pos))
+        removed = []
+        for removal_step, unique_id, spawn_step in reversed(self.removed_cars):
+            if removal_step <= since:
+                break
+            if spawn_step <= since:
+                removed.append(unique_id)
+        return {"step": step, "full": False, "added": added, "moved": moved, "removed": removed}
+
+    def static_cells(self, cell_type):
+        """
+        Returns the (x, y) positions of all cells of a type (a CELL_* code),
+        in the same column-major order as MultiGrid.coord_iter.
+        """
+        return [(int(x), int(y)) for x, y in np.argwhere(self.cell_layer == cell_type)]
+
+    def cell_id(self, prefix, pos):
+        """
+        Returns the id a static cell had as an agent (prefix + row-major index in the map file).
+        """
+        x, y = pos
+        return f"{prefix}_{(self.height - y - 1) * self.width + x}"
+
+    def record_trip(self, number, spawn_step):
+        """
+        Records the trip of a car that just reached its destination, if a
+        collector sink is configured.
+        """
+        if not self.record_trips:
+            return
+        self.datacollector.add_table_row("Trips", {
+            "Car": number,
+            "Spawn Step": spawn_step,
+            "Arrival Step": self.step_count,
+            "Trip Steps": self.step_count - spawn_step,
+        })
+
+    def stuck_car_count(self):
+        """
+        Returns how many cars did not manage to move in their last turn.
+        """
+        if self.vectorized is not None:
+            return self.vectorized.stuck_count()
+        return sum(1 for car in self.cars.values() if car.stuck_counter > 0)
+
     def toggle_traffic_lights(self):
         """
-        Toggles the state of all traffic lights (synchronized for S and s).
+        Lets the signal controller switch the lights of every intersection.
         """
-        if self.light_timer % self.light_cycle_duration == 0:
-            for light in self.traffic_lights_S:
-                light.state = True
-            for light in self.traffic_lights_s:
-                light.state = False
-        elif self.light_timer % self.light_cycle_duration == self.light_cycle_duration // 2:
-            for light in self.traffic_lights_S:
-                light.state = False
-            for light in self.traffic_lights_s:
-                light.state = True
-        self.light_timer += 1
+        self.signal_controller.step(self)
 
     def step(self):
         """
         Advances the model by one step, toggles traffic lights, and spawns new cars.
         """
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.start_step(self)
+
         self.step_count += 1
         self.toggle_traffic_lights()
-        self.schedule.step()
+        if metrics is not None:
+            metrics.lap("lights")
+
+        if self.vectorized is not None:
+            self.vectorized.step()
+        else:
+            self.schedule.step()
+        if metrics is not None:
+            metrics.lap("cars")
+
+        if self.vectorized is None:
+            self.resolve_route_requests()
+        if metrics is not None:
+            metrics.lap("routing")
 
         cars_spawned = self.try_spawn_car()
+        if metrics is not None:
+            metrics.lap("spawn")
 
         if cars_spawned is not None and cars_spawned == []:
             self.running = False
 
         if not self.running:
-            cars = [agent for agent in self.schedule.agents if isinstance(agent, Car)]
-            for car in cars:
-                self.grid.remove_agent(car)
+            if self.vectorized is not None:
+                self.in_grid -= self.vectorized.clear()
+            for car in list(self.cars.values()):
+                self.remove_car(car)
                 self.schedule.remove(car)
                 self.in_grid -= 1
+        if metrics is not None:
+            metrics.lap("shutdown")
+
+        if self.collect_data:
+            self.datacollector.collect(self)
+        if self.recorder is not None:
+            self.recorder.record(self)
+        if metrics is not None:
+            metrics.lap("collect")
+            metrics.end_step(self)
+
+    def close(self):
+        """
+        Finishes the trajectory file and the collector sink, if any, and
+        stops the workers of the partitioned engine.
+        """
+        if isinstance(self.vectorized, PartitionedEngine):
+            self.vectorized.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if isinstance(self.datacollector, StreamingCollector):
+            self.datacollector.close()
+
+    def run_steps(self, steps, until=None, collect=True):
+        """
+        Runs up to steps steps in a row. Returns how many steps ran and why it
+        stopped: "steps", "condition" or "finished" (the model stopped running).
 
-        self.datacollector.collect(self)
+        Parameters:
+        - steps: Most steps to run.
+        - until: Optional function of the model, checked after every step, that
+          ends the run when it returns True (e.g. InGridStable()).
+        - collect: If False, the model reporters are not collected during the run
+          (trips are still recorded).
+        """
+        collect_data = self.collect_data
+        self.collect_data = collect
+        try:
+            done = 0
+            while done < steps and self.running:
+                self.step()
+                done += 1
+                if until is not None and until(self):
+                    return done, "condition"
+            return done, ("steps" if self.running else "finished")
+        finally:
+            self.collect_data = collect_data
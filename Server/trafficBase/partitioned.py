@@ -0,0 +1,270 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the spatially partitioned stepping engine for cars
+# 2024
+
+import multiprocessing
+import os
+import random
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from .citymap import load_city_map
+from .vectorized import VectorizedEngine, change_lists
+
+
+def split_regions(width, height, count):
+    """
+    Splits a width x height grid into count rectangles of about the same
+    size, as close to square as count allows. Returns the (x0, x1, y0, y1)
+    bounds of every region (ends excluded), row by row from the bottom.
+    """
+    columns = min((c for c in range(1, count + 1) if count % c == 0),
+                  key=lambda c: abs(np.log((width / c) / (height / (count // c)))))
+    rows = count // columns
+    x_edges = np.linspace(0, width, columns + 1).round().astype(int).tolist()
+    y_edges = np.linspace(0, height, rows + 1).round().astype(int).tolist()
+    return [(x_edges[column], x_edges[column + 1], y_edges[row], y_edges[row + 1])
+            for row in range(rows) for column in range(columns)]
+
+
+def region_of(regions, xs, ys):
+    """
+    Returns the index of the region holding every (x, y) cell.
+    """
+    result = np.full(len(xs), -1, dtype=np.int32)
+    for index, (x0, x1, y0, y1) in enumerate(regions):
+        result[(xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)] = index
+    return result
+
+
+class RegionModel:
+    """
+    The parts of a CityModel a VectorizedEngine reads, for the cars of one
+    region in a worker process. Arrivals are kept for the main process,
+    which records them with the rest of the model.
+    """
+
+    def __init__(self, city_map, car_layer, seed):
+        """
+        Parameters:
+        - city_map: The compiled CityMap.
+        - car_layer: The car layer shared with the main process.
+        - seed: Seed of the region's random generator.
+        """
+        self.compiled_graph = city_map.compiled_graph
+        self.light_layer = city_map.light_layer
+        self.destinations = city_map.destinations
+        self.destination_index = city_map.destination_index
+        self.routing_tables = city_map.routing_tables
+        self.route_distances = city_map.route_distances
+        self.random = random.Random(seed)
+        self.car_layer = car_layer
+        self.light_requests = np.zeros(len(city_map.lights), dtype=np.int64)
+        self.step_count = 0
+        self.in_grid = 0
+        self.reached_destination = 0
+        self.arrivals = []  # (number, spawn_step) of the cars that reached their destination this step
+
+    def record_trip(self, number, spawn_step):
+        self.arrivals.append((number, spawn_step))
+
+    def log_removal(self, unique_id, spawn_step):
+        pass  # Logged by the main process with the arrival
+
+
+def run_region(connection, city, memory_name, road_mask, interior_nodes, seed):
+    """
+    Main loop of a region worker: moves the cars of the region whose cells
+    are all inside it and sends the others to the main process. Commands
+    are ("step", (step, light states, new cars)), ("arrays", None),
+    ("changes", since), ("take", None) and ("close", None). The queries
+    answer with the arrays of the region's cars and leave them in place.
+    """
+    memory = SharedMemory(name=memory_name)
+    city_map = load_city_map(city)
+    model = RegionModel(city_map, np.ndarray((city_map.width, city_map.height), dtype=np.int32,
+                                             buffer=memory.buf), seed)
+    engine = VectorizedEngine(model, road_mask)
+    try:
+        while True:
+            command, argument = connection.recv()
+            if command == "close":
+                break
+            if command == "take":
+                connection.send(engine.take(np.ones(len(engine), dtype=bool)))
+            elif command == "arrays":
+                connection.send(engine.car_arrays())
+            elif command == "changes":
+                connection.send(engine.change_arrays(argument))
+            elif command == "step":
+                model.step_count, light_states, cars = argument
+                engine.extend(cars)
+                # Border cars are handed over before the others move: a car
+                # that reaches the border now waits for the next step, so no
+                # car acts twice in a step
+                border = engine.take(~interior_nodes[engine.nodes])
+                engine.move_cars(np.arange(len(engine)), light_states)
+                connection.send((model.arrivals, model.light_requests, border, engine.stuck_count()))
+                model.arrivals = []
+                model.light_requests = np.zeros_like(model.light_requests)
+    finally:
+        model.car_layer = None  # Release the view before closing the shared memory
+        memory.close()
+
+
+class PartitionedEngine(VectorizedEngine):
+    """
+    Vectorized engine spread over worker processes, for very large maps.
+    The grid is split into rectangular regions (see split_regions) and every
+    worker owns the cars inside one of them. In a step, each worker moves
+    the cars whose cells (own, target and sidestep options) are all inside
+    its region, in parallel with the other workers. The remaining border
+    cars are handed to this process, which moves them once every region is
+    done and hands each one to the region of its new cell at the next step.
+    The car layer lives in shared memory, so every car sees the cells
+    taken in other regions.
+
+    Cars follow the rules of Car.move and the model switches the lights as
+    usual. The result is that of stepping the cars one by one with the
+    inner cars of every region first and the border cars last: runs are
+    reproducible for a seed and a number of regions, but differ from the
+    vectorized engine's.
+
+    Between steps, this process only holds the border cars and the newly
+    spawned ones. The workers report how many of their cars are stuck with
+    every step, and answer reads of the cars (positions, car_arrays,
+    changes) with arrays while keeping them, so reading a frame never moves
+    the cars back here.
+    """
+
+    def __init__(self, model, road_mask, workers=None):
+        """
+        Parameters:
+        - model: The CityModel the cars belong to.
+        - road_mask: As in VectorizedEngine.
+        - workers: Number of regions and worker processes (default: one per CPU core).
+        """
+        super().__init__(model, road_mask)
+        self.regions = split_regions(model.width, model.height, workers or os.cpu_count() or 1)
+        self.node_region = region_of(self.regions, self.node_xs, self.node_ys)
+        neighbor_regions = self.node_region[np.maximum(self.successors, 0)]
+        interior_nodes = np.all((self.successors < 0) | (neighbor_regions == self.node_region[:, None]), axis=1)
+        self.scattered = False  # True while the workers hold cars
+        self.region_stuck = 0  # Stuck cars held by the workers
+
+        # Car layer in shared memory, written by every region
+        self.memory = SharedMemory(create=True, size=model.car_layer.nbytes)
+        car_layer = np.ndarray(model.car_layer.shape, dtype=model.car_layer.dtype, buffer=self.memory.buf)
+        car_layer[:] = model.car_layer
+        model.car_layer = car_layer
+
+        # Forked workers share the map already loaded by this process
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        context = multiprocessing.get_context(method)
+        self.connections = []
+        self.processes = []
+        for index in range(len(self.regions)):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=run_region, daemon=True, name=f"city-region-{index}",
+                                      args=(worker_connection, model.city, self.memory.name, road_mask,
+                                            interior_nodes, int(self.rng.integers(2 ** 63))))
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def gather(self):
+        """
+        Brings every car back from the workers (between two steps).
+        """
+        if not self.scattered:
+            return
+        for connection in self.connections:
+            connection.send(("take", None))
+        for connection in self.connections:
+            self.extend(connection.recv())
+        self.scattered = False
+
+    def step(self):
+        """
+        Advances every car by one step: inner cars in the regions, then border cars here.
+        """
+        model = self.model
+        light_states = np.array([light.state for light in model.traffic_lights] + [True], dtype=bool)
+        regions = self.node_region[self.nodes]
+        handoff = self.take(np.ones(len(self.numbers), dtype=bool))
+        for index, connection in enumerate(self.connections):
+            cars = {name: array[regions == index] for name, array in handoff.items()}
+            connection.send(("step", (model.step_count, light_states, cars)))
+        self.scattered = True
+
+        self.region_stuck = 0
+        for connection in self.connections:
+            arrivals, requests, border, stuck = connection.recv()
+            self.region_stuck += stuck
+            model.light_requests += requests
+            for number, spawn_step in arrivals:
+                model.record_trip(number, spawn_step)
+                model.log_removal(f"car_{number}", spawn_step)
+            model.in_grid -= len(arrivals)
+            model.reached_destination += len(arrivals)
+            self.extend(border)
+        self.move_cars(np.arange(len(self.numbers)), light_states)
+
+    def collect(self, command, argument, local):
+        """
+        Sends a read command to every worker and joins the arrays they answer
+        with the local ones (a tuple of arrays starting with car numbers),
+        ordered by car number like the cars of a single engine.
+        """
+        parts = [local]
+        if self.scattered:
+            for connection in self.connections:
+                connection.send((command, argument))
+            parts += [connection.recv() for connection in self.connections]
+        joined = [np.concatenate(arrays) for arrays in zip(*parts)]
+        order = np.argsort(joined[0], kind="stable")
+        return tuple(array[order] for array in joined)
+
+    def positions(self):
+        numbers, xs, ys = self.car_arrays()
+        return [(f"car_{number}", (x, y)) for number, x, y in zip(numbers.tolist(), xs.tolist(), ys.tolist())]
+
+    def changes(self, since):
+        return change_lists(*self.change_arrays(since))
+
+    def change_arrays(self, since):
+        return self.collect("changes", since, super().change_arrays(since))
+
+    def car_arrays(self):
+        return self.collect("arrays", None, super().car_arrays())
+
+    def stuck_count(self):
+        return (self.region_stuck if self.scattered else 0) + super().stuck_count()
+
+    def clear(self):
+        self.gather()
+        return super().clear()
+
+    def close(self):
+        """
+        Brings the cars back, stops the workers and frees the shared car
+        layer (the model keeps a copy of it).
+        """
+        if self.memory is None:
+            return
+        try:
+            self.gather()
+        finally:
+            for connection in self.connections:
+                try:
+                    connection.send(("close", None))
+                except (BrokenPipeError, OSError):
+                    pass
+            for process in self.processes:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+            self.model.car_layer = self.model.car_layer.copy()
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
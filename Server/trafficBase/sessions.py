@@ -0,0 +1,160 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the independent simulation sessions of the server
+# 2024
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Session ids clients may choose
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+class SessionLimitError(Exception):
+    """
+    Raised when every session slot is taken by a session that is in use.
+    """
+
+
+class Session:
+    """
+    One simulation with its own model. Hold session.lock while using the model:
+    Flask serves requests on several threads.
+    """
+    __slots__ = ("session_id", "model", "lock", "current_step", "last_used", "ticker")
+
+    def __init__(self, session_id, model):
+        self.session_id = session_id
+        self.model = model
+        self.lock = threading.Lock()
+        self.current_step = 0  # Steps run through the server
+        self.last_used = time.monotonic()
+        self.ticker = None  # Background stepping for live viewers, see broadcast.Ticker
+
+    def in_use(self):
+        """
+        True while a request is using the model or live viewers are watching it.
+        """
+        if self.lock.locked():
+            return True
+        return self.ticker is not None and self.ticker.playing and bool(self.ticker.subscribers)
+
+    def close(self):
+        """
+        Stops the session's ticker, if any, disconnects its viewers and
+        finishes the model's files.
+        """
+        if self.ticker is not None:
+            self.ticker.close()
+        with self.lock:
+            self.model.close()
+
+
+class SessionRegistry:
+    """
+    Maps session ids to independent models. At most max_sessions models are
+    kept: creating one more evicts the least recently used session that is
+    not in use. Sessions idle for more than idle_timeout seconds are dropped
+    when a session is created.
+    """
+
+    def __init__(self, max_sessions=16, idle_timeout=None):
+        """
+        Parameters:
+        - max_sessions: Models kept alive at the same time.
+        - idle_timeout: Seconds without requests after which a session is
+          dropped (None keeps sessions until they are evicted for room).
+        """
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()  # Session id -> Session, least recently used first
+        self.lock = threading.Lock()  # Guards the registry itself, not the models
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, session_id):
+        """
+        Returns the session with this id (marking it as used), or None.
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+                session.last_used = time.monotonic()
+            return session
+
+    def create(self, session_id, model):
+        """
+        Stores a new session for model under session_id, replacing any session
+        with the same id. Raises SessionLimitError if there is no room, or
+        ValueError for an invalid id; the model is closed in both cases.
+        Sessions dropped to make room are closed after the registry lock is
+        released, so waiting for their models never blocks other requests.
+        """
+        dropped = []
+        try:
+            if not SESSION_ID_PATTERN.fullmatch(session_id):
+                raise ValueError(f"Invalid session id {session_id!r}")
+            session = Session(session_id, model)
+            with self.lock:
+                dropped.extend(self.drop_idle())
+                replaced = self.sessions.pop(session_id, None)
+                if len(self.sessions) >= self.max_sessions:
+                    try:
+                        dropped.append(self.evict())
+                    except SessionLimitError:
+                        if replaced is not None:
+                            self.sessions[session_id] = replaced  # Keep the old session
+                        raise
+                if replaced is not None:
+                    dropped.append(replaced)
+                self.sessions[session_id] = session
+        except Exception:
+            model.close()
+            raise
+        finally:
+            for old in dropped:
+                old.close()
+        return session
+
+    def drop_idle(self):
+        """
+        Removes and returns the sessions idle for more than idle_timeout
+        seconds. Call with self.lock held, and close them after releasing it.
+        """
+        if self.idle_timeout is None:
+            return []
+        oldest = time.monotonic() - self.idle_timeout
+        dropped = []
+        for session_id, session in list(self.sessions.items()):
+            if session.last_used >= oldest:
+                break
+            if not session.in_use():
+                del self.sessions[session_id]
+                dropped.append(session)
+        return dropped
+
+    def evict(self):
+        """
+        Removes and returns the least recently used session that is not in
+        use. Call with self.lock held, and close it after releasing it.
+        """
+        for session_id, session in self.sessions.items():
+            if not session.in_use():
+                del self.sessions[session_id]
+                return session
+        raise SessionLimitError(f"All {self.max_sessions} sessions are in use")
+
+    def remove(self, session_id):
+        """
+        Drops a session. Returns True if it existed.
+        """
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.close()
+        return True
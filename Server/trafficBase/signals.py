@@ -0,0 +1,116 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the traffic light intersections and their signal controllers
+# 2024
+
+import numpy as np
+
+
+class Intersection:
+    """
+    Group of traffic lights controlling one crossing. Either the vertical
+    ("S") lights or the horizontal ("s") lights are green, never both.
+    """
+    __slots__ = ("index", "vertical", "horizontal", "vertical_green", "elapsed")
+
+    def __init__(self, index, lights):
+        """
+        Parameters:
+        - index: Position of the intersection in model.intersections.
+        - lights: The Traffic_Light objects of the crossing.
+        """
+        self.index = index
+        self.vertical = [light for light in lights if not light.is_horizontal]  # "S" lights
+        self.horizontal = [light for light in lights if light.is_horizontal]  # "s" lights
+        self.vertical_green = False
+        self.elapsed = 0  # Steps since the last switch
+
+    def set_green(self, vertical):
+        """
+        Gives green to the vertical lights (vertical=True) or to the horizontal ones.
+        """
+        for light in self.vertical:
+            light.state = vertical
+        for light in self.horizontal:
+            light.state = not vertical
+        self.vertical_green = vertical
+        self.elapsed = 0
+
+
+class FixedCycleController:
+    """
+    Switches every intersection at the same time on a fixed cycle: vertical
+    lights are green for the first half of model.light_cycle_duration and
+    horizontal lights for the second half. The queue counts in
+    model.light_requests are not needed and are cleared every step, so
+    they only ever hold the requests of the last step.
+    """
+
+    def step(self, model):
+        model.light_requests[:] = 0
+        phase = model.light_timer % model.light_cycle_duration
+        if phase == 0:
+            for intersection in model.intersections:
+                intersection.set_green(True)
+        elif phase == model.light_cycle_duration // 2:
+            for intersection in model.intersections:
+                intersection.set_green(False)
+        else:
+            for intersection in model.intersections:
+                intersection.elapsed += 1
+        model.light_timer += 1
+
+
+class ActuatedController:
+    """
+    Gives green time to each intersection on its own, from the queues seen by
+    its lights. Every car that checks a light adds to model.light_requests
+    (see Car.check_traffic_light), so the counts of the last step tell how
+    many cars want each approach. After min_green steps an intersection
+    switches when the red approach has more cars than the green one, or when
+    the green has lasted max_green steps and any car is waiting on red.
+    """
+
+    def __init__(self, min_green=3, max_green=20):
+        """
+        Parameters:
+        - min_green: Steps an approach stays green before it may switch.
+        - max_green: Steps after which a waiting red approach always gets green.
+        """
+        self.min_green = min_green
+        self.max_green = max_green
+        self.started = False
+
+    def step(self, model):
+        if not self.started:
+            # Same first phase as the fixed cycle
+            for intersection in model.intersections:
+                intersection.set_green(True)
+            self.started = True
+            model.light_requests[:] = 0
+            return
+
+        # Cars asking for the vertical and the horizontal lights of every intersection
+        count = len(model.intersections)
+        requests = model.light_requests
+        vertical = np.bincount(model.light_intersection, weights=requests * ~model.light_horizontal, minlength=count)
+        horizontal = np.bincount(model.light_intersection, weights=requests * model.light_horizontal, minlength=count)
+        requests[:] = 0
+
+        for intersection in model.intersections:
+            intersection.elapsed += 1
+            if intersection.elapsed < self.min_green:
+                continue
+            if intersection.vertical_green:
+                green, red = vertical[intersection.index], horizontal[intersection.index]
+            else:
+                green, red = horizontal[intersection.index], vertical[intersection.index]
+            if red > green or (red > 0 and intersection.elapsed >= self.max_green):
+                intersection.set_green(not intersection.vertical_green)
+
+
+# Available signal controllers by name
+SIGNAL_CONTROLLERS = {
+    "fixed": FixedCycleController,
+    "actuated": ActuatedController,
+}
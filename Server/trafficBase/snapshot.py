@@ -0,0 +1,285 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the checkpoints of a running city model
+# 2024
+
+import io
+import json
+import zipfile
+import numpy as np
+from .agent import Car, color_palette
+from .citymap import load_city_map
+from .model import CityModel, TUNABLES
+
+SNAPSHOT_VERSION = 2
+
+# Model attributes saved as they are
+MODEL_SCALARS = ("n", "reached_destination", "in_grid", "running", "step_count", "route_searches_saved",
+                 "find_path_calls", "reroutes", "car_id_counter", "light_timer", "light_cycle_duration",
+                 "spawn_interval", "repair_horizon", "repair_budget", "collect_data", "change_history")
+
+# Random generators of the model
+RANDOM_STREAMS = ("random", "spawn_random", "color_random")
+
+# Car arrays of the vectorized engine
+ENGINE_ARRAYS = ("numbers", "nodes", "destinations", "next_hops", "stuck", "spawn_steps", "moved_steps")
+
+
+class ModelSnapshot:
+    """
+    Everything a CityModel needs to continue from a given step: counters,
+    light and intersection states, the signal controller, the random
+    generators and the cars (as arrays, whatever the engine). The compiled
+    map is not included, only its content hash, so restored models share
+    the map already loaded by the process. The collected data and the step
+    metrics are not included either: a restored model starts them afresh.
+
+    A snapshot can be restored any number of times; every restore is an
+    independent model (a fork).
+    """
+
+    def __init__(self, meta, arrays):
+        """
+        Parameters:
+        - meta: JSON-serializable dictionary of scalar state.
+        - arrays: Dictionary of name -> NumPy array.
+        """
+        self.meta = meta
+        self.arrays = arrays
+
+    @classmethod
+    def capture(cls, model):
+        """
+        Takes a snapshot of a model between two steps.
+        """
+        if model.route_requests:
+            raise ValueError("Cannot take a snapshot in the middle of a step")
+        if model.engine == "partitioned":
+            raise ValueError("Snapshots of the partitioned engine are not supported")
+        random_states = {name: getattr(model, name).getstate() for name in RANDOM_STREAMS}
+        meta = {
+            "version": SNAPSHOT_VERSION,
+            "city": model.city,
+            "digest": model.city_map.digest,
+            "engine": model.engine,
+            "signals": model.signals,
+            "scalars": {name: getattr(model, name) for name in MODEL_SCALARS},
+            "schedule": [model.schedule.steps, model.schedule.time],
+            "random": {name: [state[0], state[2]] for name, state in random_states.items()},
+            "controller": vars(model.signal_controller),
+            "removed_cars": list(model.removed_cars),
+        }
+        arrays = {
+            **{f"{name}_state": np.array(state[1], dtype=np.int64) for name, state in random_states.items()},
+            "light_states": model.light_states(),
+            "light_requests": model.light_requests.copy(),
+            "vertical_green": np.array([i.vertical_green for i in model.intersections], dtype=bool),
+            "elapsed": np.array([i.elapsed for i in model.intersections], dtype=np.int64),
+        }
+
+        if model.vectorized is not None:
+            engine = model.vectorized
+            meta["engine_rng"] = engine.rng.bit_generator.state
+            for name in ENGINE_ARRAYS:
+                arrays[f"engine_{name}"] = getattr(engine, name).copy()
+        else:
+            cars = list(model.schedule.agents)  # In schedule order, which the random activation depends on
+            directions = [car.direction or (0, 0) for car in cars]
+            detours = [car.detour or [] for car in cars]
+            arrays.update({
+                "car_numbers": np.array([car.number for car in cars], dtype=np.int64),
+                "car_positions": np.array([car.pos for car in cars], dtype=np.int32).reshape(-1, 2),
+                "car_destinations": np.array([model.destination_index[car.destination] for car in cars], dtype=np.int32),
+                "car_stuck": np.array([car.stuck_counter for car in cars], dtype=np.int32),
+                "car_colors": np.array([car.color_index for car in cars], dtype=np.int8),
+                "car_spawn_steps": np.array([car.spawn_step for car in cars], dtype=np.int64),
+                "car_moved_steps": np.array([car.moved_step for car in cars], dtype=np.int64),
+                "car_directions": np.array(directions, dtype=np.int8).reshape(-1, 2),
+                "car_has_direction": np.array([car.direction is not None for car in cars], dtype=bool),
+                "car_detour_lengths": np.array([len(detour) if car.detour is not None else -1
+                                                for car, detour in zip(cars, detours)], dtype=np.int32),
+                "car_detour_cells": np.array([pos for detour in detours for pos in detour],
+                                             dtype=np.int32).reshape(-1, 2),
+            })
+        return cls(meta, arrays)
+
+    def to_bytes(self):
+        """
+        Serializes the snapshot as a .npz archive (the metadata is stored as JSON).
+        """
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, meta=np.array(json.dumps(self.meta)), **self.arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Reads a snapshot written by to_bytes.
+        """
+        try:
+            with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+                arrays = {name: archive[name] for name in archive.files}
+            meta = json.loads(arrays.pop("meta").item())
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            raise ValueError("Not a model snapshot")
+        if meta.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {meta.get('version')!r}")
+        return cls(meta, arrays)
+
+    def restore(self, metrics=False, collector=None):
+        """
+        Builds a new CityModel in the state of the snapshot.
+
+        Parameters:
+        - metrics: As in CityModel.
+        - collector: As in CityModel.
+        """
+        meta, arrays = self.meta, self.arrays
+        city_map = load_city_map(meta["city"])
+        if city_map.digest != meta["digest"]:
+            raise ValueError(f"The map {meta['city']!r} changed since the snapshot was taken")
+
+        scalars = meta["scalars"]
+        model = CityModel(scalars["n"], engine=meta["engine"], city=meta["city"], metrics=metrics,
+                          signals=meta["signals"], collector=collector)
+        try:
+            self.apply(model)
+        except Exception:
+            model.close()
+            raise
+        return model
+
+    def check_arrays(self, model):
+        """
+        Raises ValueError unless every array fits the map and the counters of
+        model (already set from the snapshot's scalars): lights and
+        intersections have the right sizes, every car is on a graph node of
+        the map, and car numbers and cells are unique. The snapshot may come
+        from a client, so nothing is trusted before it is used.
+        """
+        arrays = self.arrays
+        graph = model.compiled_graph
+
+        def array(name, dtype_kind, shape):
+            value = arrays.get(name)
+            if value is None or value.dtype.kind not in dtype_kind or value.shape != shape:
+                raise ValueError(f"Invalid {name} array in the snapshot")
+            return value
+
+        def in_range(name, values, low, high):
+            if values.size and not (low <= values.min() and values.max() < high):
+                raise ValueError(f"{name} out of range in the snapshot")
+
+        light_count, intersection_count = len(model.traffic_lights), len(model.intersections)
+        array("light_states", "b", (light_count,))
+        in_range("light_requests", array("light_requests", "iu", (light_count,)), 0, np.iinfo(np.int64).max)
+        array("vertical_green", "b", (intersection_count,))
+        in_range("elapsed", array("elapsed", "iu", (intersection_count,)), 0, np.iinfo(np.int64).max)
+
+        if model.vectorized is not None:
+            count = len(arrays.get("engine_numbers", ()))
+            cars = {name: array(f"engine_{name}", "iu", (count,)) for name in ENGINE_ARRAYS}
+            in_range("engine_nodes", cars["nodes"], 0, graph.node_count)
+            in_range("engine_next_hops", cars["next_hops"], -1, graph.node_count)
+            in_range("engine_destinations", cars["destinations"], 0, len(model.destinations))
+            in_range("engine_stuck", cars["stuck"], 0, np.iinfo(np.int32).max)
+            nodes = cars["nodes"]
+        else:
+            count = len(arrays.get("car_numbers", ()))
+            cars = {name: array(f"car_{name}", "iu", (count,)) for name in
+                    ("numbers", "destinations", "stuck", "colors", "spawn_steps", "moved_steps", "detour_lengths")}
+            array("car_has_direction", "b", (count,))
+            in_range("car_directions", array("car_directions", "iu", (count, 2)), -1, 2)
+            in_range("car_destinations", cars["destinations"], 0, len(model.destinations))
+            in_range("car_stuck", cars["stuck"], 0, np.iinfo(np.int32).max)
+            in_range("car_colors", cars["colors"], 0, len(color_palette))
+            in_range("car_detour_lengths", cars["detour_lengths"], -1, graph.node_count)
+            detour_count = int(cars["detour_lengths"][cars["detour_lengths"] > 0].sum())
+            nodes = self.graph_nodes(graph, array("car_positions", "iu", (count, 2)), "car_positions")
+            self.graph_nodes(graph, array("car_detour_cells", "iu", (detour_count, 2)), "car_detour_cells")
+
+        in_range("car numbers", cars["numbers"], 0, model.car_id_counter + 1)
+        in_range("car spawn steps", cars["spawn_steps"], 0, model.step_count + 1)
+        in_range("car moved steps", cars["moved_steps"], 0, model.step_count + 1)
+        if len(np.unique(cars["numbers"])) != count or len(np.unique(nodes)) != count:
+            raise ValueError("Two cars share a number or a cell in the snapshot")
+        if count != model.in_grid:
+            raise ValueError(f"The snapshot has {count} cars but in_grid is {model.in_grid}")
+
+    @staticmethod
+    def graph_nodes(graph, positions, name):
+        """
+        Returns the graph node of every (x, y) row of positions, or raises
+        ValueError if one of them is off the map or not a road cell of the graph.
+        """
+        xs, ys = positions[:, 0], positions[:, 1]
+        if not np.all((xs >= 0) & (xs < graph.width) & (ys >= 0) & (ys < graph.height)):
+            raise ValueError(f"{name} off the map in the snapshot")
+        nodes = graph.node_ids[xs, ys]
+        if np.any(nodes < 0):
+            raise ValueError(f"{name} not on a road in the snapshot")
+        return nodes
+
+    def apply(self, model):
+        """
+        Puts a model just built for this snapshot in its state (see restore).
+        """
+        meta, arrays = self.meta, self.arrays
+        scalars = meta["scalars"]
+        # Only the known attributes, with the types they have in a new model (the snapshot may come from a client)
+        for name in MODEL_SCALARS:
+            value = scalars.get(name)
+            if name in TUNABLES:
+                model.set_tunable(name, value)
+            elif type(value) is type(getattr(model, name)):
+                setattr(model, name, value)
+            else:
+                raise ValueError(f"Invalid value {value!r} for {name} in the snapshot")
+        self.check_arrays(model)
+        model.schedule.steps, model.schedule.time = meta["schedule"]
+        for name in RANDOM_STREAMS:
+            version, gauss_next = meta["random"][name]
+            getattr(model, name).setstate((version, tuple(arrays[f"{name}_state"].tolist()), gauss_next))
+        model.removed_cars.extend(tuple(removal) for removal in meta["removed_cars"])
+
+        # Lights, intersections and signal controller
+        for light, state in zip(model.traffic_lights, arrays["light_states"].tolist()):
+            light.state = state
+        model.light_requests[:] = arrays["light_requests"]
+        for intersection, vertical_green, elapsed in zip(model.intersections, arrays["vertical_green"].tolist(),
+                                                         arrays["elapsed"].tolist()):
+            intersection.vertical_green = vertical_green
+            intersection.elapsed = elapsed
+        controller = vars(model.signal_controller)
+        for name, default in controller.items():
+            value = meta["controller"].get(name)
+            if type(value) is not type(default):
+                raise ValueError(f"Invalid value {value!r} for the signal controller's {name} in the snapshot")
+            controller[name] = value
+
+        if model.vectorized is not None:
+            engine = model.vectorized
+            engine.rng.bit_generator.state = meta["engine_rng"]
+            for name in ENGINE_ARRAYS:
+                setattr(engine, name, arrays[f"engine_{name}"].copy())
+            model.car_layer[engine.node_xs[engine.nodes], engine.node_ys[engine.nodes]] = engine.numbers
+            return
+
+        detour_cells = [tuple(pos) for pos in arrays["car_detour_cells"].tolist()]
+        detour_start = 0
+        cars = zip(arrays["car_numbers"].tolist(), arrays["car_positions"].tolist(),
+                   arrays["car_destinations"].tolist(), arrays["car_stuck"].tolist(),
+                   arrays["car_colors"].tolist(), arrays["car_spawn_steps"].tolist(),
+                   arrays["car_moved_steps"].tolist(), arrays["car_directions"].tolist(),
+                   arrays["car_has_direction"].tolist(), arrays["car_detour_lengths"].tolist())
+        for number, pos, destination, stuck, color, spawn_step, moved_step, direction, has_direction, detour in cars:
+            car = Car(f"car_{number}", model, model.destinations[destination], number=number, color_index=color)
+            car.stuck_counter = stuck
+            car.spawn_step = spawn_step
+            car.direction = tuple(direction) if has_direction else None
+            if detour >= 0:
+                car.detour = detour_cells[detour_start:detour_start + detour]
+                detour_start += detour
+            model.place_car(car, tuple(pos))
+            car.moved_step = moved_step
+            model.schedule.add(car)
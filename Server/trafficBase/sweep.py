@@ -0,0 +1,150 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages parallel parameter sweeps of the city model
+# 2024
+
+import argparse
+import inspect
+import itertools
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .citymap import load_city_map, DEFAULT_CITY
+from .model import CityModel
+
+# Parameters passed to CityModel itself; anything else must be one of TUNABLES, set once it is built
+INIT_PARAMETERS = set(inspect.signature(CityModel.__init__).parameters) - {"self", "seed"}
+
+
+def parameter_grid(parameters):
+    """
+    Expands a dictionary of parameter -> list of values into every combination.
+    """
+    names = list(parameters)
+    return [dict(zip(names, values)) for values in itertools.product(*(parameters[name] for name in names))]
+
+
+def run_replica(config, steps, seed):
+    """
+    Runs one seeded model for a number of steps (or until it stops) and
+    returns its DataCollector model series. Settings that are not CityModel
+    parameters must be TUNABLES; the model is closed when the run ends.
+    """
+    init = {name: value for name, value in config.items() if name in INIT_PARAMETERS}
+    init.setdefault("N", 0)
+    model = CityModel(**init, seed=seed)
+    try:
+        for name, value in config.items():
+            if name not in INIT_PARAMETERS:
+                model.set_tunable(name, value)
+
+        for _ in range(steps):
+            model.step()
+            if not model.running:
+                break
+        return model.datacollector.model_vars
+    finally:
+        model.close()
+
+
+def aggregate(series_list):
+    """
+    Combines the series of several replicas step by step: mean, standard
+    deviation, min and max over the replicas still running at that step.
+    """
+    aggregated = {}
+    for name in series_list[0]:
+        runs = [series[name] for series in series_list]
+        stats = {"mean": [], "std": [], "min": [], "max": [], "replicas": []}
+        for step in range(max(len(run) for run in runs)):
+            values = [run[step] for run in runs if step < len(run)]
+            mean = sum(values) / len(values)
+            stats["mean"].append(mean)
+            stats["std"].append(math.sqrt(sum((value - mean) ** 2 for value in values) / len(values)))
+            stats["min"].append(min(values))
+            stats["max"].append(max(values))
+            stats["replicas"].append(len(values))
+        aggregated[name] = stats
+    return aggregated
+
+
+def run_configuration(index, config, replicas, steps, base_seed):
+    """
+    Runs every replica of one configuration in the current worker and
+    returns the aggregated series. Replica r uses seed base_seed + r.
+    """
+    series_list = [run_replica(config, steps, base_seed + replica) for replica in range(replicas)]
+    final = {name: [series[name][-1] for series in series_list] for name in series_list[0]}
+    return {
+        "index": index,
+        "config": config,
+        "replicas": replicas,
+        "steps": steps,
+        "final_mean": {name: sum(values) / len(values) for name, values in final.items()},
+        "series": aggregate(series_list),
+    }
+
+
+def preload_maps(cities):
+    """
+    Worker initializer: compiles (or loads from the map cache) every map once per process.
+    """
+    for city in cities:
+        load_city_map(city)
+
+
+def run_sweep(configs, replicas=5, steps=300, processes=None, base_seed=0):
+    """
+    Runs every configuration on a process pool and yields its result as soon
+    as it is done (in completion order; each result carries its index).
+
+    Parameters:
+    - configs: List of dictionaries of CityModel parameters (N, engine, city,
+      ...) and TUNABLES settings (light_cycle_duration, spawn_interval, ...).
+    - replicas: Seeded runs per configuration.
+    - steps: Steps per run (a run also ends when the model stops).
+    - processes: Worker processes (default: one per CPU core).
+    - base_seed: Seed of the first replica.
+    """
+    cities = sorted({config.get("city", DEFAULT_CITY) for config in configs})
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count(),
+                             initializer=preload_maps, initargs=(cities,)) as pool:
+        futures = [pool.submit(run_configuration, index, config, replicas, steps, base_seed)
+                   for index, config in enumerate(configs)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def parse_parameter(text):
+    """
+    Parses "name=v1,v2,..." into (name, [values]), reading numbers as numbers.
+    """
+    name, _, values = text.partition("=")
+    parsed = []
+    for value in values.split(","):
+        try:
+            parsed.append(json.loads(value))
+        except json.JSONDecodeError:
+            parsed.append(value)
+    return name, parsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a parameter sweep of CityModel on a process pool.")
+    parser.add_argument("--param", action="append", default=[], type=parse_parameter,
+                        help="Swept parameter, e.g. light_cycle_duration=6,10,14 (repeatable)")
+    parser.add_argument("--replicas", type=int, default=5)
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="sweep_results.jsonl", help="JSON lines file, one configuration per line")
+    arguments = parser.parse_args()
+
+    configs = parameter_grid(dict(arguments.param))
+    with open(arguments.output, 'w') as output:
+        for done, result in enumerate(run_sweep(configs, arguments.replicas, arguments.steps,
+                                                arguments.processes, arguments.seed), start=1):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            print(f"[{done}/{len(configs)}] {result['config']} -> {result['final_mean']}")
@@ -0,0 +1,229 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the recording and replay of car trajectories and light states
+# 2024
+
+import json
+import mmap
+import os
+import numpy as np
+
+TRAJECTORY_MAGIC = b"TRJ1"
+INDEX_MAGIC = b"TIDX"
+# Int32 fields at the start of every step record
+RECORD_HEADER = ("step", "keyframe", "reached_destination", "light_count", "set_count", "removed_count")
+
+
+def padded(size):
+    """
+    Rounds a byte count up to a multiple of 4, so every int32 section stays aligned.
+    """
+    return (size + 3) & ~3
+
+
+def car_number(unique_id):
+    """
+    Number of a car from its unique id ("car_<number>").
+    """
+    return int(unique_id[4:])
+
+
+class TrajectoryRecorder:
+    """
+    Writes the car positions and light states of every step of a model to
+    an append-only file that TrajectoryReader memory-maps.
+
+    File layout (little-endian, every section 4-byte aligned):
+    - "TRJ1", uint32 length of the JSON header, JSON header (map, seed, ...).
+    - One record per step: RECORD_HEADER as int32, then the light states
+      (uint8, 1 for green), the (number, x, y) int32 triples of the cars set
+      in this step, and the int32 numbers of the removed cars. A keyframe
+      lists every car; the other records only list the cars that entered,
+      moved or left since the previous record.
+    - On close: an int64 (step, offset, keyframe) index of the records,
+      then "TIDX" and the int64 offset of the index.
+    A file left without an index (the process died) is still readable.
+    """
+
+    def __init__(self, path, model, keyframe_interval=100):
+        """
+        Parameters:
+        - path: File to write (replaced if it exists).
+        - model: The CityModel being recorded (for the header).
+        - keyframe_interval: Records between two full keyframes. Seeking to a
+          step replays at most this many deltas.
+        """
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.index = []  # (step, offset, keyframe) of every record
+        self.last_step = None
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'wb')
+
+        header = json.dumps({
+            "city": model.city,
+            "digest": model.city_map.digest,
+            "width": model.width,
+            "height": model.height,
+            "engine": model.engine,
+            "signals": model.signals,
+            "seed": model._seed,
+            "lights": [light.unique_id for light in model.traffic_lights],
+            "keyframe_interval": keyframe_interval,
+        }).encode()
+        self.file.write(TRAJECTORY_MAGIC + np.uint32(len(header)).tobytes() + header)
+        self.file.write(b"\0" * (padded(len(header)) - len(header)))
+
+    def record(self, model):
+        """
+        Appends the state of the model after its last step.
+        """
+        keyframe = self.last_step is None or len(self.index) % self.keyframe_interval == 0
+        removed = []
+        if keyframe:
+            numbers, xs, ys = model.car_arrays()
+        else:
+            changes = model.car_changes(self.last_step)
+            keyframe = changes["full"]
+            cars = changes["added"] + changes["moved"]
+            numbers = np.array([car_number(unique_id) for unique_id, _ in cars], dtype=np.int32)
+            positions = np.array([pos for _, pos in cars], dtype=np.int32).reshape(-1, 2)
+            xs, ys = positions[:, 0], positions[:, 1]
+            removed = [car_number(unique_id) for unique_id in changes["removed"]]
+
+        lights = model.light_states().astype(np.uint8)
+        cars = np.empty((len(numbers), 3), dtype='<i4')
+        cars[:, 0] = numbers
+        cars[:, 1] = xs
+        cars[:, 2] = ys
+        header = np.array([model.step_count, keyframe, model.reached_destination,
+                           len(lights), len(cars), len(removed)], dtype='<i4')
+
+        self.index.append((model.step_count, self.file.tell(), int(keyframe)))
+        self.file.write(header.tobytes())
+        self.file.write(lights.tobytes() + b"\0" * (padded(len(lights)) - len(lights)))
+        self.file.write(cars.tobytes())
+        self.file.write(np.array(removed, dtype='<i4').tobytes())
+        self.last_step = model.step_count
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        """
+        Writes the index and closes the file.
+        """
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.index, dtype='<i8').reshape(-1, 3).tobytes())
+        self.file.write(INDEX_MAGIC + np.int64(index_offset).tobytes())
+        self.file.close()
+
+
+class TrajectoryReader:
+    """
+    Reads a file written by TrajectoryRecorder through a memory map: records
+    are read straight from the page cache and nothing is simulated. Reading
+    steps in order only applies one delta per step.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:4] != TRAJECTORY_MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a trajectory file")
+        header_size = int(np.frombuffer(self.map, dtype='<u4', count=1, offset=4)[0])
+        self.header = json.loads(self.map[8:8 + header_size])
+        self.records_start = 8 + padded(header_size)
+
+        end = len(self.map)
+        if end >= 12 and self.map[end - 12:end - 8] == INDEX_MAGIC:
+            index_offset = int(np.frombuffer(self.map, dtype='<i8', count=1, offset=end - 8)[0])
+            count = (end - 12 - index_offset) // 24
+            index = np.frombuffer(self.map, dtype='<i8', count=3 * count, offset=index_offset).reshape(-1, 3).copy()
+        else:
+            index = self.scan(end)
+        self.steps = index[:, 0]
+        self.offsets = index[:, 1]
+        self.keyframes = np.flatnonzero(index[:, 2])
+        self.cursor = None  # (record position, cars) of the last frame read
+
+    def scan(self, end):
+        """
+        Rebuilds the index by walking the records (for files without an index).
+        """
+        index = []
+        offset = self.records_start
+        while offset + 24 <= end:
+            header = np.frombuffer(self.map, dtype='<i4', count=len(RECORD_HEADER), offset=offset)
+            step, keyframe, _, light_count, set_count, removed_count = header.tolist()
+            size = 24 + padded(light_count) + 12 * set_count + 4 * removed_count
+            if offset + size > end:
+                break  # Record cut short
+            index.append((step, offset, keyframe))
+            offset += size
+        return np.array(index, dtype=np.int64).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def record(self, position):
+        """
+        Returns the header fields, light states, set cars and removed cars of a record.
+        """
+        offset = int(self.offsets[position])
+        header = dict(zip(RECORD_HEADER, np.frombuffer(self.map, dtype='<i4', count=len(RECORD_HEADER),
+                                                        offset=offset).tolist()))
+        offset += 24
+        lights = np.frombuffer(self.map, dtype=np.uint8, count=header["light_count"], offset=offset)
+        offset += padded(header["light_count"])
+        cars = np.frombuffer(self.map, dtype='<i4', count=3 * header["set_count"], offset=offset).reshape(-1, 3)
+        offset += 12 * header["set_count"]
+        removed = np.frombuffer(self.map, dtype='<i4', count=header["removed_count"], offset=offset)
+        return header, lights, cars, removed
+
+    def frame(self, step):
+        """
+        Returns the recorded state after a step as a dictionary with step,
+        reached_destination, in_grid, numbers, xs, ys and lights (bool array).
+        Raises KeyError if the step was not recorded.
+        """
+        position = int(np.searchsorted(self.steps, step))
+        if position >= len(self.steps) or self.steps[position] != step:
+            raise KeyError(f"Step {step} was not recorded")
+
+        # Start from the cursor if it is between the last keyframe and the step
+        keyframe = int(self.keyframes[np.searchsorted(self.keyframes, position, side='right') - 1])
+        if self.cursor is not None and keyframe <= self.cursor[0] <= position:
+            start, cars = self.cursor[0] + 1, self.cursor[1]
+        else:
+            start, cars = keyframe, {}
+
+        for current in range(start, position + 1):
+            header, lights, set_cars, removed = self.record(current)
+            if header["keyframe"]:
+                cars = {}
+            for number in removed.tolist():
+                cars.pop(number, None)
+            for number, x, y in set_cars.tolist():
+                cars[number] = (x, y)
+        self.cursor = (position, cars)
+
+        header, lights, _, _ = self.record(position)
+        positions = np.array(list(cars.values()), dtype=np.int32).reshape(-1, 2)
+        return {
+            "step": step,
+            "reached_destination": header["reached_destination"],
+            "in_grid": len(cars),
+            "numbers": np.fromiter(cars.keys(), dtype=np.int32, count=len(cars)),
+            "xs": positions[:, 0],
+            "ys": positions[:, 1],
+            "lights": lights.astype(bool),
+        }
+
+    def close(self):
+        self.map.close()
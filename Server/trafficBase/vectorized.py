@@ -0,0 +1,290 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages the vectorized (struct-of-arrays) stepping engine for cars
+# 2024
+
+import numpy as np
+
+# Per-car arrays of an engine, all in the same car order
+CAR_ARRAYS = ("numbers", "nodes", "destinations", "next_hops", "stuck", "spawn_steps", "moved_steps")
+
+def change_lists(numbers, xs, ys, added):
+    """
+    Turns the arrays of change_arrays into the (added, moved) lists of
+    (unique_id, (x, y)) returned by changes.
+    """
+    return tuple(
+        [(f"car_{number}", (x, y)) for number, x, y in
+         zip(numbers[mask].tolist(), xs[mask].tolist(), ys[mask].tolist())]
+        for mask in (added, ~added)
+    )
+
+
+class VectorizedEngine:
+    """
+    Steps every car at once with NumPy instead of calling Car.step one object
+    at a time. Cars are stored as arrays (number, node, destination, next hop
+    and stuck counter) and follow the model's shared routing tables.
+
+    The traffic rules are the ones of Car.move: cars wait at red lights,
+    yield when the corner they want to enter is taken, never share a cell,
+    leave the grid at their destination and step aside into the best free
+    road cell when blocked by another car. Cars act in a seeded random
+    order, as with RandomActivation, and the result is the same as stepping
+    them one by one in that order: every round decides, all at once, the
+    cars that come first in the order among all cars touching the same
+    cells. Stuck cars do not search for detours; they rely on the sidestep
+    and the shared routes.
+    """
+
+    def __init__(self, model, road_mask):
+        """
+        Parameters:
+        - model: The CityModel the cars belong to.
+        - road_mask: Boolean array telling which graph nodes are road cells
+          (the only cells a car may step aside into).
+        """
+        self.model = model
+        graph = model.compiled_graph
+        self.node_count = graph.node_count
+        positions = np.array(graph.positions, dtype=np.int32).reshape(-1, 2)
+        self.node_xs = positions[:, 0]
+        self.node_ys = positions[:, 1]
+        self.light_of_node = model.light_layer[self.node_xs, self.node_ys]
+        self.corner_mask = graph.corner_mask
+        self.sidestep_mask = graph.through_mask & road_mask
+        self.destination_nodes = np.array([graph.node_id(pos) for pos in model.destinations], dtype=np.int32)
+
+        # Successors of every node, padded with -1
+        degrees = np.diff(graph.indptr)
+        self.successors = np.full((self.node_count, max(int(degrees.max(initial=0)), 1)), -1, dtype=np.int32)
+        for k in range(self.successors.shape[1]):
+            has_kth = degrees > k
+            self.successors[has_kth, k] = graph.indices[graph.indptr[:-1][has_kth] + k]
+
+        # Seeded from the model so runs are reproducible
+        self.rng = np.random.default_rng(model.random.getrandbits(64))
+
+        # Car arrays
+        self.numbers = np.empty(0, dtype=np.int64)  # Car number (as in car_layer)
+        self.nodes = np.empty(0, dtype=np.int32)  # Current node
+        self.destinations = np.empty(0, dtype=np.int32)  # Destination index
+        self.next_hops = np.empty(0, dtype=np.int32)  # Next node on the route (-1 if none)
+        self.stuck = np.empty(0, dtype=np.int32)  # Stuck counter
+        self.spawn_steps = np.empty(0, dtype=np.int64)  # Step the car entered the grid
+        self.moved_steps = np.empty(0, dtype=np.int64)  # Last step the car changed cell
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def add_car(self, number, pos, destination):
+        """
+        Adds a car at pos heading to destination (a position in model.destinations).
+        """
+        node = self.model.compiled_graph.node_id(pos)
+        destination_index = self.model.destination_index[destination]
+        self.numbers = np.append(self.numbers, number)
+        self.nodes = np.append(self.nodes, np.int32(node))
+        self.destinations = np.append(self.destinations, np.int32(destination_index))
+        self.next_hops = np.append(self.next_hops, np.int32(-1))
+        self.stuck = np.append(self.stuck, np.int32(0))
+        self.spawn_steps = np.append(self.spawn_steps, self.model.step_count)
+        self.moved_steps = np.append(self.moved_steps, self.model.step_count)
+        self.model.car_layer[pos] = number
+
+    def clear(self):
+        """
+        Removes every car. Returns how many cars were removed.
+        """
+        removed = len(self.numbers)
+        for number, spawn_step in zip(self.numbers.tolist(), self.spawn_steps.tolist()):
+            self.model.log_removal(f"car_{number}", spawn_step)
+        self.model.car_layer[self.node_xs[self.nodes], self.node_ys[self.nodes]] = -1
+        self.keep(np.zeros(removed, dtype=bool))
+        return removed
+
+    def keep(self, mask):
+        """
+        Keeps only the cars selected by a boolean mask.
+        """
+        for name in CAR_ARRAYS:
+            setattr(self, name, getattr(self, name)[mask])
+
+    def positions(self):
+        """
+        Returns a list of (unique_id, (x, y)) for every car.
+        """
+        xs = self.node_xs[self.nodes].tolist()
+        ys = self.node_ys[self.nodes].tolist()
+        return [(f"car_{number}", (x, y)) for number, x, y in zip(self.numbers.tolist(), xs, ys)]
+
+    def changes(self, since):
+        """
+        Returns the cars that entered the grid after step since and the older
+        cars that changed cell after it, as two lists of (unique_id, (x, y)).
+        """
+        return change_lists(*self.change_arrays(since))
+
+    def change_arrays(self, since):
+        """
+        Returns the number, x and y of the cars that changed cell after step
+        since, and whether each of them entered the grid after it.
+        """
+        changed = self.moved_steps > since
+        nodes = self.nodes[changed]
+        return (self.numbers[changed].astype(np.int32), self.node_xs[nodes], self.node_ys[nodes],
+                self.spawn_steps[changed] > since)
+
+    def car_arrays(self):
+        """
+        Returns the number, x and y of every car as three int32 arrays.
+        """
+        return self.numbers.astype(np.int32), self.node_xs[self.nodes], self.node_ys[self.nodes]
+
+    def stuck_count(self):
+        """
+        Returns how many cars did not manage to move in their last turn.
+        """
+        return int((self.stuck > 0).sum())
+
+    def take(self, mask):
+        """
+        Removes the cars selected by a boolean mask and returns their arrays
+        (a dictionary by CAR_ARRAYS name), to hand them to another engine.
+        """
+        cars = {name: getattr(self, name)[mask] for name in CAR_ARRAYS}
+        self.keep(~mask)
+        return cars
+
+    def extend(self, cars):
+        """
+        Adds cars returned by take. Their cells must already be set in the
+        car layer. Cars stay ordered by number, as add_car leaves them, so
+        the next step does not depend on the order cars were handed over.
+        """
+        order = np.argsort(np.concatenate([self.numbers, cars["numbers"]]), kind="stable")
+        for name in CAR_ARRAYS:
+            setattr(self, name, np.concatenate([getattr(self, name), cars[name]])[order])
+
+    def step(self):
+        """
+        Advances every car by one step.
+        """
+        light_states = np.array([light.state for light in self.model.traffic_lights] + [True], dtype=bool)
+        self.move_cars(np.arange(len(self.numbers)), light_states)
+
+    def move_cars(self, cars, light_states):
+        """
+        Gives a turn to some of the cars. The others keep their cell and
+        state, and the cells they hold count as taken.
+
+        Parameters:
+        - cars: Indices of the cars that act.
+        - light_states: State of every traffic light, then True (for cells without a light).
+        """
+        count = len(cars)
+        if count == 0:
+            return
+
+        model = self.model
+        order = self.rng.permutation(count)  # Turn of each car in this step
+        nodes = self.nodes[cars]
+        destinations = self.destinations[cars]
+        old_xs = self.node_xs[nodes]
+        old_ys = self.node_ys[nodes]
+
+        # Move proposals from the shared routing tables
+        at_destination = nodes == self.destination_nodes[destinations]
+        targets = model.routing_tables[destinations, nodes]
+        targets[at_destination] = -1
+        self.next_hops[cars] = targets
+        safe_targets = np.maximum(targets, 0)
+        target_lights = self.light_of_node[safe_targets]
+        red = (targets >= 0) & ~light_states[target_lights]  # Index -1 means no light
+        asking = (targets >= 0) & (target_lights >= 0)
+        np.add.at(model.light_requests, target_lights[asking], 1)  # Queue counts for the signal controller
+        waiting = (targets < 0) | red  # Cars that do not try to move at all
+
+        # Cells each car depends on: its own, its target and the ones it may step into
+        options = self.successors[nodes]
+        cells = np.concatenate([nodes[:, None], targets[:, None], options], axis=1)
+
+        # Only the cells the cars touch are ever read, so only those are set
+        # (the cost of a step follows the cars, not the size of the map).
+        # Cells held by cars that do not act are taken for the whole step.
+        occupant = np.empty(self.node_count, dtype=np.int64)
+        touched = cells[cells >= 0]
+        occupant[touched] = -1
+        occupant[touched[model.car_layer[self.node_xs[touched], self.node_ys[touched]] >= 0]] = count
+        occupant[nodes] = np.arange(count)
+        new_nodes = nodes.copy()
+        moved = np.zeros(count, dtype=bool)
+        blocked = np.zeros(count, dtype=bool)
+        undecided = np.arange(count)
+        earliest = np.empty(self.node_count, dtype=np.int64)  # Set for every cell before it is read
+
+        while undecided.size:
+            # A car can act now if it comes first among the undecided cars touching its cells
+            car_cells = cells[undecided]
+            used = car_cells >= 0
+            earliest[car_cells[used]] = count
+            np.minimum.at(earliest, car_cells[used], np.broadcast_to(order[undecided][:, None], car_cells.shape)[used])
+            ready = np.all(~used | (earliest[np.maximum(car_cells, 0)] == order[undecided][:, None]), axis=1)
+            acting = undecided[ready]
+            undecided = undecided[~ready]
+
+            # Cars at their destination leave the grid
+            leaving = acting[at_destination[acting]]
+            occupant[nodes[leaving]] = -1
+
+            trying = acting[~at_destination[acting] & ~waiting[acting]]
+            free = occupant[targets[trying]] < 0
+            going = trying[free]
+            occupant[nodes[going]] = -1
+            occupant[targets[going]] = going
+            new_nodes[going] = targets[going]
+            moved[going] = True
+
+            # Blocked cars yield to a taken corner, or step aside into the free
+            # road cell with the lowest remaining route cost
+            stopped = trying[~free]
+            stopped = stopped[~self.corner_mask[targets[stopped]]]
+            choices = options[stopped]
+            safe_choices = np.maximum(choices, 0)
+            valid = (choices >= 0) & self.sidestep_mask[safe_choices] & (occupant[safe_choices] < 0)
+            distances = np.where(valid, model.route_distances[destinations[stopped][:, None], safe_choices], np.inf)
+            best = np.argmin(distances, axis=1) if stopped.size else np.empty(0, dtype=np.int64)
+            rows = np.arange(stopped.size)
+            can_step = distances[rows, best] < np.inf
+            stepping = stopped[can_step]
+            side = choices[rows, best][can_step]
+            occupant[nodes[stepping]] = -1
+            occupant[side] = stepping
+            new_nodes[stepping] = side
+            moved[stepping] = True
+            blocked[stopped[~can_step]] = True
+
+        # Update the stuck counters like Car.move does
+        stuck = self.stuck[cars]
+        stuck[moved] = 0
+        self.moved_steps[cars[moved]] = model.step_count
+        stuck[red | blocked] += 1
+        stuck[blocked & (stuck == 3)] = 0
+        self.stuck[cars] = stuck
+        self.nodes[cars] = new_nodes
+
+        # Keep the car layer in sync
+        model.car_layer[old_xs, old_ys] = -1
+        staying = ~at_destination
+        model.car_layer[self.node_xs[new_nodes[staying]], self.node_ys[new_nodes[staying]]] = self.numbers[cars[staying]]
+        arrived = int(at_destination.sum())
+        if arrived:
+            leaving = cars[at_destination]
+            for number, spawn_step in zip(self.numbers[leaving].tolist(), self.spawn_steps[leaving].tolist()):
+                model.record_trip(number, spawn_step)
+                model.log_removal(f"car_{number}", spawn_step)
+            keep = np.ones(len(self.numbers), dtype=bool)
+            keep[leaving] = False
+            self.keep(keep)
+            model.in_grid -= arrived
+            model.reached_destination += arrived
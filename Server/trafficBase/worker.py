@@ -0,0 +1,375 @@
+# Imanol Santisteban
+# Nicolas Alarcón
+# This code manages city models stepped in a separate worker process
+# 2024
+
+import multiprocessing
+import threading
+import time
+import traceback
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from .agent import Traffic_Light
+from .broadcast import check_tick_rate
+from .citymap import load_city_map, DEFAULT_CITY
+from .collector import RingBufferSink
+from .model import CityModel
+
+# Int32 fields at the start of every published frame
+FRAME_FIELDS = ("step", "in_grid", "reached_destination", "car_count", "running", "stuck_cars")
+
+
+class WorkerError(Exception):
+    """
+    Raised by a WorkerModel whose worker process stopped stepping (its model
+    raised or the process died), instead of serving its last frame.
+    """
+
+
+class FrameBuffer:
+    """
+    Double-buffered frames in shared memory: the worker writes a new step
+    into the slot readers are not using and then flips "latest", so readers
+    always find a whole frame without waiting for the model. Every slot has
+    a sequence number, odd while the slot is written; a reader that sees it
+    change while copying (the worker published twice meanwhile) reads again.
+
+    Layout: int64 [latest slot, frames published], then two slots of int64
+    sequence, int32 FRAME_FIELDS, int32 car numbers, int32 (x, y) pairs
+    and uint8 light states.
+    """
+
+    def __init__(self, buffer, capacity, light_count):
+        """
+        Parameters:
+        - buffer: The shared memory (memoryview) to use.
+        - capacity: Most cars a frame can hold (one per graph node is enough).
+        - light_count: Number of traffic lights.
+        """
+        self.capacity = capacity
+        self.light_count = light_count
+        self.control = np.ndarray(2, dtype=np.int64, buffer=buffer)
+        self.slots = []
+        offset = self.control.nbytes
+        for _ in range(2):
+            slot = {}
+            for name, dtype, count in (("sequence", np.int64, 1), ("fields", np.int32, len(FRAME_FIELDS)),
+                                       ("numbers", np.int32, capacity), ("positions", np.int32, 2 * capacity),
+                                       ("lights", np.uint8, light_count)):
+                slot[name] = np.ndarray(count, dtype=dtype, buffer=buffer, offset=offset)
+                offset += -(-slot[name].nbytes // 8) * 8  # Keep every array 8-byte aligned
+            self.slots.append(slot)
+
+    @classmethod
+    def size(cls, capacity, light_count):
+        """
+        Bytes of shared memory needed for a buffer.
+        """
+        slot = sum(-(-size // 8) * 8 for size in (8, 4 * len(FRAME_FIELDS), 4 * capacity, 8 * capacity, light_count))
+        return 16 + 2 * slot
+
+    def publish(self, model):
+        """
+        Writes the state of the model into the free slot and makes it the latest.
+        """
+        slot = self.slots[1 - int(self.control[0])]
+        numbers, xs, ys = model.car_arrays()
+        count = len(numbers)
+        slot["sequence"][0] += 1  # Odd: being written
+        slot["fields"][:] = (model.step_count, model.in_grid, model.reached_destination, count,
+                             model.running, model.stuck_car_count())
+        slot["numbers"][:count] = numbers
+        slot["positions"][0:2 * count:2] = xs
+        slot["positions"][1:2 * count:2] = ys
+        slot["lights"][:] = model.light_states()
+        slot["sequence"][0] += 1  # Even: complete
+        self.control[0] = 1 - int(self.control[0])
+        self.control[1] += 1
+
+    def read(self):
+        """
+        Returns a copy of the latest frame as a dictionary of FRAME_FIELDS and
+        numbers, xs, ys and lights arrays.
+        """
+        while True:
+            slot = self.slots[int(self.control[0])]
+            sequence = int(slot["sequence"][0])
+            if sequence % 2:
+                time.sleep(0)  # Being written, let the worker finish
+                continue
+            frame = dict(zip(FRAME_FIELDS, slot["fields"].tolist()))
+            count = frame["car_count"]
+            frame["numbers"] = slot["numbers"][:count].copy()
+            positions = slot["positions"][:2 * count].copy()
+            frame["xs"], frame["ys"] = positions[0::2], positions[1::2]
+            frame["lights"] = slot["lights"].astype(bool)
+            if int(slot["sequence"][0]) == sequence:
+                return frame
+
+
+def run_worker(connection, memory_name, capacity, light_count, model_args):
+    """
+    Main loop of the worker process: builds the model, publishes every step
+    into the shared frame buffer and runs the commands sent by WorkerModel
+    ("step", "run", "play", "pause", "close"). If stepping raises, the error
+    is sent back as ("failed", message) and the worker waits for "close".
+    """
+    memory = SharedMemory(name=memory_name)
+    try:
+        try:
+            model = CityModel(**model_args, collector=RingBufferSink())
+        except Exception as e:
+            connection.send(("error", str(e)))
+            return
+        frames = FrameBuffer(memory.buf, capacity, light_count)
+        frames.publish(model)
+        connection.send(("ready", model._seed))
+
+        pending = 0  # Steps asked for and not run yet
+        interval = None  # Seconds between steps while playing
+        next_tick = 0.0
+        failed = False  # Set once the model raised: only "close" is served then
+        while True:
+            if failed:
+                timeout = None
+            elif pending:
+                timeout = 0
+            elif interval is not None:
+                timeout = max(0.0, next_tick - time.monotonic())
+            else:
+                timeout = None
+            command = None
+            if connection.poll(timeout):
+                command, argument = connection.recv()
+                if command == "close":
+                    break
+                if failed:
+                    continue
+
+            try:
+                if command == "step":
+                    pending += argument
+                elif command == "run":
+                    steps, until, collect = argument
+                    model.run_steps(steps, until=until, collect=collect)
+                    frames.publish(model)
+                elif command == "play":
+                    interval, next_tick = 1 / argument, time.monotonic()
+                elif command == "pause":
+                    interval = None
+                elif not model.running:
+                    pending, interval = 0, None
+                else:
+                    if pending:
+                        pending -= 1
+                    else:
+                        next_tick = max(next_tick + interval, time.monotonic())
+                    model.step()
+                    frames.publish(model)
+            except Exception as e:
+                traceback.print_exc()
+                connection.send(("failed", f"{type(e).__name__}: {e}"))
+                failed = True
+        model.close()
+    finally:
+        frames = None  # Release the views before closing the shared memory
+        memory.close()
+
+
+class PublishedFrame:
+    """
+    One frame of a WorkerModel with the read side of the CityModel interface
+    (counters, cars, lights), so endpoints can serve it like a model. Static
+    map data is read from the WorkerModel.
+    """
+
+    def __init__(self, frame, source):
+        """
+        Parameters:
+        - frame: Dictionary returned by FrameBuffer.read.
+        - source: The WorkerModel that published it.
+        """
+        self.frame = frame
+        self.source = source
+        self.step_count = frame["step"]
+        self.in_grid = frame["in_grid"]
+        self.reached_destination = frame["reached_destination"]
+        self.running = bool(frame["running"])
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+    @property
+    def traffic_lights(self):
+        """
+        The traffic lights, with their states in this frame.
+        """
+        for light, state in zip(self.source.lights, self.frame["lights"].tolist()):
+            light.state = state
+        return self.source.lights
+
+    def stuck_car_count(self):
+        return self.frame["stuck_cars"]
+
+    def car_arrays(self):
+        return self.frame["numbers"], self.frame["xs"], self.frame["ys"]
+
+    def light_states(self):
+        return self.frame["lights"]
+
+    def car_positions(self):
+        numbers, xs, ys = self.car_arrays()
+        return [(f"car_{number}", (x, y)) for number, x, y in zip(numbers.tolist(), xs.tolist(), ys.tolist())]
+
+    def car_changes(self, since=None):
+        """
+        Always a full snapshot: the worker does not publish per-car changes.
+        """
+        return {"step": self.step_count, "full": True, "added": self.car_positions(), "moved": [], "removed": []}
+
+
+class WorkerModel:
+    """
+    Stand-in for a CityModel that runs in its own process, so a slow step
+    never blocks the server's request threads. Reads (latest()) come from the
+    last frame published in shared memory and never wait for the model.
+    Stepping is asynchronous: step, run_steps and play only send a command
+    to the worker, and readers see the result once it is published. Once
+    the worker fails, every read and command raises WorkerError.
+    Static map data comes from the compiled map loaded in this process.
+    """
+
+    metrics = None  # Step profiling stays inside the worker
+    vectorized = None
+
+    def __init__(self, N, engine="agents", city=DEFAULT_CITY, seed=None, signals="fixed", record=None):
+        """
+        Parameters: as in CityModel.
+        """
+        self.n = N
+        self.engine = engine
+        self.city = city
+        self.signals = signals
+        self.city_map = load_city_map(city)
+        self.width = self.city_map.width
+        self.height = self.city_map.height
+        self.cell_layer = self.city_map.cell_layer
+        self.direction_layer = self.city_map.direction_layer
+        self.lights = [Traffic_Light(self.cell_id("tl", pos), pos, is_horizontal=is_horizontal)
+                       for pos, is_horizontal in self.city_map.lights]
+
+        capacity = self.city_map.compiled_graph.node_count  # Cars never share a cell
+        light_count = len(self.lights)
+        self.memory = SharedMemory(create=True, size=FrameBuffer.size(capacity, light_count))
+        self.frames = FrameBuffer(self.memory.buf, capacity, light_count)
+        context = multiprocessing.get_context("spawn")  # A fresh interpreter, not a copy of the server's threads
+        self.connection, worker_connection = context.Pipe()
+        model_args = dict(N=N, engine=engine, city=city, seed=seed, signals=signals, record=record)
+        self.process = context.Process(target=run_worker, daemon=True, name=f"city-worker-{city}",
+                                       args=(worker_connection, self.memory.name, capacity, light_count, model_args))
+        self.process.start()
+        while not self.connection.poll(0.1):
+            if not self.process.is_alive():
+                self.close()
+                raise RuntimeError("The worker process exited before building its model")
+        status, message = self.connection.recv()
+        if status == "error":
+            self.close()
+            raise ValueError(message)
+        self._seed = message  # Seed the worker's model drew, to replay the run
+        self.failure = None  # Why the worker stopped stepping, once it did
+        self.failure_lock = threading.Lock()  # Request threads share the pipe
+
+    # Static map helpers shared with CityModel
+    static_cells = CityModel.static_cells
+    cell_id = CityModel.cell_id
+
+    def check(self):
+        """
+        Raises WorkerError if the worker's model failed or its process died.
+        """
+        with self.failure_lock:
+            if self.failure is None and self.connection.poll():
+                try:
+                    _, self.failure = self.connection.recv()  # The only message sent after "ready"
+                except EOFError:
+                    self.process.join(timeout=1)  # Closed pipe: the process is exiting
+            if self.failure is None and not self.process.is_alive():
+                self.failure = f"the process exited with code {self.process.exitcode}"
+        if self.failure is not None:
+            raise WorkerError(f"The worker stopped stepping: {self.failure}")
+
+    def latest(self):
+        """
+        Returns the latest published frame as a PublishedFrame. Use it when
+        reading several values, so they all come from the same step.
+        """
+        self.check()
+        return PublishedFrame(self.frames.read(), self)
+
+    @property
+    def step_count(self):
+        return self.latest().step_count
+
+    @property
+    def in_grid(self):
+        return self.latest().in_grid
+
+    @property
+    def reached_destination(self):
+        return self.latest().reached_destination
+
+    @property
+    def running(self):
+        return self.latest().running
+
+    @property
+    def traffic_lights(self):
+        return self.latest().traffic_lights
+
+    def step(self):
+        """
+        Asks the worker for one more step.
+        """
+        self.check()
+        self.connection.send(("step", 1))
+
+    def run_steps(self, steps, until=None, collect=True):
+        """
+        Asks the worker to fast-forward (see CityModel.run_steps). Returns
+        (steps, "queued") at once: the worker may still stop early, as
+        CityModel.run_steps does.
+        """
+        self.check()
+        self.connection.send(("run", (steps, until, collect)))
+        return steps, "queued"
+
+    def play(self, tick_rate):
+        """
+        Lets the worker step on its own at tick_rate steps per second.
+        """
+        check_tick_rate(tick_rate)
+        self.check()
+        self.connection.send(("play", tick_rate))
+
+    def pause(self):
+        self.connection.send(("pause", None))
+
+    def close(self):
+        """
+        Stops the worker (finishing its files) and frees the shared memory.
+        """
+        if self.memory is None:
+            return
+        if self.process.is_alive():
+            try:
+                self.connection.send(("close", None))
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.frames = None
+        self.memory.close()
+        self.memory.unlink()
+        self.memory = None
@@ -63,6 +63,14 @@ class Road3D {
 
 // Define the agent server URI
 const agent_server_uri = "http://localhost:8585/";
+// Each viewer runs its own simulation on the server
+const session_id = crypto.randomUUID();
+
+// Builds the URL of a server endpoint for this viewer's session
+function serverUrl(endpoint, params = {}) {
+  const query = new URLSearchParams({ session: session_id, ...params });
+  return agent_server_uri + endpoint + "?" + query;
+}
 
 // Initialize arrays to store agents and obstacles
 const agents = [];
@@ -73,6 +81,8 @@ const Destinations = [];
 const MAX_LIGHTS = 24;
 
 const updateInterval = 100; // milliseconds
+// Open the page with ?live to let the server step the model and push every step
+const liveMode = new URLSearchParams(window.location.search).has("live");
 let lastUpdateTime = performance.now();
 // Initialize WebGL-related variables
 let gl, programInfo, agentArrays, agentsBufferInfo, agentsVao, BuildingVAO, Building2Buffer, Building2VAO, wheelVAO, wheelBufferInfo, TrafficLightArrays, TrafficLightBuffer, TrafficLightVAO, BuildingBuffer, RoadBuffer, RoadVAO, SubterraBuffer, SubterraVAO, DestinationBuffer, DestinationVAO;
@@ -409,9 +419,10 @@ async function main() {
   await initAgentsModel();
   await getLights();
   await getAgents();
-  await getBuildings();
-  await getRoads();
-  await getDestinations();
+  await getMap();
+  if (liveMode) {
+    await startLive();
+  }
 
   setLightingUniforms();
   // Pass parameters in the correct order
@@ -425,7 +436,7 @@ async function main() {
 async function initAgentsModel() {
   try {
     // Send a POST request to the agent server to initialize the model
-    let response = await fetch(agent_server_uri + "init", {
+    let response = await fetch(serverUrl("init"), {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(data)
@@ -450,40 +461,46 @@ async function initAgentsModel() {
  */
 async function getAgents() {
   try {
-    let response = await fetch(agent_server_uri + "getAgents");
+    let response = await fetch(serverUrl("getAgents"));
     if (response.ok) {
       let result = await response.json();
-
-      for (const agentData of result.positions) {
-        let agent = agents.find(a => a.id === agentData.id);
-
-        if (agent) {
-          // Update existing agent
-          if (!agent.currentPosition) {
-            agent.currentPosition = [...agent.previousPosition];
-          }
-          agent.previousPosition = [...agent.currentPosition];
-          agent.targetPosition = [agentData.x, agentData.y, agentData.z];
-          agent.lastUpdateTime = performance.now();
-        } else {
-          // Add new agent
-          const newAgent = new Agent3D(agentData.id, [agentData.x, agentData.y, agentData.z]);
-          agents.push(newAgent);
-        }
-      }
+      applyAgentPositions(result.positions);
     }
   } catch (error) {
     console.log("Error fetching agents:", error);
   }
 }
 
+/*
+ * Moves the known agents to their new positions and adds the new ones.
+ */
+function applyAgentPositions(positions) {
+  for (const agentData of positions) {
+    let agent = agents.find(a => a.id === agentData.id);
+
+    if (agent) {
+      // Update existing agent
+      if (!agent.currentPosition) {
+        agent.currentPosition = [...agent.previousPosition];
+      }
+      agent.previousPosition = [...agent.currentPosition];
+      agent.targetPosition = [agentData.x, agentData.y, agentData.z];
+      agent.lastUpdateTime = performance.now();
+    } else {
+      // Add new agent
+      const newAgent = new Agent3D(agentData.id, [agentData.x, agentData.y, agentData.z]);
+      agents.push(newAgent);
+    }
+  }
+}
+
 
 
 
 
 async function getLights() {
   try {
-    let response = await fetch(agent_server_uri + "getLights");
+    let response = await fetch(serverUrl("getLights"));
     if (response.ok) {
       let result = await response.json();
       console.log("Light positions obtained")
@@ -520,15 +537,10 @@ async function getLights() {
  */
 async function getBuildings() {
   try {
-    let response = await fetch(agent_server_uri + "getBuildings");
+    let response = await fetch(serverUrl("getBuildings"));
     if (response.ok) {
       let result = await response.json();
-      for (const obstacle of result.positions) {
-        const newObstacle = new Building3D(obstacle.id, [obstacle.x, obstacle.y, obstacle.z]);
-        // Assign a random model index (1 or 2)
-        newObstacle.modelIndex = Math.random() < 0.5 ? 1 : 2;
-        Buildings.push(newObstacle);
-      }
+      addBuildings(result.positions);
       console.log("Buildings:", Buildings);
     }
   } catch (error) {
@@ -539,7 +551,7 @@ async function getBuildings() {
 async function getRoads() {
   try {
     // Send a GET request to the agent server to retrieve the obstacle positions
-    let response = await fetch(agent_server_uri + "getRoads")
+    let response = await fetch(serverUrl("getRoads"))
 
     // Check if the response was successful
     if (response.ok) {
@@ -547,10 +559,7 @@ async function getRoads() {
       let result = await response.json()
 
       // Create new obstacles and add them to the obstacles array
-      for (const Road of result.positions) {
-        const newRoad = new Road3D(Road.id, [Road.x, Road.y, Road.z], Road.direction)
-        Roads.push(newRoad)
-      }
+      addRoads(result.positions)
       // Log the obstacles array
       console.log("Roads:", Roads)
     }
@@ -562,18 +571,12 @@ async function getRoads() {
 }
 async function getDestinations() {
   try {
-    let response = await fetch(agent_server_uri + "getDestinations");
+    let response = await fetch(serverUrl("getDestinations"));
     if (response.ok) {
       let result = await response.json();
 
       // Populate the Destinations array with position data
-      for (const dest of result.positions) {
-        Destinations.push({
-          id: dest.id,
-          position: [dest.x, dest.y, dest.z],
-          scale: [1, 1, 1], // Scale for rendering
-        });
-      }
+      addDestinations(result.positions);
 
       console.log("Destinations:", Destinations);
     }
@@ -583,9 +586,54 @@ async function getDestinations() {
 }
 
 
+/*
+ * Retrieves every static layer of the map (buildings, roads and destinations) in one request.
+ */
+async function getMap() {
+  try {
+    let response = await fetch(serverUrl("getMap"));
+    if (response.ok) {
+      let result = await response.json();
+      addBuildings(result.buildings);
+      addRoads(result.roads);
+      addDestinations(result.destinations);
+      console.log("Map:", result.width, "x", result.height);
+    }
+  } catch (error) {
+    console.error("Error fetching map:", error);
+  }
+}
+
+function addBuildings(positions) {
+  for (const obstacle of positions) {
+    const newObstacle = new Building3D(obstacle.id, [obstacle.x, obstacle.y, obstacle.z]);
+    // Assign a random model index (1 or 2)
+    newObstacle.modelIndex = Math.random() < 0.5 ? 1 : 2;
+    Buildings.push(newObstacle);
+  }
+}
+
+function addRoads(positions) {
+  for (const Road of positions) {
+    const newRoad = new Road3D(Road.id, [Road.x, Road.y, Road.z], Road.direction)
+    Roads.push(newRoad)
+  }
+}
+
+function addDestinations(positions) {
+  for (const dest of positions) {
+    Destinations.push({
+      id: dest.id,
+      position: [dest.x, dest.y, dest.z],
+      scale: [1, 1, 1], // Scale for rendering
+    });
+  }
+}
+
+
 async function getModelStats() {
   try {
-    let response = await fetch(agent_server_uri + "getStats");
+    let response = await fetch(serverUrl("getStats"));
     if (response.ok) {
       let stats = await response.json();
 
@@ -598,18 +646,68 @@ async function getModelStats() {
 }
 
 /*
- * Updates the agent positions by sending a request to the agent server.
+ * Reads a binary frame of the /step endpoint (see trafficBase/frames.py)
+ * as typed array views over the response buffer.
+ */
+function readFrame(buffer) {
+  const header = new Int32Array(buffer, 0, 6);
+  const [version, step, inGrid, reachedDestination, carCount, lightCount] = header;
+  let offset = header.byteLength;
+  const numbers = new Int32Array(buffer, offset, carCount);
+  offset += numbers.byteLength;
+  const positions = new Int32Array(buffer, offset, 2 * carCount);
+  offset += positions.byteLength;
+  const lights = new Uint8Array(buffer, offset, lightCount);
+  return { version, step, inGrid, reachedDestination, numbers, positions, lights };
+}
+
+/*
+ * Updates the agents, lights (in /getLights order) and stats from one simulation step.
+ */
+function applyFrame(positions, lights, inGrid, reachedDestination) {
+  applyAgentPositions(positions);
+  for (let i = 0; i < lights.length && i < traficLights.length; i++) {
+    traficLights[i].state = Boolean(lights[i]);
+  }
+  updateStatsUI({ in_grid: inGrid, reached_destination: reachedDestination });
+}
+
+/*
+ * Lets the server step the model on its own and listens to the frames it pushes.
+ */
+async function startLive() {
+  const events = new EventSource(serverUrl("stream"));
+  events.addEventListener("frame", (event) => {
+    const frame = JSON.parse(event.data);
+    applyFrame(frame.cars, frame.lights, frame.in_grid, frame.reached_destination);
+  });
+  try {
+    await fetch(serverUrl("play", { tick_rate: 1000 / updateInterval }), { method: "POST" });
+  } catch (error) {
+    console.log(error);
+  }
+}
+
+/*
+ * Advances the model and updates the agents, lights and stats with a single request.
  */
 async function update() {
   try {
-    let response = await fetch(agent_server_uri + "update");
+    let response = await fetch(serverUrl("step", { format: "binary" }));
 
     if (response.ok) {
-      // Retrieve the updated agent positions
-      await getAgents();
-      await getLights();
-      await getModelStats();
-      console.log("Updated agents");
+      const frame = readFrame(await response.arrayBuffer());
+
+      const positions = [];
+      for (let i = 0; i < frame.numbers.length; i++) {
+        positions.push({
+          id: "car_" + frame.numbers[i],
+          x: frame.positions[2 * i],
+          y: 0.7,
+          z: frame.positions[2 * i + 1],
+        });
+      }
+      applyFrame(positions, frame.lights, frame.inGrid, frame.reachedDestination);
     }
   } catch (error) {
     console.log(error);
@@ -656,7 +754,7 @@ async function drawScene(gl, programInfo, wheelBufferInfo, wheelVAO, BuildingVAO
   drawDestination(distance, DestinationVAO, DestinationBuffer, viewProjectionMatrix);
 
   const currentTime = performance.now();
-  if (currentTime - lastUpdateTime >= updateInterval) {
+  if (!liveMode && currentTime - lastUpdateTime >= updateInterval) {
     lastUpdateTime = currentTime;
     await update();
   }